@@ -18,11 +18,21 @@ import numpy as np
 import os
 import sys
 import shutil
-import glob
 import argparse
 import hashlib
+import xlsxwriter
+import json
+import functools
 import ast
 import time
+# load tidals package locally if it does not exist globally
+import importlib
+if importlib.util.find_spec("tidals") is None:
+    tidalsPath = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                      "..", "..", "..", "tidepool-analysis-tools"))
+    if tidalsPath not in sys.path:
+        sys.path.insert(0, tidalsPath)
+import tidals as td
 
 
 # %% USER INPUTS
@@ -80,7 +90,8 @@ parser.add_argument("-f",
                     # default=["all"], NOTE: we define the default to be "all" below
                     action="append",
                     help="the format of the exported data. Export options " +
-                         "include json, xlsx, csv, csvs, or all. " +
+                         "include json, ndjson, xlsx, csv, csvs, or all " +
+                         "(all does not include ndjson). " +
                          "NOTE: you can include multiple formats by passing " +
                          "the option multiple times (e.g., -f json -f csv)")
 
@@ -101,18 +112,32 @@ parser.add_argument("--filterByDatesExceptUploadsAndSettings",
                          "after start and end dates, so include ALL " +
                          "upload and settings data in export")
 
+parser.add_argument("--low-memory",
+                    dest="lowMemory",
+                    default="False",
+                    help="save the data of each type to (hidden) csv files, " +
+                         "and read them back for each export, instead of " +
+                         "keeping all of the exports in memory. Specify " +
+                         "boolean with a string (e.g., 'True', 'False', " +
+                         "'T', or 'F'")
+
 args = parser.parse_args()
 # Because having a default for an action="append" always includes the default...
 if args.exportFormat is None:
     args.exportFormat = ['all']
 
 
+# the number of rows of an excel sheet (including the header) is limited
+excelMaxRows = 1048576
+
+
 # %% LOAD DATA FUNCTIONS
 def checkInputFile(inputFile):
     if os.path.isfile(inputFile):
         if os.stat(inputFile).st_size > 2:
             if inputFile[-4:] == "json":
-                inputData = pd.read_json(inputFile, orient="records")
+                inputData = pd.read_json(inputFile, orient="records",
+                                         precise_float=True)
                 fileName = os.path.split(inputFile)[-1][:-5]
             elif inputFile[-4:] == "xlsx":
                 inputData = readXlsxData(inputFile)
@@ -210,20 +235,14 @@ def sortColumns(df):
     return df
 
 
-def tempRemoveFields(df):
-    removeFields = ["basalSchedules",
-                    "bgTarget",
-                    "bgTargets",
-                    "carbRatio",
-                    "carbRatios",
-                    "insulinSensitivity",
-                    "insulinSensitivities"]
-
-    tempRemoveFields = list(set(df) & set(removeFields))
-    tempDf = df[tempRemoveFields]
-    df = df.drop(columns=tempRemoveFields)
-
-    return df, tempDf
+# the settings fields are exported as they are, without flattening
+doNotFlattenFields = ["basalSchedules",
+                      "bgTarget",
+                      "bgTargets",
+                      "carbRatio",
+                      "carbRatios",
+                      "insulinSensitivity",
+                      "insulinSensitivities"]
 
 
 def removeBrackets(df, fieldName):
@@ -234,40 +253,15 @@ def removeBrackets(df, fieldName):
     return df
 
 
-def flattenJson(df, dataFieldsForExport):
-
-    # remove fields that we don't want to flatten
-    df, holdData = tempRemoveFields(df)
+def flattenJson(df):
 
     # remove [] from annotations field
     df = removeBrackets(df, "annotations")
 
-    # get a list of data types of column headings
-    columnHeadings = list(df)  # ["payload", "suppressed"]
-
-    # loop through each columnHeading
-    newDataFrame = pd.DataFrame()
-
-    for colHead in columnHeadings:
-        # if the df field has embedded json
-        if any(isinstance(item, dict) for item in df[colHead]):
-            # grab the data that is in brackets
-            jsonBlob = df[colHead][df[colHead].astype(str).str[0] == "{"]
-
-            # replace those values with nan
-            df.loc[jsonBlob.index, colHead] = np.nan
-
-            # turn jsonBlob to dataframe
-            newDataFrame = pd.concat([newDataFrame, pd.DataFrame(jsonBlob.tolist(),
-                                        index=jsonBlob.index).add_prefix(colHead + '.')], axis=1)
-
-    newColHeadings = list(newDataFrame)
-
-    # put df back into the main dataframe
-    # and add the fields that were removed back in
-    columnFilter = list(set(newColHeadings) & set(dataFieldsForExport))
-    tempDataFrame = newDataFrame.filter(items=columnFilter)
-    df = pd.concat([df, tempDataFrame, holdData], axis=1)
+    # flatten the embedded json, the fields that are not exported are
+    # removed by filterByApprovedDataFields
+    df = td.clean.flatten_json(df, do_not_flatten=doNotFlattenFields,
+                               first_of_lists=[])
 
     return df
 
@@ -275,7 +269,7 @@ def flattenJson(df, dataFieldsForExport):
 def filterByApprovedDataFields(df, dataFieldsForExport):
 
     # flatten embedded json, if it exists
-    df = flattenJson(df, dataFieldsForExport)
+    df = flattenJson(df)
 
     dfExport = pd.DataFrame()
     colHeadings = list(df)
@@ -335,6 +329,22 @@ def tslimCalibrationFix(df):
 
 
 # %% ANONYMIZE DATA FUNCTIONS
+@functools.lru_cache(maxsize=None)
+def hashScheduleName(scheduleName, salt, userID):
+    hashedScheduleName = \
+        hashlib.sha256((scheduleName + salt + userID).encode()).hexdigest()[0:8]
+
+    return hashedScheduleName
+
+
+def hashScheduleKeys(schedule, salt, userID):
+    hashedSchedule = \
+        {hashScheduleName(scheduleName, salt, userID): scheduleValue
+         for scheduleName, scheduleValue in schedule.items()}
+
+    return hashedSchedule
+
+
 def hashScheduleNames(df, salt, userID):
 
     scheduleNames = ["basalSchedules",
@@ -346,38 +356,47 @@ def hashScheduleNames(df, salt, userID):
     for scheduleName in scheduleNames:
         # if scheduleName exists, find the rows that have the scheduleName
         if scheduleName in list(df):
-            scheduleNameDataFrame = df[df[scheduleName].notnull()].copy()
-            scheduleNameRows = scheduleNameDataFrame[scheduleName].index
-
-            # loop through each schedule name row
-            for scheduleNameRow in scheduleNameRows:
-                # this is for the csv version, which loads the data as string
-                if isinstance(scheduleNameDataFrame.loc[scheduleNameRow, scheduleName], str):
-                    scheduleNameDataFrame.loc[scheduleNameRow, [scheduleName]] = \
-                        [ast.literal_eval(scheduleNameDataFrame.loc[scheduleNameRow, scheduleName])]
-
-                scheduleNameKeys = \
-                    list(scheduleNameDataFrame[scheduleName]
-                    [scheduleNameRow].keys())
-                # loop through each key and replace with hashed version
-                for scheduleNameKey in scheduleNameKeys:
-                    hashedScheduleName = \
-                    hashlib.sha256((scheduleNameKey + args.salt + userID).
-                               encode()).hexdigest()[0:8]
-                    scheduleNameDataFrame[scheduleName][scheduleNameRow][hashedScheduleName] = \
-                        scheduleNameDataFrame[scheduleName][scheduleNameRow].pop(scheduleNameKey)
-
-            # drop and reattach the new data
-            df = df.drop(columns=scheduleName)
-            df = pd.merge(df, scheduleNameDataFrame.loc[:, ["id", scheduleName]], how="left", on="id")
+            scheduleRows = df[scheduleName].notnull().values
+            hashedSchedules = []
+            parsedSchedules = {}
+            for schedule in df.loc[scheduleRows, scheduleName]:
+                # this is for the csv version, which loads the data as
+                # string, so each distinct string is only parsed once
+                if isinstance(schedule, str):
+                    if schedule not in parsedSchedules:
+                        parsedSchedules[schedule] = hashScheduleKeys(
+                            ast.literal_eval(schedule), salt, userID)
+                    hashedSchedules.append(parsedSchedules[schedule])
+                else:
+                    hashedSchedules.append(
+                        hashScheduleKeys(schedule, salt, userID))
+
+            # replace the schedules of the settings rows with the new data
+            scheduleValues = df[scheduleName].values.astype(object)
+            scheduleValues[scheduleRows] = hashedSchedules
+            df[scheduleName] = scheduleValues
+
     return df
 
 
+def hashValues(values, lengthOfHash, salt, userID):
+    # fields like uploadId and deviceId have only a handful of distinct
+    # values, so only hash the unique values (sha256(value + salt + userID))
+    # and broadcast the hashes back to all of the rows through the codes
+    codes, uniqueValues = pd.factorize(pd.Series(values).astype(str))
+    saltAndUserID = (salt + userID).encode()
+    uniqueHashes = np.array(
+        [hashlib.sha256(value.encode() + saltAndUserID).
+         hexdigest()[0:lengthOfHash] for value in uniqueValues],
+        dtype=object)
+
+    return uniqueHashes[codes]
+
+
 def hashData(df, columnHeading, lengthOfHash, salt, userID):
 
     df[columnHeading] = \
-        (df[columnHeading].astype(str) + salt + userID).apply(
-        lambda s: hashlib.sha256(s.encode()).hexdigest()[0:lengthOfHash])
+        hashValues(df[columnHeading], lengthOfHash, salt, userID)
 
     return df
 
@@ -439,46 +458,37 @@ def removeManufacturersFromAnnotationsCode(df):
     return df
 
 
-def mergeWizardWithBolus(df, exportDirectory):
-
-    if (("bolus" in set(df.type)) and ("wizard" in set(df.type))):
-        bolusData = pd.read_csv(exportDirectory + "bolus.csv",
-                                low_memory=False)
-        wizardData = pd.read_csv(exportDirectory + "wizard.csv",
-                                 low_memory=False)
-
-
-
-        # merge the wizard data with the bolus data
-        wizardData["calculatorId"] = wizardData["id"]
-        wizardDataFields = [
-            "bgInput",
-            "bgTarget.high",
-            "bgTarget.low",
-            "bgTarget.range",
-            "bgTarget.target",
-            "bolus",
-            "carbInput",
-            "calculatorId",
-            "insulinCarbRatio",
-            "insulinOnBoard",
-            "insulinSensitivity",
-            "recommended.carb",
-            "recommended.correction",
-            "recommended.net",
-            "units",
-        ]
-        keepTheseWizardFields = \
-            set(wizardDataFields).intersection(list(wizardData))
-        bolusData = pd.merge(bolusData,
-                             wizardData[list(keepTheseWizardFields)],
-                             how="left",
-                             left_on="id",
-                             right_on="bolus")
-
-        mergedBolusData = bolusData.drop("bolus", axis=1)
-    else:
-        mergedBolusData = pd.DataFrame()
+def mergeWizardWithBolus(bolusData, wizardData):
+
+    # merge the wizard data with the bolus data
+    wizardData = wizardData.copy()
+    wizardData["calculatorId"] = wizardData["id"]
+    wizardDataFields = [
+        "bgInput",
+        "bgTarget.high",
+        "bgTarget.low",
+        "bgTarget.range",
+        "bgTarget.target",
+        "bolus",
+        "carbInput",
+        "calculatorId",
+        "insulinCarbRatio",
+        "insulinOnBoard",
+        "insulinSensitivity",
+        "recommended.carb",
+        "recommended.correction",
+        "recommended.net",
+        "units",
+    ]
+    keepTheseWizardFields = \
+        set(wizardDataFields).intersection(list(wizardData))
+    bolusData = pd.merge(bolusData,
+                         wizardData[list(keepTheseWizardFields)],
+                         how="left",
+                         left_on="id",
+                         right_on="bolus")
+
+    mergedBolusData = bolusData.drop("bolus", axis=1)
 
     return mergedBolusData
 
@@ -492,12 +502,10 @@ def cleanDiretory(exportFolder, fileName):
     if os.path.exists(hiddenCsvExportFolder):
         shutil.rmtree(hiddenCsvExportFolder)
 
-    os.makedirs(hiddenCsvExportFolder)
-
     unhiddenCsvExportFolder = os.path.join(exportFolder,
                                            fileName + "-csvs", "")
 
-    for fType in ["xlsx", "json", "csv"]:
+    for fType in ["xlsx", "json", "ndjson", "csv"]:
         fName = os.path.join(exportFolder, fileName + "." + fType)
         if os.path.exists(fName):
             os.remove(fName)
@@ -509,8 +517,49 @@ def cleanDiretory(exportFolder, fileName):
     return hiddenCsvExportFolder
 
 
+def convertNumericStrings(df):
+    # the csv version loads the fields that have mixed types (e.g., the
+    # insulinSensitivity of the wizard and pumpSettings data) as strings, so
+    # convert the fields of each type that only have numbers back to numbers
+    for col in df.columns[df.dtypes == object]:
+        values = df[col].dropna()
+        if values.map(type).eq(str).all():
+            numericValues = pd.to_numeric(values, errors="coerce")
+            if (np.isfinite(numericValues).all() &
+                    numericValues.astype(str).equals(values)):
+                df[col] = pd.to_numeric(df[col])
+
+    return df
+
+
+def getExportTables(df, mergeCalculatorData):
+    # group the data by type once, and merge the wizard (AKA calculator)
+    # data with the bolus data in memory
+    groupedData = df.groupby(by="type")
+    exportTables = {}
+    for dataType in sorted(set(df[df.type.notnull()].type)):
+        exportTables[dataType] = convertNumericStrings(
+            filterAndSort(groupedData, dataType, "time"))
+
+    # merge wizard data with bolus data, and delete wizard data
+    if mergeCalculatorData:
+        if (("bolus" in exportTables) and ("wizard" in exportTables)):
+            exportTables["bolus"] = \
+                mergeWizardWithBolus(exportTables["bolus"],
+                                     exportTables["wizard"])
+        exportTables.pop("wizard", None)
+
+    for dataType in exportTables.keys():
+        exportTables[dataType] = sortColumns(exportTables[dataType])
+
+    return exportTables
+
+
 def exportCsvFiles(df, exportFolder, fileName, mergeCalculatorData):
+    # low memory version, which saves the data of each type to a hidden
+    # folder of csv files that are read back by each of the exports
     hiddenCsvExportFolder = cleanDiretory(exportFolder, fileName)
+    os.makedirs(hiddenCsvExportFolder)
     groupedData = df.groupby(by="type")
 
     for dataType in set(df[df.type.notnull()].type):
@@ -520,8 +569,12 @@ def exportCsvFiles(df, exportFolder, fileName, mergeCalculatorData):
 
     # merge wizard data with bolus data, and delete wizard data
     if mergeCalculatorData:
-        bolusWithWizardData = mergeWizardWithBolus(df, hiddenCsvExportFolder)
-        if len(bolusWithWizardData) > 0:
+        if (("bolus" in set(df.type)) and ("wizard" in set(df.type))):
+            bolusData = pd.read_csv(hiddenCsvExportFolder + "bolus.csv",
+                                    low_memory=False)
+            wizardData = pd.read_csv(hiddenCsvExportFolder + "wizard.csv",
+                                     low_memory=False)
+            bolusWithWizardData = mergeWizardWithBolus(bolusData, wizardData)
             bolusWithWizardData = sortColumns(bolusWithWizardData)
             bolusWithWizardData.to_csv(hiddenCsvExportFolder + "bolus.csv",
                                        index=False)
@@ -531,15 +584,20 @@ def exportCsvFiles(df, exportFolder, fileName, mergeCalculatorData):
     return hiddenCsvExportFolder
 
 
-def exportSingleCsv(exportFolder, fileName, exportDirectory, fileType):
-    # first load in all csv files
-    csvFiles = glob.glob(exportDirectory + "*.csv")
-    bigTable = pd.DataFrame()
-    for csvFile in csvFiles:
-        bigTable = pd.concat([bigTable, pd.read_csv(csvFile, low_memory=False)], sort=False)
+def readCsvFiles(exportDirectory):
+    # read the csv file of each type back, one at a time
+    for csvFile in sorted(os.listdir(exportDirectory)):
+        yield csvFile[:-4], pd.read_csv(os.path.join(exportDirectory, csvFile),
+                                        low_memory=False)
+
+
+def exportSingleCsv(exportTables, exportFolder, fileName, fileType):
+    # combine the data of all of the types
+    bigTable = pd.concat([typeData for dataType, typeData in exportTables],
+                         sort=False)
 
     # first sort by time and then put columns in alphabetical order
-    bigTable = bigTable.sort_values("time")
+    bigTable = bigTable.sort_values("time", kind="mergesort")
     bigTable = sortColumns(bigTable)
     if (("csv" in fileType) | ("all" in fileType)):
         bigTable.to_csv(os.path.join(exportFolder, fileName + ".csv"), index=False)
@@ -547,48 +605,98 @@ def exportSingleCsv(exportFolder, fileName, exportDirectory, fileType):
     return bigTable
 
 
-def formatKeyValue(key, val):
+def formatJsonValue(val):
     if str(val) in ["True", "False"]:
-        output = '\n  "{0}":{1}'.format(key, str(val).lower())
-    elif isinstance(val, str):
-        output = '\n  "{0}":"{1}"'.format(key, val)
+        output = str(val).lower()
+    elif isinstance(val, (str, dict, list)):
+        output = '"{0}"'.format(val)
     else:
-        output = '\n  "{0}":{1}'.format(key, val)
+        output = '{0}'.format(val)
 
     return output
 
 
-def formatRow(oneRow):
-    keyValList = [formatKeyValue(k, v) for k, v in oneRow.items()]
-    keyValString = ",".join(keyValList)
-    rowString = '\n {' + keyValString + '\n }'
+def formatJsonValues(values, ndjson=False):
+    # the booleans and numbers of a field are formatted all at once, and the
+    # other values one at a time
+    if values.dtype == bool:
+        jsonValues = np.where(values, "true", "false").astype(object)
+    elif values.dtype.kind in "iuf":
+        jsonValues = values.astype(str).values.astype(object)
+    elif ndjson:
+        jsonValues = np.array([json.dumps(val, default=str) for val in values],
+                              dtype=object)
+    else:
+        jsonValues = np.array([formatJsonValue(val) for val in values],
+                              dtype=object)
 
-    return rowString
+    return jsonValues
 
 
-def rowToDict(rowData):
-    rowDict = formatRow(rowData[rowData.notnull()].to_dict())
-    return rowDict
+def exportJson(df, exportFolder, fileName, ndjson=False, chunkSize=10000):
+    # write the (pretty or newline delimited) json one chunk of rows at a
+    # time, and leave out the null values of each row
+    if ndjson:
+        jsonExportFileName = os.path.join(exportFolder, fileName + ".ndjson")
+        fileStart, rowStart, rowEnd, rowSeparator = "", "{", "}", "\n"
+        fileEnd = "\n" if len(df) > 0 else ""
+    else:
+        jsonExportFileName = os.path.join(exportFolder, fileName + ".json")
+        fileStart, rowStart, rowEnd, rowSeparator = "[", "\n {", "\n }", ","
+        fileEnd = "\n]"
+
+    with open(jsonExportFileName, "w") as outfile:
+        outfile.write(fileStart)
+        for chunkStart in range(0, len(df), chunkSize):
+            chunk = df.iloc[chunkStart:(chunkStart + chunkSize)]
+            rowStrings = np.full(len(chunk), "", dtype=object)
+            for col in chunk.columns:
+                notNull = chunk[col].notnull().values
+                if notNull.any():
+                    if ndjson:
+                        keyString = ',{0}:'.format(json.dumps(col))
+                    else:
+                        keyString = ',\n  "{0}":'.format(col)
+                    keyValueStrings = np.full(len(chunk), "", dtype=object)
+                    keyValueStrings[notNull] = keyString + \
+                        formatJsonValues(chunk[col][notNull], ndjson)
+                    rowStrings = rowStrings + keyValueStrings
+
+            # the first comma of each row is not needed
+            if chunkStart > 0:
+                outfile.write(rowSeparator)
+            outfile.write(rowSeparator.join(
+                [rowStart + rowString[1:] + rowEnd
+                 for rowString in rowStrings]))
+        outfile.write(fileEnd)
 
+    return
 
-def exportPrettyJson(df, exportFolder, fileName):
-    jsonExportFileName = os.path.join(exportFolder, fileName + ".json")
-    outfile = open(jsonExportFileName, 'w')
-    rowList = df.apply(rowToDict, axis=1)
-    allRows = ",".join(rowList)
-    jsonString = '[' + allRows + '\n]'
-    outfile.write(jsonString)
-    outfile.close()
 
-    return
+def getColumnWidths(df, sampleSize=10000):
+    # each column is as wide as its longest value (or heading), which is
+    # estimated from a sample of the rows of the big tables
+    if len(df) > sampleSize:
+        df = df.sample(sampleSize, random_state=0)
 
+    colWidths = []
+    for col in df.columns:
+        colWidth = df[col].astype(str).str.len().max() if len(df) > 0 else 0
+        colWidths.append(max(len(col), int(colWidth)))
 
-def exportExcelFile(exportDirectory, exportFolder, fileName):
-    mylen = np.vectorize(len)
-    writer = pd.ExcelWriter(os.path.join(exportFolder, fileName + ".xlsx"),
-                            engine='xlsxwriter')
+    return colWidths
+
+
+def exportExcelFile(exportTables, exportFolder, fileName,
+                    maxRows=excelMaxRows, chunkSize=10000):
+    # the rows are streamed to the workbook in constant memory mode, so they
+    # have to be written in order, one row at a time
+    workbook = xlsxwriter.Workbook(
+        os.path.join(exportFolder, fileName + ".xlsx"),
+        {"constant_memory": True,
+         "default_date_format": "yyyy-mm-dd hh:mm:ss",
+         "nan_inf_to_errors": True})
 
-    workbook = writer.book
     header_format = workbook.add_format({'bold': True,
                                          'valign': 'center',
                                          'border': False,
@@ -596,33 +704,57 @@ def exportExcelFile(exportDirectory, exportFolder, fileName):
 
     cell_format = workbook.add_format({'align': 'center'})
 
-    csvFiles = sorted(os.listdir(exportDirectory))
-    for csvFile in csvFiles:
-        dataName = csvFile[:-4]
+    for dataName, tempCsvData in exportTables:
+        tempCsvData = tempCsvData.copy()
 
-        tempCsvData = pd.read_csv(
-                os.path.join(exportDirectory, dataName + ".csv"),
-                low_memory=False)
-
-        # put the date time columns in an excel interpretable format
+        # put the date time columns in an excel interpretable format. Excel
+        # does not support timezones, so the times with a timezone offset
+        # are saved in utc, and the local (device) times are saved as they are
         for col_heading in list(tempCsvData):
             if "time" in col_heading.lower()[-4:]:
                 tempCsvData[col_heading] = \
-                    pd.to_datetime(tempCsvData[col_heading])
-
-        tempCsvData.to_excel(writer, dataName, startrow=1, header=False,
-                             index=False, freeze_panes=(1, 0))
-
-        worksheet = writer.sheets[dataName]
-        workbook.add_format({'align': 'center'})
-
-        # Write the column headers with the defined format
-        for col_num, value in enumerate(tempCsvData.columns.values):
-            worksheet.write(0, col_num, value, header_format)
-            colWidth = max(len(value), max(mylen(tempCsvData.iloc[:, col_num].astype(str))))
-            worksheet.set_column(col_num, col_num, colWidth, cell_format)
-
-    writer.save()
+                    pd.to_datetime(tempCsvData[col_heading], utc=True). \
+                    dt.tz_localize(None)
+
+        # the settings (dicts) and lists are saved as strings
+        for col_heading in tempCsvData.columns[tempCsvData.dtypes == object]:
+            isDictOrList = \
+                tempCsvData[col_heading].map(type).isin([dict, list])
+            if isDictOrList.any():
+                tempCsvData.loc[isDictOrList, col_heading] = \
+                    tempCsvData.loc[isDictOrList, col_heading].astype(str)
+
+        colWidths = getColumnWidths(tempCsvData)
+
+        # split the data over more than one sheet if it is longer than the
+        # row limit of excel (e.g., cbg-1, cbg-2, ...)
+        rowsPerSheet = maxRows - 1
+        nSheets = max(1, int(np.ceil(len(tempCsvData) / rowsPerSheet)))
+        for sheetNumber in range(nSheets):
+            if nSheets > 1:
+                sheetName = "{0}-{1}".format(dataName, sheetNumber + 1)
+            else:
+                sheetName = dataName
+            worksheet = workbook.add_worksheet(sheetName)
+            worksheet.freeze_panes(1, 0)
+
+            # Write the column headers with the defined format
+            for col_num, colWidth in enumerate(colWidths):
+                worksheet.set_column(col_num, col_num, colWidth, cell_format)
+            worksheet.write_row(0, 0, tempCsvData.columns.values,
+                                header_format)
+
+            sheetData = tempCsvData.iloc[(sheetNumber * rowsPerSheet):
+                                         ((sheetNumber + 1) * rowsPerSheet)]
+            for chunkStart in range(0, len(sheetData), chunkSize):
+                chunk = sheetData.iloc[chunkStart:(chunkStart + chunkSize)]
+                chunkValues = chunk.values.astype(object)
+                chunkValues[chunk.isnull().values] = None
+                for rowNum, rowValues in enumerate(chunkValues.tolist(),
+                                                   chunkStart + 1):
+                    worksheet.write_row(rowNum, 0, rowValues)
+
+    workbook.close()
 
     return
 
@@ -636,7 +768,8 @@ def readXlsxData(xlsxPathAndFileName):
     return cdf
 
 
-def exportData(df, fileName, fileType, exportDirectory, mergeCalculatorData):
+def exportData(df, fileName, fileType, exportDirectory, mergeCalculatorData,
+               lowMemory=False):
     # create output folder(s)
     if not os.path.exists(exportDirectory):
         os.makedirs(exportDirectory)
@@ -644,25 +777,50 @@ def exportData(df, fileName, fileType, exportDirectory, mergeCalculatorData):
     # sort data by time
     df = df.sort_values("time")
 
-    # all of the exports are based off of csvs table, which are needed to
-    # merge the bolus and wizard (AKA calculator) data
-    csvExportFolder = exportCsvFiles(df, exportDirectory, fileName, mergeCalculatorData)
+    # all of the exports are made from the data of each type, where the
+    # bolus and wizard (AKA calculator) data are merged. In low memory mode,
+    # the data of each type is saved to csvs, which are read back as needed
+    if lowMemory:
+        csvExportFolder = \
+            exportCsvFiles(df, exportDirectory, fileName, mergeCalculatorData)
+        del df
+
+        def getTables():
+            return readCsvFiles(csvExportFolder)
+    else:
+        cleanDiretory(exportDirectory, fileName)
+        exportTables = getExportTables(df, mergeCalculatorData)
+        del df
+
+        def getTables():
+            return exportTables.items()
 
-    if (("csv" in fileType) | ("json" in fileType) | ("all" in fileType)):
-        allData = exportSingleCsv(exportDirectory, fileName, csvExportFolder, fileType)
+    if (("csv" in fileType) | ("json" in fileType) |
+            ("ndjson" in fileType) | ("all" in fileType)):
+        allData = exportSingleCsv(getTables(), exportDirectory,
+                                  fileName, fileType)
 
     if (("json" in fileType) | ("all" in fileType)):
-        exportPrettyJson(allData, exportDirectory, fileName)
+        exportJson(allData, exportDirectory, fileName)
+
+    if ("ndjson" in fileType):
+        exportJson(allData, exportDirectory, fileName, ndjson=True)
 
     if (("xlsx" in fileType) | ("all" in fileType)):
-        exportExcelFile(csvExportFolder, exportDirectory, fileName)
+        exportExcelFile(getTables(), exportDirectory, fileName)
 
+    unhiddenCsvExportFolder = \
+        os.path.join(exportDirectory, fileName + "-csvs", "")
     if (("csvs" in fileType) | ("all" in fileType)):
-        # unhide the csv files
-        unhiddenCsvExportFolder = \
-            os.path.join(exportDirectory, fileName + "-csvs", "")
-        os.rename(csvExportFolder, unhiddenCsvExportFolder)
-    else:
+        if lowMemory:
+            # unhide the csv files
+            os.rename(csvExportFolder, unhiddenCsvExportFolder)
+        else:
+            os.makedirs(unhiddenCsvExportFolder)
+            for dataType, typeData in getTables():
+                typeData.to_csv(unhiddenCsvExportFolder + dataType + ".csv",
+                                index=False)
+    elif lowMemory:
         shutil.rmtree(csvExportFolder)
 
     return
@@ -735,5 +893,6 @@ else:
     outputName = "PHI-" + userID
 
 exportData(data, outputName, args.exportFormat,
-           args.exportPath, "t" in args.mergeWizardDataWithBolusData.lower())
+           args.exportPath, "t" in args.mergeWizardDataWithBolusData.lower(),
+           "t" in args.lowMemory.lower())
 print("done, took", round(time.time() - startTime, 1), "seconds")
@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: columnar (parquet) storage of donor datasets
+dependencies:
+    * pyarrow
+license: BSD-2-Clause
+
+Each donor's dataset is stored as a hive-partitioned parquet dataset:
+
+    PHI-<date>-parquetData/userid=<userid>/type=<type>/part-<n>.parquet
+
+Nested json fields are flattened into "<field>.<subfield>" columns, lists
+are stored as json strings, and each type partition only keeps the columns
+that have data for that type. A stage that only needs a few data types or a
+few columns can therefore read only those files and column chunks.
+
+The saved data is what prepare_for_parquet makes of the api records, which
+differs from the PHI-<userid>.csv files (and from the records) in that:
+    * all embedded json is flattened, at every depth, including the payload,
+      suppressed and recommended fields that the csv stages keep as
+      embedded json, e.g. a "payload.systemTime" column instead of a payload
+      column
+    * lists (e.g. annotations) are json strings, where the csv files have
+      their python repr
+    * the rows are grouped by type, in the order they were saved within
+      each type, and the columns are in no particular order
+    * a type only has the columns that have data for it
+parse_embedded_json(csv data), passed through prepare_for_parquet, gives
+the same data as the parquet dataset.
+
+A donor can be refreshed incrementally: merge_donor_dataset appends new
+records (deduplicated on id) as new part files, and the donor's watermark
+(userid=<userid>/_watermark.json) records the latest time, modifiedTime and
+the uploadIds that have been saved.
+"""
+
+# %% load in required libraries
+import os
+import sys
+import ast
+import json
+import glob
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# %% define functions
+def get_parquet_dataset_path(data_path, date_stamp):
+    ''' path of the parquet dataset that holds all donors of a date stamp '''
+    phi_date_stamp = "PHI-" + date_stamp
+    donor_folder = os.path.join(data_path, phi_date_stamp + "-donor-data")
+
+    return os.path.join(donor_folder, phi_date_stamp + "-parquetData")
+
+
+def get_donor_path(dataset_path, userid):
+    return os.path.join(dataset_path, "userid=" + userid)
+
+
+def donor_exists(dataset_path, userid):
+    return os.path.isdir(get_donor_path(dataset_path, userid))
+
+
+def get_donor_size(dataset_path, userid):
+    ''' total number of bytes stored for a donor '''
+    donor_files = glob.glob(
+        os.path.join(get_donor_path(dataset_path, userid), "*", "*.parquet")
+    )
+
+    return sum(os.path.getsize(f) for f in donor_files)
+
+
+def flatten_nested_fields(df, sep="."):
+    '''
+    flatten columns that contain dictionaries (embedded json) into
+    "<field>.<subfield>" columns, recursively
+    '''
+    newColumns = []
+    for colHead in list(df):
+        if df[colHead].dtype != object:
+            continue
+
+        isDict = df[colHead].apply(lambda x: isinstance(x, dict))
+        if isDict.any():
+            jsonBlob = df.loc[isDict, colHead]
+            nested = pd.DataFrame(
+                jsonBlob.tolist(), index=jsonBlob.index
+            ).add_prefix(colHead + sep)
+            nested = flatten_nested_fields(nested, sep=sep)
+
+            # keep the values of the field that are not embedded json
+            if isDict.all():
+                df = df.drop(columns=colHead)
+            else:
+                df.loc[isDict, colHead] = np.nan
+
+            newColumns.append(nested)
+
+    if len(newColumns) > 0:
+        df = pd.concat([df] + newColumns, axis=1, sort=False)
+
+    return df
+
+
+def _to_json_string(x):
+    if isinstance(x, (list, dict)):
+        return json.dumps(x)
+    if pd.isnull(x):
+        return None
+    return str(x)
+
+
+def make_columns_parquet_safe(df):
+    '''
+    parquet needs a single type per column, so columns with lists or with a
+    mix of types are stored as strings
+    '''
+    for colHead in list(df):
+        if df[colHead].dtype != object:
+            continue
+
+        inferredType = pd.api.types.infer_dtype(df[colHead], skipna=True)
+        if inferredType in ["string", "boolean", "empty"]:
+            continue
+        elif inferredType in ["floating", "integer", "mixed-integer-float"]:
+            df[colHead] = pd.to_numeric(df[colHead])
+        else:
+            df[colHead] = df[colHead].apply(_to_json_string)
+
+    return df
+
+
+def prepare_for_parquet(df):
+    '''
+    flatten the embedded json and make the columns parquet safe, so the
+    data can be split into type partitions
+    '''
+    df = df.reset_index(drop=True)
+    if "type" not in list(df):
+        df["type"] = "unknown"
+    df["type"] = df["type"].fillna("unknown").astype(str)
+
+    df = flatten_nested_fields(df)
+    df = make_columns_parquet_safe(df)
+
+    # columns without any data have no parquet type
+    df = df.dropna(axis=1, how="all")
+
+    return df
+
+
+def write_type_partitions(df, donor_path, part=0):
+    '''
+    write a (prepared) batch of donor data, one part file per data type
+    '''
+    for dataType, typeData in df.groupby("type", sort=False):
+        typeData = typeData.drop(columns="type").dropna(axis=1, how="all")
+        type_path = os.path.join(donor_path, "type=" + dataType)
+        if not os.path.exists(type_path):
+            os.makedirs(type_path)
+        pq.write_table(
+            pa.Table.from_pandas(typeData, preserve_index=False),
+            os.path.join(type_path, "part-%d.parquet" % part)
+        )
+
+    return
+
+
+def save_donor_dataset(df, dataset_path, userid):
+    '''
+    save (overwrite) a single donor's data to the parquet dataset, one file
+    per data type
+    INPUTS:
+        * df is the donor data, as returned by the tidepool api
+        * dataset_path is the root of the parquet dataset
+        * userid of the donor
+    OUTPUTS:
+        * the path of the donor partition
+    '''
+    writer = DonorParquetWriter(dataset_path, userid)
+    writer.write(df)
+
+    return writer.close()
+
+
+class DonorParquetWriter:
+    '''
+    writes a donor to the parquet dataset in batches, each batch becomes a
+    new part file of each of its type partitions. The donor is written to a
+    temporary folder that replaces the saved donor on close, so a failed
+    download does not leave a partially written donor behind.
+    '''
+    def __init__(self, dataset_path, userid):
+        self.donor_path = get_donor_path(dataset_path, userid)
+        self.temp_path = self.donor_path + ".tmp"
+        if os.path.exists(self.temp_path):
+            shutil.rmtree(self.temp_path)
+        os.makedirs(self.temp_path)
+        self.part = 0
+        self.nRecords = 0
+
+    def write_records(self, records):
+        ''' write a list of records (dictionaries) '''
+        self.write(pd.DataFrame(records))
+
+    def write(self, df):
+        ''' write a dataframe '''
+        if len(df) > 0:
+            write_type_partitions(prepare_for_parquet(df), self.temp_path,
+                                  part=self.part)
+            self.part = self.part + 1
+            self.nRecords = self.nRecords + len(df)
+
+    def close(self):
+        if os.path.exists(self.donor_path):
+            shutil.rmtree(self.donor_path)
+        os.rename(self.temp_path, self.donor_path)
+
+        return self.donor_path
+
+    def abort(self):
+        ''' remove the partially written donor, and keep the saved donor '''
+        if os.path.exists(self.temp_path):
+            shutil.rmtree(self.temp_path)
+
+
+class DonorNdjsonWriter:
+    '''
+    writes records as newline delimited json, in batches
+    '''
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_path = file_path + ".tmp"
+        self.file = open(self.temp_path, "w")
+        self.nRecords = 0
+
+    def write_records(self, records):
+        self.file.write("".join(json.dumps(r) + "\n" for r in records))
+        self.nRecords = self.nRecords + len(records)
+
+    def write(self, df):
+        self.write_records(
+            [{k: v for k, v in r.items() if not _is_null(v)}
+             for r in df.to_dict("records")]
+        )
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_path, self.file_path)
+
+        return self.file_path
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class DonorCsvWriter:
+    '''
+    collects batches of records and saves them as a single csv file on
+    close. csv files need all of the columns up front, so unlike the other
+    writers this holds the donor's data in memory.
+    '''
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_path = file_path + ".tmp"
+        self.batches = []
+        self.nRecords = 0
+
+    def write_records(self, records):
+        self.write(pd.DataFrame(records))
+
+    def write(self, df):
+        self.batches.append(df)
+        self.nRecords = self.nRecords + len(df)
+
+    def close(self):
+        df = pd.concat(
+            [pd.DataFrame()] + self.batches, ignore_index=True, sort=False
+        )
+        df.to_csv(self.temp_path)
+        os.replace(self.temp_path, self.file_path)
+        self.batches = []
+
+        return self.file_path
+
+    def abort(self):
+        self.batches = []
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def _is_null(x):
+    return (not isinstance(x, (list, dict))) and pd.isnull(x)
+
+
+def load_donor_dataset(
+    dataset_path,
+    userid,
+    types=None,
+    columns=None,
+    filters=None
+):
+    '''
+    load a single donor's data from the parquet dataset
+    INPUTS:
+        * dataset_path is the root of the parquet dataset
+        * userid of the donor
+        * types (optional) is a list of data types to load, only the files of
+          those types are read
+        * columns (optional) is a list of columns to load, only those column
+          chunks are read
+        * filters (optional) is a list of (column, op, value) filters, e.g.
+          [("value", ">", 2.1)], that are pushed down to the parquet reader.
+          Files that do not have a filtered column are skipped.
+    OUTPUTS:
+        * dataframe with a "type" column, the rows of each type are in the
+          order they were saved. Embedded json is flattened and lists are
+          json strings (see the top of this module).
+    '''
+    donor_path = get_donor_path(dataset_path, userid)
+    type_paths = sorted(glob.glob(os.path.join(donor_path, "type=*")))
+    if types is not None:
+        type_paths = [
+            p for p in type_paths
+            if os.path.basename(p)[len("type="):] in types
+        ]
+
+    all_data = []
+    for type_path in type_paths:
+        for type_file in get_type_parts(type_path):
+            saved_columns = pq.read_schema(type_file).names
+
+            # a filter on a column that a part does not have excludes it
+            if filters is not None:
+                if not all(f[0] in saved_columns for f in filters):
+                    continue
+
+            type_columns = saved_columns
+            if columns is not None:
+                type_columns = [c for c in columns if c in saved_columns]
+
+            typeData = pq.read_table(
+                type_file,
+                columns=type_columns,
+                filters=filters
+            ).to_pandas()
+
+            if (columns is None) or ("type" in columns):
+                typeData["type"] = os.path.basename(type_path)[len("type="):]
+            all_data.append(typeData)
+
+    if len(all_data) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(all_data, ignore_index=True, sort=False)
+
+    if columns is not None:
+        df = df[[c for c in columns if c in list(df)]]
+
+    return df
+
+
+def get_type_parts(type_path):
+    ''' the part files of a type partition, in the order they were saved '''
+    return sorted(
+        glob.glob(os.path.join(type_path, "part-*.parquet")),
+        key=get_part_number
+    )
+
+
+def get_part_number(part_file):
+    return int(os.path.basename(part_file)[len("part-"):-len(".parquet")])
+
+
+def rewrite_type_partition(df, type_path):
+    '''
+    replace all of the parts of a type partition with a single part that
+    holds df (an empty df removes the partition)
+    '''
+    temp_path = os.path.join(
+        os.path.dirname(type_path), "_" + os.path.basename(type_path) + ".tmp"
+    )
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+
+    if len(df) > 0:
+        df = df.drop(columns="type", errors="ignore").dropna(axis=1, how="all")
+        pq.write_table(
+            pa.Table.from_pandas(df, preserve_index=False),
+            os.path.join(temp_path, "part-0.parquet")
+        )
+
+    shutil.rmtree(type_path)
+    if len(df) > 0:
+        os.rename(temp_path, type_path)
+    else:
+        shutil.rmtree(temp_path)
+
+    return
+
+
+def merge_donor_dataset(df, dataset_path, userid, modified_since=None):
+    '''
+    merge new records into a saved donor, deduplicating on id. The new
+    records are appended as new part files. Only the type partitions that
+    already have one of the new ids are rewritten (the new version of the
+    record replaces the saved one), so the cost of a merge follows the
+    amount of new data rather than the donor's whole history.
+    INPUTS:
+        * modified_since (optional) is the latest modifiedTime of the saved
+          donor (see update_watermark). If given, records that are already
+          saved are only replaced if they were modified after it, and are
+          otherwise skipped.
+    OUTPUTS:
+        * the number of records that were added, and the number of saved
+          records that were replaced
+    '''
+    # the download windows overlap, so the new records can repeat an id
+    if "id" in list(df):
+        df = df.drop_duplicates(subset="id", keep="first")
+
+    if not donor_exists(dataset_path, userid):
+        save_donor_dataset(df, dataset_path, userid)
+        return len(df), 0
+
+    if len(df) == 0:
+        return 0, 0
+
+    df = prepare_for_parquet(df)
+    donor_path = get_donor_path(dataset_path, userid)
+
+    nAdded = 0
+    nReplaced = 0
+    for dataType, typeData in df.groupby("type", sort=False):
+        type_path = os.path.join(donor_path, "type=" + dataType)
+        type_parts = get_type_parts(type_path)
+
+        if len(type_parts) > 0:
+            saved_ids = pd.concat([
+                pq.read_table(f, columns=["id"]).column("id").to_pandas()
+                for f in type_parts
+            ])
+            isSaved = typeData["id"].isin(saved_ids)
+
+            if (modified_since is not None) and isSaved.any():
+                isModified = pd.Series(False, index=typeData.index)
+                if "modifiedTime" in list(typeData):
+                    isModified = (
+                        pd.to_datetime(typeData["modifiedTime"], utc=True)
+                        > pd.to_datetime(modified_since, utc=True)
+                    )
+                typeData = typeData[~isSaved | isModified]
+                isSaved = isSaved[~isSaved | isModified]
+
+            if isSaved.any():
+                replacedIds = typeData.loc[isSaved, "id"]
+                nReplaced = nReplaced + len(replacedIds)
+                savedData = load_donor_dataset(
+                    dataset_path, userid, types=[dataType]
+                )
+                rewrite_type_partition(
+                    savedData[~savedData["id"].isin(replacedIds)],
+                    type_path
+                )
+                type_parts = get_type_parts(type_path)
+
+            nAdded = nAdded + int((~isSaved).sum())
+
+        else:
+            nAdded = nAdded + len(typeData)
+
+        if len(typeData) == 0:
+            continue
+
+        if len(type_parts) > 0:
+            part = get_part_number(type_parts[-1]) + 1
+        else:
+            part = 0
+        write_type_partitions(typeData, donor_path, part=part)
+
+    return nAdded, nReplaced
+
+
+def get_watermark_path(dataset_path, userid):
+    return os.path.join(get_donor_path(dataset_path, userid), "_watermark.json")
+
+
+def get_watermark(dataset_path, userid):
+    '''
+    the watermark of a saved donor (see update_watermark), None if the donor
+    was not saved with one
+    '''
+    watermark_path = get_watermark_path(dataset_path, userid)
+    if not os.path.exists(watermark_path):
+        return None
+
+    with open(watermark_path) as f:
+        return json.load(f)
+
+
+def update_watermark(dataset_path, userid, df=None, fetched_on=None):
+    '''
+    update the watermark of a donor with newly saved records. The watermark
+    keeps the latest time and modifiedTime, and the uploadIds, that have
+    been saved, so the next download only needs to ask for what is missing.
+    INPUTS:
+        * df (optional) is the newly saved data, if not given the watermark
+          is computed from the time, modifiedTime and uploadId columns of
+          the whole saved donor
+        * fetched_on (optional) is when the data was downloaded
+    '''
+    watermark = get_watermark(dataset_path, userid)
+    if (watermark is None) or (df is None):
+        watermark = {"maxTime": None, "maxModifiedTime": None, "uploadIds": []}
+
+    if df is None:
+        df = load_donor_dataset(
+            dataset_path, userid, columns=["time", "modifiedTime", "uploadId"]
+        )
+
+    for field, key in [("time", "maxTime"), ("modifiedTime", "maxModifiedTime")]:
+        if (field in list(df)) and df[field].notnull().any():
+            maxValue = pd.to_datetime(df[field], utc=True).max()
+            if watermark[key] is not None:
+                maxValue = max(maxValue, pd.to_datetime(watermark[key], utc=True))
+            watermark[key] = maxValue.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    if "uploadId" in list(df):
+        watermark["uploadIds"] = sorted(
+            set(watermark["uploadIds"]) | set(df["uploadId"].dropna())
+        )
+
+    if fetched_on is None:
+        fetched_on = pd.Timestamp.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    watermark["fetchedOn"] = fetched_on
+
+    # write the watermark atomically, next to the donor's data
+    watermark_path = get_watermark_path(dataset_path, userid)
+    with open(watermark_path + ".tmp", "w") as f:
+        json.dump(watermark, f)
+    os.replace(watermark_path + ".tmp", watermark_path)
+
+    return watermark
+
+
+def parse_embedded_json(df):
+    '''
+    csv files store the embedded json of the tidepool api as strings, this
+    turns those strings back into dictionaries and lists
+    '''
+    def _literal_eval(x):
+        if isinstance(x, str) and (x[:1] in ["{", "["]):
+            try:
+                return ast.literal_eval(x)
+            except (ValueError, SyntaxError):
+                return x
+        return x
+
+    for colHead in list(df):
+        if df[colHead].dtype != object:
+            continue
+        firstChar = df[colHead].dropna().astype(str).str[:1]
+        if firstChar.isin(["{", "["]).any():
+            df[colHead] = df[colHead].apply(_literal_eval)
+
+    return df
+
+
+def convert_csv_folder(csv_path, dataset_path, overwrite=False):
+    '''
+    one-time conversion of a PHI-<date>-csvData folder to a parquet dataset
+    '''
+    all_files = sorted(glob.glob(os.path.join(csv_path, "PHI-*.csv")))
+    for f in all_files:
+        userid = os.path.basename(f)[len("PHI-"):-len(".csv")]
+        if donor_exists(dataset_path, userid) and not overwrite:
+            print(userid, "already converted")
+            continue
+
+        data = pd.read_csv(f, low_memory=False)
+        data = data.drop(columns="Unnamed: 0", errors="ignore")
+        data = parse_embedded_json(data)
+        save_donor_dataset(data, dataset_path, userid)
+        print(userid, "converted")
+
+    return
+
+
+# %% convert csv data to parquet
+if __name__ == "__main__":
+    codeDescription = "convert a PHI-<date>-csvData folder to parquet"
+    parser = argparse.ArgumentParser(description=codeDescription)
+
+    parser.add_argument(
+        "-d",
+        "--date-stamp",
+        dest="date_stamp",
+        help="date, in '%Y-%m-%d' format, of the date when " +
+        "donors were accepted"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-data-path",
+        dest="data_path",
+        default=os.path.abspath(
+            os.path.join(
+                os.path.dirname(__file__), "data"
+            )
+        ),
+        help="the output path where the data is stored"
+    )
+
+    parser.add_argument(
+        "--overwrite",
+        dest="overwrite",
+        action="store_true",
+        help="convert donors that have already been converted"
+    )
+
+    args = parser.parse_args()
+    if args.date_stamp is None:
+        sys.exit("a date stamp (-d) is required")
+
+    phi_date_stamp = "PHI-" + args.date_stamp
+    csv_path = os.path.join(
+        args.data_path,
+        phi_date_stamp + "-donor-data",
+        phi_date_stamp + "-csvData"
+    )
+    if not os.path.exists(csv_path):
+        sys.exit(csv_path + " does not exist")
+
+    convert_csv_folder(
+        csv_path,
+        get_parquet_dataset_path(args.data_path, args.date_stamp),
+        overwrite=args.overwrite
+    )
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: benchmark the local time estimate on synthetic datasets
+version: 0.0.1
+dependencies:
+    * estimate_local_time.py
+    * wikipedia-timezone-aliases-2018-04-28.csv
+license: BSD-2-Clause
+
+Makes synthetic Tidepool datasets of a traveller (cgm, pump, upload,
+healthkit and dexcom-api records, trips across timezones, dst changes, gaps,
+and large timezone offsets that need to be corrected), and times each stage
+of the local time estimate on them. Every dataset is run in a fresh process,
+so the peak memory is the memory of that dataset only. The results are
+saved to a json file, which can be compared to the results of another
+commit with --compare-to.
+
+usage:
+    python benchmark_estimate_local_time.py --years 1 5 -o benchmark.json
+"""
+
+
+# %% REQUIRED LIBRARIES
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess as sub
+import datetime as dt
+import multiprocessing
+import pandas as pd
+import numpy as np
+import estimate_local_time as elt
+
+
+# %% CONSTANTS
+HOME_TIMEZONE = "US/Mountain"
+TRAVEL_TIMEZONES = [
+    "America/New_York", "Europe/London", "Asia/Kolkata", "America/St_Johns",
+    "Australia/Lord_Howe", "Pacific/Auckland", "America/Sao_Paulo",
+    "Asia/Tokyo"
+]
+STAGES = [
+    "load", "preprocess", "daySeries", "estimation", "imputation", "apply",
+    "dstCorrection", "save"
+]
+
+
+# %% USER INPUTS
+codeDescription = "Benchmark the local time estimate on synthetic datasets"
+parser = argparse.ArgumentParser(description=codeDescription)
+
+parser.add_argument("--years",
+                    dest="years",
+                    nargs="+",
+                    default=[1.0, 3.0],
+                    type=float,
+                    help="the number of years of each synthetic dataset " +
+                    "(one benchmark per value)")
+
+parser.add_argument("--start-date",
+                    dest="startDate",
+                    default="2015-01-01",
+                    help="the first date of the synthetic datasets")
+
+parser.add_argument("--cgm-minutes",
+                    dest="cgmMinutes",
+                    default=5,
+                    type=int,
+                    help="minutes between cgm values")
+
+parser.add_argument("--boluses-per-day",
+                    dest="bolusesPerDay",
+                    default=5,
+                    type=int,
+                    help="number of boluses on each day")
+
+parser.add_argument("--uploads-per-week",
+                    dest="uploadsPerWeek",
+                    default=1.0,
+                    type=float,
+                    help="average number of pump (and of cgm) uploads per week")
+
+parser.add_argument("--healthkit-fraction",
+                    dest="healthkitFraction",
+                    default=0.3,
+                    type=float,
+                    help="fraction of the days with healthkit uploads")
+
+parser.add_argument("--dexcom-api-fraction",
+                    dest="dexcomApiFraction",
+                    default=0.1,
+                    type=float,
+                    help="fraction of the days where the cgm data comes " +
+                    "from the dexcom api")
+
+parser.add_argument("--trips-per-year",
+                    dest="tripsPerYear",
+                    default=6.0,
+                    type=float,
+                    help="average number of trips to another timezone per year")
+
+parser.add_argument("--gaps-per-year",
+                    dest="gapsPerYear",
+                    default=4.0,
+                    type=float,
+                    help="average number of gaps (days without data) per year")
+
+parser.add_argument("--corrupted-fraction",
+                    dest="corruptedFraction",
+                    default=0.01,
+                    type=float,
+                    help="fraction of the days where the pump has a timezone " +
+                    "offset that is off by whole days")
+
+parser.add_argument("--input-format",
+                    dest="inputFormat",
+                    default="csv",
+                    choices=["csv", "json"],
+                    help="file format of the synthetic datasets")
+
+parser.add_argument("--repeats",
+                    dest="repeats",
+                    default=1,
+                    type=int,
+                    help="number of runs of each dataset, the best time of " +
+                    "each stage is reported")
+
+parser.add_argument("--seed",
+                    dest="seed",
+                    default=0,
+                    type=int,
+                    help="random seed of the synthetic datasets")
+
+parser.add_argument("--deprecated-timezone-list",
+                    dest="timezoneAliasesFilePathAndName",
+                    default=os.path.abspath(
+                            os.path.join(
+                            os.path.dirname(__file__),
+                            "wikipedia-timezone-aliases-2018-04-28.csv")),
+                    help="a .csv file that contains a list of deprecated " +
+                    "timezones and their alias")
+
+parser.add_argument("-o",
+                    "--output-file",
+                    dest="outputFile",
+                    default=os.path.abspath(
+                            os.path.join(
+                            os.path.dirname(__file__),
+                            "output", "benchmarks",
+                            "benchmark-" +
+                            dt.datetime.now().strftime("%Y-%m-%d-%H%M%S") +
+                            ".json")),
+                    help="the json file where the results are saved")
+
+parser.add_argument("--compare-to",
+                    dest="compareTo",
+                    default=None,
+                    help="(optional) json file of a previous benchmark to " +
+                    "compare the results to")
+
+
+# %% FUNCTIONS
+def format_times(times):
+    # utc times in the tidepool format (e.g., 2018-01-01T00:00:00.000Z)
+    seconds = np.datetime_as_string(
+        np.asarray(times, dtype="datetime64[s]"), unit="s"
+    )
+    return pd.Series(seconds, dtype=object) + ".000Z"
+
+
+def get_runs(rng, nDays, runsPerYear, minLength, maxLength):
+    # a boolean mask of random runs of days
+    isInRun = np.zeros(nDays, dtype=bool)
+    for _ in range(rng.poisson(runsPerYear * nDays / 365.25)):
+        start = rng.randint(0, nDays)
+        isInRun[start:start + rng.randint(minLength, maxLength + 1)] = True
+
+    return isInRun
+
+
+def make_synthetic_dataset(
+    years=1.0,
+    startDate="2015-01-01",
+    cgmMinutes=5,
+    bolusesPerDay=5,
+    uploadsPerWeek=1.0,
+    healthkitFraction=0.3,
+    dexcomApiFraction=0.1,
+    tripsPerYear=6.0,
+    gapsPerYear=4.0,
+    corruptedFraction=0.01,
+    seed=0
+):
+    '''
+    make a synthetic Tidepool dataset of a traveller
+    OUTPUTS:
+        * dataframe with cbg, bolus and upload records, in the format of the
+          donor csv files (deviceTags and payload are strings)
+    '''
+    rng = np.random.RandomState(seed)
+    days = pd.date_range(startDate, periods=int(round(years * 365.25)))
+    nDays = len(days)
+
+    # the timezone the traveller is in on each day
+    timezones = np.full(nDays, HOME_TIMEZONE, dtype=object)
+    for _ in range(rng.poisson(tripsPerYear * years)):
+        start = rng.randint(0, nDays)
+        timezones[start:start + rng.randint(3, 15)] = \
+            rng.choice(TRAVEL_TIMEZONES)
+
+    trueOffsets = np.zeros(nDays)
+    for tz in np.unique(timezones):
+        isTz = timezones == tz
+        trueOffsets[isTz] = elt.td.tz.get_timezone_offsets(
+            days[isTz] + pd.Timedelta(12, unit="h"), tz
+        )
+
+    # the devices are set to the new local time a few days late
+    pumpOffsets = trueOffsets.copy()
+    cgmOffsets = trueOffsets.copy()
+    for i in range(1, nDays):
+        if rng.random_sample() < 0.5:
+            pumpOffsets[i] = pumpOffsets[i - 1]
+        if rng.random_sample() < 0.3:
+            cgmOffsets[i] = cgmOffsets[i - 1]
+
+    # large timezone offsets that are off by whole days (with a conversion
+    # offset that undoes them)
+    isCorrupted = rng.random_sample(nDays) < corruptedFraction
+    corruptedDays = \
+        rng.choice([-4, -3, -2, -1, 1, 2, 3, 4], nDays) * isCorrupted
+    conversionOffsets = -corruptedDays * 1440 * 60 * 1000
+
+    hasData = ~get_runs(rng, nDays, gapsPerYear, 1, 14)
+    # the cgm data comes from the dexcom api in one contiguous period
+    isDexcomApi = np.zeros(nDays, dtype=bool)
+    nDexcomApiDays = int(round(dexcomApiFraction * nDays))
+    dexcomApiStart = rng.randint(0, nDays - nDexcomApiDays + 1)
+    isDexcomApi[dexcomApiStart:dexcomApiStart + nDexcomApiDays] = True
+    localMidnights = days.values - trueOffsets.astype("timedelta64[m]")
+    dataDays = np.flatnonzero(hasData)
+
+    # cgm data
+    pointsPerDay = 1440 // cgmMinutes
+    cgmDays = np.repeat(dataDays, pointsPerDay)
+    cgmTimes = localMidnights[cgmDays] + (
+        np.tile(np.arange(pointsPerDay) * cgmMinutes * 60, len(dataDays)) +
+        rng.randint(0, 60, len(cgmDays))
+    ).astype("timedelta64[s]")
+    cgm = pd.DataFrame({
+        "type": "cbg",
+        "time": format_times(cgmTimes),
+        "value": rng.uniform(3, 15, len(cgmDays)).round(4),
+        "units": "mmol/L",
+        "timezoneOffset": cgmOffsets[cgmDays],
+        "conversionOffset": 0,
+        "uploadId": "upload-cgm",
+    })
+    isDexcomApiCgm = isDexcomApi[cgmDays]
+    cgm.loc[isDexcomApiCgm, "payload"] = \
+        "{'systemTime': '" + cgm.loc[isDexcomApiCgm, "time"] + \
+        "', 'trend': 'flat'}"
+    cgm.loc[isDexcomApiCgm & (rng.random_sample(len(cgm)) < 0.5),
+            "timezoneOffset"] = np.nan
+
+    # pump data
+    bolusDays = np.repeat(dataDays, bolusesPerDay)
+    bolusTimes = localMidnights[bolusDays] + \
+        rng.randint(6 * 60, 23 * 60, len(bolusDays)).astype("timedelta64[m]")
+    bolus = pd.DataFrame({
+        "type": "bolus",
+        "subType": "normal",
+        "time": format_times(bolusTimes),
+        "normal": rng.uniform(0.5, 8, len(bolusDays)).round(2),
+        "timezoneOffset": pumpOffsets[bolusDays] + corruptedDays[bolusDays] * 1440,
+        "conversionOffset": conversionOffsets[bolusDays],
+        "uploadId": "upload-pump",
+    })
+
+    # uploads of the pump, the cgm, and healthkit
+    uploads = []
+    for deviceType, uploadsPerDay, deviceTags, timeProcessing in [
+        ("pump", uploadsPerWeek / 7, "['insulin-pump']", "utc-bootstrapping"),
+        ("cgm", uploadsPerWeek / 7, "['cgm']", "across-the-board-timezone"),
+        ("healthkit", 2 * healthkitFraction, "['cgm']", "none"),
+    ]:
+        uploadDays = dataDays[rng.random_sample(len(dataDays)) < uploadsPerDay / 2]
+        uploadDays = np.sort(np.concatenate([uploadDays, uploadDays[
+            rng.random_sample(len(uploadDays)) < 0.5]]))
+        uploadTimes = localMidnights[uploadDays] + \
+            rng.randint(8 * 60, 22 * 60, len(uploadDays)). \
+            astype("timedelta64[m]")
+        uploadTimezones = timezones[uploadDays].copy()
+        # sometimes the home timezone is left in the uploader when travelling
+        uploadTimezones[rng.random_sample(len(uploadDays)) < 0.1] = HOME_TIMEZONE
+        uploads.append(pd.DataFrame({
+            "type": "upload",
+            "time": format_times(uploadTimes),
+            "timezone": uploadTimezones,
+            "timezoneOffset": trueOffsets[uploadDays],
+            "conversionOffset": 0,
+            "deviceTags": deviceTags,
+            "timeProcessing": timeProcessing,
+            "uploadId": "upload-" + deviceType,
+        }))
+
+    df = pd.concat([cgm, bolus] + uploads, ignore_index=True, sort=False)
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    df["id"] = ["synthetic-" + str(i) for i in range(len(df))]
+
+    return df
+
+
+def get_peak_memory_mb():
+    # peak resident memory of the process. VmHWM starts over when a process
+    # is spawned, whereas ru_maxrss (in KB on linux) keeps the peak memory of
+    # the parent process that it was forked from
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_benchmark(inputFile, timezoneAliasesFilePathAndName, endDate):
+    '''
+    load, estimate and save the local time of a single dataset, and return
+    the duration of each stage and the peak memory
+    '''
+    stats = {"startMemoryMB": get_peak_memory_mb()}
+    timezoneAliases = \
+        elt.load_timezone_aliases(timezoneAliasesFilePathAndName)
+
+    stageStartTime = time.time()
+    data, fileName = elt.checkInputFile(inputFile)
+    stats["loadSeconds"] = round(time.time() - stageStartTime, 3)
+
+    data, cDays = elt.estimate_local_time(
+        data, timezoneAliases, "2010-01-01", endDate, stats=stats
+    )
+
+    stageStartTime = time.time()
+    with tempfile.TemporaryDirectory() as outputPath:
+        elt.save_local_time_estimates(
+            data, cDays, fileName, outputPath, outputPath
+        )
+    stats["saveSeconds"] = round(time.time() - stageStartTime, 3)
+
+    stats["totalSeconds"] = round(
+        sum([stats[stage + "Seconds"] for stage in STAGES]), 3
+    )
+    stats["nRows"] = len(data)
+    stats["nDays"] = len(cDays)
+    stats["peakMemoryMB"] = get_peak_memory_mb()
+
+    return stats
+
+
+def run_benchmark_in_new_process(*args):
+    # a fresh (spawned) process, so the peak memory is of this dataset only
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        stats = pool.apply(run_benchmark, args)
+
+    return stats
+
+
+def get_git_commit():
+    try:
+        commit = sub.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=sub.DEVNULL
+        ).decode("utf-8").strip()
+    except (OSError, sub.CalledProcessError):
+        commit = None
+
+    return commit
+
+
+def compare_benchmarks(results, previousResults):
+    # the best time of each stage, and the peak memory, of both benchmarks
+    previousCases = {case["name"]: case for case in previousResults["cases"]}
+    rows = []
+    for case in results["cases"]:
+        if case["name"] not in previousCases:
+            continue
+        previous = previousCases[case["name"]]["best"]
+        for key in [stage + "Seconds" for stage in STAGES] + \
+                ["totalSeconds", "peakMemoryMB"]:
+            rows.append({
+                "case": case["name"],
+                "metric": key,
+                "previous": previous.get(key),
+                "current": case["best"][key],
+            })
+    comparison = pd.DataFrame(rows)
+    if len(comparison) > 0:
+        comparison["ratio"] = \
+            (comparison.current / comparison.previous).round(2)
+
+    return comparison
+
+
+def benchmark_estimate_local_time(
+    years,
+    timezoneAliasesFilePathAndName,
+    inputFormat="csv",
+    repeats=1,
+    datasetArgs={}
+):
+    '''
+    benchmark the local time estimate on a synthetic dataset for each of
+    the years, see make_synthetic_dataset for the datasetArgs
+    '''
+    results = {
+        "codeVersion": elt.codeVersion,
+        "gitCommit": get_git_commit(),
+        "createdOn": dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "cpuCount": os.cpu_count(),
+        "cases": []
+    }
+
+    with tempfile.TemporaryDirectory() as workPath:
+        for nYears in years:
+            name = "years-" + str(nYears)
+            datasetParams = dict(datasetArgs, years=nYears)
+            data = make_synthetic_dataset(**datasetParams)
+            inputFile = os.path.join(workPath, name + "." + inputFormat)
+            if inputFormat == "json":
+                data.to_json(inputFile, orient="records")
+            else:
+                data.to_csv(inputFile, index=False)
+            del data
+
+            endDate = (
+                pd.Timestamp(datasetParams.get("startDate", "2015-01-01")) +
+                pd.Timedelta(int(nYears * 366) + 1, unit="D")
+            ).strftime("%Y-%m-%d")
+
+            runs = []
+            for _ in range(repeats):
+                runs.append(run_benchmark_in_new_process(
+                    inputFile, timezoneAliasesFilePathAndName, endDate
+                ))
+                print(name, "run", len(runs), "took",
+                      runs[-1]["totalSeconds"], "seconds, peak memory",
+                      runs[-1]["peakMemoryMB"], "MB")
+
+            best = pd.DataFrame(runs).min().to_dict()
+            results["cases"].append({
+                "name": name,
+                "dataset": datasetParams,
+                "inputFormat": inputFormat,
+                "inputMB": round(os.stat(inputFile).st_size / 1E6, 1),
+                "runs": runs,
+                "best": best,
+            })
+
+    return results
+
+
+# %% START OF CODE
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.timezoneAliasesFilePathAndName):
+        sys.exit("{0} is not a valid file".format(
+                args.timezoneAliasesFilePathAndName))
+
+    results = benchmark_estimate_local_time(
+        args.years,
+        args.timezoneAliasesFilePathAndName,
+        inputFormat=args.inputFormat,
+        repeats=args.repeats,
+        datasetArgs={
+            "startDate": args.startDate,
+            "cgmMinutes": args.cgmMinutes,
+            "bolusesPerDay": args.bolusesPerDay,
+            "uploadsPerWeek": args.uploadsPerWeek,
+            "healthkitFraction": args.healthkitFraction,
+            "dexcomApiFraction": args.dexcomApiFraction,
+            "tripsPerYear": args.tripsPerYear,
+            "gapsPerYear": args.gapsPerYear,
+            "corruptedFraction": args.corruptedFraction,
+            "seed": args.seed,
+        }
+    )
+
+    outputPath = os.path.dirname(os.path.abspath(args.outputFile))
+    if not os.path.isdir(outputPath):
+        os.makedirs(outputPath)
+    with open(args.outputFile, "w") as outputFile:
+        json.dump(results, outputFile, indent=2)
+    print("saved the results to", args.outputFile)
+
+    if pd.notnull(args.compareTo):
+        with open(args.compareTo, "r") as previousFile:
+            print(compare_benchmarks(results, json.load(previousFile)))
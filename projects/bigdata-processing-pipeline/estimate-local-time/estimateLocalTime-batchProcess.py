@@ -2,11 +2,11 @@
 # -*- coding: utf-8 -*-
 """
 description: Estimate local time
-version: 0.0.1
+version: 0.0.2
 created: 2018-10-23
 author: Ed Nykaza
 dependencies:
-    * estimate-local-time.py
+    * estimate_local_time.py
 license: BSD-2-Clause
 """
 
@@ -16,23 +16,31 @@ import os
 import sys
 import datetime as dt
 import argparse
-import subprocess as sub
 import time
+import resource
+import traceback
+import pandas as pd
 from multiprocessing import Pool
 # load tidals package locally if it does not exist globally
 import importlib
 if importlib.util.find_spec("tidals") is None:
     tidalsPath = os.path.abspath(os.path.join(os.path.dirname(__file__),
-                      "..", "..", "tidepool-analysis-tools"))
+                      "..", "..", "..", "tidepool-analysis-tools"))
     if tidalsPath not in sys.path:
         sys.path.insert(0, tidalsPath)
 import tidals as td
+envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if envPath not in sys.path:
+    sys.path.insert(0, envPath)
+from job_manifest import JobManifest, SKIPPED
+import estimate_local_time as elt
 startTime = time.time()
 print("starting at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
 # %% USER INPUTS
-codeDescription = "A batch processing or wrapper script to run the estimate-local-time.py"
+codeDescription = "A batch processing or wrapper script to estimate the " + \
+    "local time of all donor datasets"
 parser = argparse.ArgumentParser(description=codeDescription)
 
 parser.add_argument("-d",
@@ -47,6 +55,36 @@ parser.add_argument("--start-date",
                     default="2010-01-01",
                     help="filter data by startDate and endDate")
 
+parser.add_argument("--end-date",
+                    dest="endDate",
+                    default=dt.datetime.now().strftime("%Y-%m-%d"),
+                    help="filter data by startDate and endDate")
+
+parser.add_argument("--deprecated-timezone-list",
+                    dest="timezoneAliasesFilePathAndName",
+                    default=os.path.abspath(
+                            os.path.join(
+                            os.path.dirname(__file__),
+                            "wikipedia-timezone-aliases-2018-04-28.csv")),
+                    help="a .csv file that contains a list of deprecated " +
+                    "timezones and their alias")
+
+parser.add_argument("-w",
+                    "--workers",
+                    dest="workers",
+                    default=os.cpu_count(),
+                    type=int,
+                    help="number of worker processes used to estimate the " +
+                    "local time of the donor datasets")
+
+parser.add_argument("--maxtasksperchild",
+                    dest="maxtasksperchild",
+                    default=None,
+                    type=int,
+                    help="number of donors a worker processes before it is " +
+                    "replaced with a fresh process (default: workers are " +
+                    "never replaced)")
+
 parser.add_argument("-ow",
                     "--overWrite",
                     dest="overWrite",
@@ -54,6 +92,12 @@ parser.add_argument("-ow",
                     help="Specify if you want to overwrite a file that has already" + \
                     "been processed, False if NO, True if YES")
 
+parser.add_argument("--retry-failed",
+                    dest="retryFailed",
+                    action="store_true",
+                    help="also run the donors that failed in a previous " +
+                    "run (by default only unfinished donors are run)")
+
 args = parser.parse_args()
 
 
@@ -79,13 +123,66 @@ localTimeEstimateDaySeriesPath = os.path.join(dataPath, args.dateStamp + "-local
 if not os.path.exists(localTimeEstimateDaySeriesPath):
     os.makedirs(localTimeEstimateDaySeriesPath)
 
+# the deprecated timezone to alias map is built once and cached in this file
+timezoneAliasesCachePathAndName = os.path.join(
+    dataPath, "PHI-" + args.dateStamp + "-timezoneAliasMap.json"
+)
+
+# the timing and memory stats of each donor are added to this file
+localTimeStatsPathAndName = os.path.join(
+    dataPath, "PHI-" + args.dateStamp + "-localTime-stats.csv"
+)
+
+
+# the job manifest records the donors that are done, so a run that stops
+# part way resumes with the donors that did not finish
+manifest = JobManifest(
+    os.path.join(dataPath, "PHI-" + args.dateStamp + "-jobManifest.sqlite")
+)
+stage = "local-time"
+manifest.add_jobs(stage, donors.userID)
+unfinished = manifest.get_unfinished(stage, retry_failed=args.retryFailed)
+print(str(len(unfinished)) + " of " + str(len(donors)) + " donors left to run")
+
 
 # %% FUNCTIONS
+worker_settings = {}
+
+
+def init_worker(timezoneAliasesFilePathAndName, cacheFilePathAndName):
+    # the timezone aliases are the same for every donor, so they are loaded
+    # once per worker. The timezone offset tables (td.tz) are cached in the
+    # worker too, so they are only built once for each timezone
+    worker_settings["timezoneAliases"] = elt.load_timezone_aliases(
+        timezoneAliasesFilePathAndName, cacheFilePathAndName
+    )
+
+    return
+
+
+def get_peak_memory_mb():
+    # peak resident memory of the worker process (ru_maxrss is in KB on linux)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
 def run_estimate_local_time(dIndex):
     userID = donors.userID[dIndex]
+    stats = {"dIndex": dIndex, "userID": userID}
+    try:
+        stats.update(estimate_donor_local_time(dIndex, userID))
+    except (Exception, SystemExit):
+        manifest.fail(stage, userID, traceback.format_exc())
+        print("failed with index=" + str(dIndex), traceback.format_exc())
+        stats["status"] = "failed"
+
+    return stats
+
+
+def estimate_donor_local_time(dIndex, userID):
     fileName = "PHI-" + str(userID)
     jsonFileName = os.path.join(jsonDataPath, fileName + ".json")
     fileSize = os.stat(jsonFileName).st_size
+    stats = {"fileSizeMB": round(fileSize / 1E6, 1)}
     if fileSize > 1000:
         localTimeEstimateDataPathAndName = \
             os.path.join(localTimeEstimateDataPath, fileName + ".csv")
@@ -94,34 +191,105 @@ def run_estimate_local_time(dIndex):
                 ((os.path.exists(localTimeEstimateDataPathAndName)) & (args.overWrite))):
 
             print("starting with index=" + str(dIndex),
-                  "file size is: " + str(round(fileSize/1E6, 1)) + "MB")
+                  "file size is: " + str(stats["fileSizeMB"]) + "MB")
+            manifest.start(stage, userID, input_bytes=fileSize)
+            donorStartTime = time.time()
+
+            data, fileName = elt.checkInputFile(jsonFileName)
+            stats["loadSeconds"] = round(time.time() - donorStartTime, 3)
+            stats["dataMB"] = \
+                round(data.memory_usage(deep=True).sum() / 1E6, 1)
+
             # local time estimate
-            p = sub.Popen(["python", "estimate-local-time.py",
-                           "-i", jsonFileName,
-                           "-o", localTimeEstimateDataPath,
-                           "--day-series-output-path", localTimeEstimateDaySeriesPath,
-                           "--start-date", args.startDate], stdout=sub.PIPE, stderr=sub.PIPE)
+            estimateStartTime = time.time()
+            data, cDays = elt.estimate_local_time(
+                data,
+                worker_settings["timezoneAliases"],
+                args.startDate,
+                args.endDate,
+                stats=stats
+            )
+            stats["estimateSeconds"] = \
+                round(time.time() - estimateStartTime, 3)
+            stats["nRows"] = len(data)
+            stats["nDays"] = len(cDays)
 
-            output, errors = p.communicate()
-            output = output.decode("utf-8")
-            errors = errors.decode("utf-8")
+            saveStartTime = time.time()
+            elt.save_local_time_estimates(
+                data,
+                cDays,
+                fileName,
+                localTimeEstimateDataPath,
+                localTimeEstimateDaySeriesPath
+            )
+            stats["saveSeconds"] = round(time.time() - saveStartTime, 3)
 
+            donorDuration = round(time.time() - donorStartTime, 3)
+            stats["totalSeconds"] = donorDuration
+            stats["peakMemoryMB"] = get_peak_memory_mb()
+            stats["status"] = "done"
             print("finished with index=" + str(dIndex),
-                 " output: " + output, "errors: " + errors)
+                  "in " + str(donorDuration) + " seconds",
+                  "peak memory is: " + str(stats["peakMemoryMB"]) + "MB")
+
+            manifest.finish(stage, userID, duration=donorDuration)
         else:
             print("skipped index=" + str(dIndex) + " because is was already processed")
+            manifest.finish(stage, userID, input_bytes=fileSize)
+            stats["status"] = "already-processed"
     else:
         print("skipped index=" + str(dIndex) + " because file size is: " + str(fileSize) + "Bytes")
+        manifest.finish(stage, userID, status=SKIPPED, input_bytes=fileSize)
+        stats["status"] = "skipped"
+
+    return stats
+
+
+def save_stats(stats, statsPathAndName):
+    # one row per donor, added as each donor finishes so the stats of a run
+    # that stops part way are kept
+    statsColumns = [
+        "dIndex", "userID", "status", "fileSizeMB", "dataMB", "nRows",
+        "nDays", "nTimezoneOffsetCorrections", "loadSeconds",
+        "preprocessSeconds", "daySeriesSeconds", "estimationSeconds",
+        "imputationSeconds", "applySeconds", "dstCorrectionSeconds",
+        "estimateSeconds", "saveSeconds", "totalSeconds", "peakMemoryMB"
+    ]
+    pd.DataFrame([stats], columns=statsColumns).to_csv(
+        statsPathAndName,
+        mode="a",
+        header=not os.path.exists(statsPathAndName),
+        index=False
+    )
 
     return
 
 
 # %% main code execution
 
-# use multiple cores to process
-pool = Pool(os.cpu_count())
-pool.map(run_estimate_local_time, donors.dIndex)
+# build the alias map cache before the workers load it
+elt.load_timezone_aliases(
+    args.timezoneAliasesFilePathAndName, timezoneAliasesCachePathAndName
+)
+
+# use multiple cores to process, the workers are started once and reused
+pool = Pool(
+    processes=args.workers,
+    initializer=init_worker,
+    initargs=(
+        args.timezoneAliasesFilePathAndName,
+        timezoneAliasesCachePathAndName
+    ),
+    maxtasksperchild=args.maxtasksperchild
+)
+for stats in pool.imap_unordered(
+    run_estimate_local_time,
+    donors.loc[donors.userID.isin(unfinished), "dIndex"]
+):
+    save_stats(stats, localTimeStatsPathAndName)
 pool.close()
+pool.join()
+print(manifest.summary(stage))
 
 endTime = time.time()
 print("finshed at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
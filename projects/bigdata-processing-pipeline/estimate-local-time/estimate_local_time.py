@@ -0,0 +1,1074 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: Estimate local time
+version: 0.0.3
+created: 2018-04-30
+author: Ed Nykaza
+dependencies:
+    * tidepool-data-env (install using anaconda, see readme for details)
+    * wikipedia-timezone-aliases-2018-04-28.csv
+license: BSD-2-Clause
+
+usage:
+    import estimate_local_time as elt
+    timezoneAliases = elt.load_timezone_aliases(timezoneAliasesFilePathAndName)
+    data, daySeries = elt.estimate_local_time(
+        data, timezoneAliases, startDate, endDate
+    )
+
+see estimate-local-time.py for the command line version
+
+TODO:
+* [] see readme file
+"""
+
+
+# %% REQUIRED LIBRARIES
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import functools
+from datetime import timedelta
+# load tidals package locally if it does not exist globally
+import importlib
+if importlib.util.find_spec("tidals") is None:
+    tidalsPath = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                      "..", "..", "..", "tidepool-analysis-tools"))
+    if tidalsPath not in sys.path:
+        sys.path.insert(0, tidalsPath)
+import tidals as td
+
+
+# %% CONSTANTS
+codeVersion = "0.0.3"
+
+
+# %% FUNCTIONS
+
+def filterByDates(df, startDate, endDate):
+
+    # filter by qualified start & end date, and sort
+    df = \
+        df[(df.time >= startDate) &
+           (df.time <= (endDate + "T23:59:59"))]
+
+    return df
+
+
+def getTimezoneAliasMap(tzAlias):
+    # a deprecated timezone is converted to its alias if it is the end of
+    # exactly one of the timezones in the alias table, so every suffix of
+    # the table timezones that is unique maps to its alias
+    suffixAliases = {}
+    suffixCounts = {}
+    for tz, alias in zip(tzAlias.tz, tzAlias.alias):
+        for i in range(len(tz)):
+            suffixAliases[tz[i:]] = alias
+            suffixCounts[tz[i:]] = suffixCounts.get(tz[i:], 0) + 1
+
+    return {suffix: alias for suffix, alias in suffixAliases.items()
+            if suffixCounts[suffix] == 1}
+
+
+def convertDeprecatedTimezoneToAlias(df, tzAlias):
+    # tzAlias is the alias map (see load_timezone_aliases) or the alias table
+    if "timezone" in df:
+        if isinstance(tzAlias, pd.DataFrame):
+            tzAlias = getTimezoneAliasMap(tzAlias)
+
+        # timezones are kept as a categorical, so only the categories
+        # (the unique timezones) are mapped
+        df["timezone"] = df["timezone"].astype("category").map(
+            lambda tz: tzAlias.get(tz, tz)
+        ).astype("category")
+
+    return df
+
+
+def largeTimezoneOffsetCorrection(df):
+    # timezone offsets above 840 are moved back, and offsets below -720 are
+    # moved forward, by whole days until they are in range, and the
+    # conversion offsets are changed by the same amount. Returns the data
+    # and the number of rows that were corrected
+    tzo = df.timezoneOffset.values
+    nDays = np.zeros(len(df), dtype=np.int64)
+    isLarge = tzo > 840
+    isSmall = tzo < -720
+    nDays[isLarge] = -((840 - tzo[isLarge]) // 1440)
+    nDays[isSmall] = (tzo[isSmall] + 720) // 1440
+
+    isCorrected = isLarge | isSmall
+    nCorrected = int(isCorrected.sum())
+    if nCorrected > 0:
+        df.loc[isCorrected, "conversionOffset"] = \
+            df.loc[isCorrected, "conversionOffset"] - \
+            (nDays[isCorrected] * 1440 * 60 * 1000)
+
+        df.loc[isCorrected, "timezoneOffset"] = \
+            df.loc[isCorrected, "timezoneOffset"] - (nDays[isCorrected] * 1440)
+
+    return df, nCorrected
+
+
+def createContiguousDaySeries(df):
+    firstDay = df.date.min()
+    lastDay = df.date.max()
+    rng = pd.date_range(firstDay, lastDay).date
+    contiguousDaySeries = \
+        pd.DataFrame(rng, columns=["date"]).sort_values(
+                "date", ascending=False).reset_index(drop=True)
+
+    return contiguousDaySeries
+
+
+def getAndPreprocessUploadRecords(df):
+    # filter by type upload
+    ud = df[df.type == "upload"].copy()
+    # the device tags of the uploads in string format (they are lists in
+    # json data)
+    deviceTags = ud.deviceTags.astype(str)
+    hasPumpTag = deviceTags.str.contains("pump").values
+    hasCgmTag = deviceTags.str.contains("cgm").values
+    isHealthkit = (ud.timeProcessing == "none").values
+
+    # define a device type (e.g., pump, cgm, or healthkit), where cgm is for
+    # non-healthkit cgm records only
+    deviceTypes = {1: "pump", 2: "cgm", 3: "healthkit"}
+    deviceTypeKeys = np.where(hasCgmTag, np.where(isHealthkit, 3, 2),
+                              np.where(hasPumpTag, 1, 0))
+    ud["deviceType"] = \
+        pd.Series(deviceTypeKeys, index=ud.index).map(deviceTypes)
+
+    return ud
+
+
+def isDexcomApiPayload(payloads):
+    # dexcom-api data have a systemTime in their payload. The payload is a
+    # dictionary in json data, and the string of the dictionary in csv data
+    return np.array([
+        isinstance(payload, (dict, str)) and ("systemTime" in payload)
+        for payload in payloads
+    ], dtype=bool)
+
+
+def getAndPreprocessNonDexApiCgmRecords(df):
+    # non-healthkit cgm and exclude dexcom-api data
+    isCgm = df.type == "cbg"
+    if "payload.systemTime" in df:
+        df.loc[isCgm, "isDexcomAPI"] = \
+            df.loc[isCgm, "payload.systemTime"].notnull()
+
+    elif "payload" in df:
+        df.loc[isCgm, "isDexcomAPI"] = \
+            isDexcomApiPayload(df.loc[isCgm, "payload"].values)
+
+    if "isDexcomAPI" in df:
+        cd = df[isCgm &
+                (df.timezoneOffset.notnull()) &
+                (~df.isDexcomAPI.fillna(False).astype(bool))].copy()
+
+    else:
+        cd = df[isCgm & (df.timezoneOffset.notnull())]
+
+    return cd
+
+
+def getTimezoneOffset(currentDate, currentTimezone):
+
+    # here we add 1 day to the current date to account for changes to/from DST
+    # (the offsets of whole dates are kept in the td.tz calendars)
+    tzo = td.tz.get_date_offset(currentDate + timedelta(days=1),
+                                currentTimezone)
+
+    return tzo
+
+
+def getTimezoneOffsets(dates, currentTimezone):
+    # the timezone offsets of a series of dates, see getTimezoneOffset
+    nextDays = pd.to_datetime(pd.Series(dates)) + timedelta(days=1)
+    tzos = td.tz.get_date_offsets(nextDays, currentTimezone)
+
+    return tzos
+
+
+def getTzoForDateTime(currentDateTime, currentTimezone):
+
+    tzo = td.tz.get_timezone_offset(pd.to_datetime(currentDateTime),
+                                    currentTimezone)
+
+    return tzo
+
+
+def isDSTChangeDay(currentDate, currentTimezone):
+    # the offset of the current day is different than the previous day, i.e.,
+    # the offset changes during the current date
+    return td.tz.is_dst_change_date(currentDate, currentTimezone)
+
+
+def addAnnotation(days, idx, annotationMessage):
+    # idx can be a single day or an array of days
+    idx = np.atleast_1d(idx)
+    annotations = days["est.annotations"]
+    hasAnnotation = pd.notnull(annotations[idx])
+    annotations[idx[hasAnnotation]] = \
+        annotations[idx[hasAnnotation]] + ", " + annotationMessage
+    annotations[idx[~hasAnnotation]] = annotationMessage
+
+    return days
+
+
+def getDailyMode(records, col):
+    # the most frequent value of a column on each day of each day series,
+    # ties go to the value that comes first (like describe()["top"])
+    values = records.loc[records[col].notnull(), ["daySeries", "date", col]]
+    valueCounts = values.groupby(
+        ["daySeries", "date", col], sort=False
+    )[col].transform("size")
+    top = valueCounts.groupby([values.daySeries, values.date]).idxmax()
+
+    return pd.Series(values.loc[top.values, col].values, index=top.index)
+
+
+def addDeviceDaySeries(uploadData, cgmData, pumpData, contDays):
+    # the day series of the uploads, the cgm and pump data, and of each
+    # type of upload (e.g., pump.upload.imputed) are made with one groupby
+    # over (daySeries, date), and are merged into the day series at once
+    daySeriesNames = ["upload", "cgm", "pump", "pump.upload.imputed",
+                      "cgm.upload.imputed", "healthkit.upload.imputed"]
+    uploadCols = [col for col in ["date", "timezoneOffset", "timezone",
+                                  "timeProcessing"] if col in uploadData]
+    typedUploads = uploadData[uploadData.deviceType.notnull()]
+    records = pd.concat([
+        uploadData[uploadCols].assign(daySeries="upload"),
+        cgmData[["date", "timezoneOffset"]].assign(daySeries="cgm"),
+        pumpData[["date", "timezoneOffset"]].assign(daySeries="pump"),
+        typedUploads[uploadCols].assign(
+            daySeries=typedUploads.deviceType + ".upload.imputed"
+        )
+    ], ignore_index=True)
+
+    daySeries = {}
+    if len(records) > 0:
+        daySeries["timezoneOffset"] = \
+            records.groupby(["daySeries", "date"]).timezoneOffset.median()
+
+    if ((len(records) > 0) & ("timezone" in records)):
+        records["timezone"] = records["timezone"].astype(object)
+        timezones = getDailyMode(records, "timezone")
+        timeProcessing = getDailyMode(records, "timeProcessing")
+
+        # the timezones of an upload day series are only used if the first
+        # day of the series has a timezone
+        firstDays = records[~records.daySeries.isin(["cgm", "pump"])]. \
+            groupby("daySeries").date.min()
+        firstDays = firstDays[[
+            (daySeriesName, firstDay) in timezones.index
+            for daySeriesName, firstDay in firstDays.items()
+        ]]
+        timezones = timezones[timezones.index.isin(
+            firstDays.index, level="daySeries")]
+        timeProcessing = timeProcessing[timeProcessing.index.isin(
+            firstDays.index, level="daySeries")]
+
+        # get the timezone offset for the timezone
+        for tz, tzDays in timezones.groupby(timezones).groups.items():
+            daySeries["timezoneOffset"][tzDays] = getTimezoneOffsets(
+                tzDays.get_level_values("date"), tz
+            ).astype(float)
+
+        daySeries["timezone"] = timezones
+        daySeries["timeProcessing"] = timeProcessing
+
+    # one wide table with a column of each day series and field
+    dfDaySeries = pd.DataFrame(index=pd.Index([], name="date"))
+    for col, values in daySeries.items():
+        if len(values) > 0:
+            values = values.unstack("daySeries")
+            values.columns = values.columns + "." + col
+            dfDaySeries = dfDaySeries.join(values, how="outer")
+
+    for daySeriesName in daySeriesNames:
+        if daySeriesName + ".timezoneOffset" not in dfDaySeries:
+            dfDaySeries[daySeriesName + ".timezoneOffset"] = np.nan
+
+    contDays = pd.merge(contDays, dfDaySeries.reset_index(),
+                        on="date", how="left")
+
+    return contDays
+
+
+def imputeUploadRecords(daySeries, deviceTypeName):
+    if deviceTypeName + ".timezone" in daySeries:
+        # carry the timezone of the last upload forward to the days
+        # without uploads
+        daySeries[deviceTypeName + ".timezone"] = \
+            daySeries[deviceTypeName + ".timezone"].ffill()
+
+        # each day gets the timeProcessing of the day before it, which means
+        # that every day after the first day with a timeProcessing gets the
+        # timeProcessing of that first day
+        timeProcessing = daySeries[deviceTypeName + ".timeProcessing"]
+        firstDay = timeProcessing.first_valid_index()
+        if firstDay is not None:
+            daySeries.loc[firstDay + 1:, deviceTypeName + ".timeProcessing"] = \
+                timeProcessing[firstDay]
+
+        # get the timezone offset of the (imputed) timezone of each day
+        imputedDays = daySeries.iloc[1:]
+        for tz, tzDays in imputedDays.groupby(deviceTypeName + ".timezone"):
+            daySeries.loc[tzDays.index, deviceTypeName + ".timezoneOffset"] = \
+                getTimezoneOffsets(tzDays["date"], tz)
+
+    else:
+        daySeries[deviceTypeName + ".timezone"] = np.nan
+        daySeries[deviceTypeName + ".timeProcessing"] = np.nan
+
+    return daySeries
+
+
+def estimateTzAndTzoWithUploadRecords(cDF):
+
+    cDF["est.type"] = np.nan
+    cDF["est.gapSize"] = np.nan
+    cDF["est.timezoneOffset"] = cDF["upload.timezoneOffset"]
+    cDF["est.annotations"] = np.nan
+
+    if "upload.timezone" in cDF:
+        cDF.loc[cDF["upload.timezone"].notnull(), ["est.type"]] = "UPLOAD"
+        cDF["est.timezone"] = cDF["upload.timezone"]
+        cDF["est.timeProcessing"] = cDF["upload.timeProcessing"]
+    else:
+        cDF["est.timezone"] = np.nan
+        cDF["est.timeProcessing"] = np.nan
+
+    cDF.loc[((cDF["est.timezoneOffset"] !=
+              cDF["home.imputed.timezoneOffset"]) &
+            (pd.notnull(cDF["est.timezoneOffset"]))),
+            "est.annotations"] = "travel"
+
+    return cDF
+
+
+def getDaySeriesArrays(cDF):
+    # the day by day estimates are made on a dictionary with a numpy array
+    # of each column of the day series, and are written back to the day
+    # series (see setDaySeriesEstimates) when they are done
+    days = {}
+    for col in cDF.columns:
+        if col in ["est.type", "est.timezone", "est.timeProcessing",
+                   "est.annotations"]:
+            days[col] = np.array(cDF[col].values, dtype=object)
+        else:
+            days[col] = cDF[col].values.copy()
+
+    return days
+
+
+def setDaySeriesEstimates(cDF, days):
+    for col in ["est.type", "est.gapSize", "est.timezoneOffset",
+                "est.annotations", "est.timezone", "est.timeProcessing"]:
+        cDF[col] = days[col]
+
+    return cDF
+
+
+def estimateTzAndTzoWithDeviceRecords(days):
+
+    # 2A. use the TZO of the pump or cgm device if it exists on a given day. In
+    # addition, compare the TZO to one of the imputed day series (i.e., the
+    # upload and home series to see if the TZ can be inferred)
+    for deviceType in ["pump", "cgm"]:
+        # find the indices of days where a TZO estimate has not been made AND
+        # where the device (e.g., pump or cgm) TZO has data
+        sIndices = np.flatnonzero(
+            (pd.isnull(days["est.timezoneOffset"])) &
+            (pd.notnull(days[deviceType + ".timezoneOffset"])))
+        # compare the device TZO to the imputed series to infer time zone
+        days = compareDeviceTzoToImputedSeries(days, sIndices, deviceType)
+
+    # 2B. if the TZ cannot be inferred with 2A, then see if the TZ can be
+    # inferred from the previous day's TZO. If the device TZO is equal to the
+    # previous day's TZO, AND if the previous day has a TZ estimate, use the
+    # previous day's TZ estimate for the current day's TZ estimate
+    for deviceType in ["pump", "cgm"]:
+        sIndices = np.flatnonzero(
+            (pd.isnull(days["est.timezoneOffset"])) &
+            (pd.notnull(days[deviceType + ".timezoneOffset"])))
+
+        days = compareDeviceTzoToPrevDayTzo(days, sIndices, deviceType)
+
+    # 2C. after 2A and 2B, check the DEVICE estimates to make sure that the
+    # pump and cgm tzo do not differ by more than 60 minutes. If they differ
+    # by more that 60 minutes, then mark the estimate as UNCERTAIN. Also, we
+    # allow the estimates to be off by 60 minutes as there are a lot of cases
+    # where the devices are off because the user changes the time for DST,
+    # at different times
+    pumpTzo = days["pump.timezoneOffset"]
+    cgmTzo = days["cgm.timezoneOffset"]
+    tzoDiffGT60 = ((days["est.type"] == "DEVICE") &
+                   (pd.notnull(pumpTzo)) &
+                   (pd.notnull(cgmTzo)) &
+                   (abs(cgmTzo - pumpTzo) > 60))
+
+    idx = np.flatnonzero(tzoDiffGT60)
+
+    days["est.type"][idx] = "UNCERTAIN"
+    days = addAnnotation(days, idx, "pump-cgm-tzo-mismatch")
+
+    return days
+
+
+def getMostFrequentTimezone(timezones):
+    # the most frequent timezone, counted on the categorical codes. Ties go
+    # to the timezone that comes first, like describe()["top"] of the
+    # timezone strings
+    timezones = timezones.astype("category")
+    codes = timezones.cat.codes.values
+    codes = codes[codes >= 0]
+    if len(codes) == 0:
+        return np.nan
+
+    counts = np.bincount(codes)
+    firstSeen = pd.unique(codes)
+    top = firstSeen[counts[firstSeen] == counts.max()][0]
+
+    return timezones.cat.categories[top]
+
+
+def addHomeTimezone(df, contDays):
+
+    if "timezone" in df:
+        homeTimezone = getMostFrequentTimezone(df["timezone"])
+        tzo = getTimezoneOffsets(contDays.date, homeTimezone)
+
+        contDays["home.imputed.timezoneOffset"] = tzo
+        contDays["home.imputed.timezone"] = homeTimezone
+
+    else:
+        contDays["home.imputed.timezoneOffset"] = np.nan
+        contDays["home.imputed.timezone"] = np.nan
+    contDays["home.imputed.timeProcessing"] = np.nan
+
+    return contDays
+
+
+@functools.lru_cache(maxsize=None)
+def getRangeOfTZOsForTimezone(tz):
+    minMaxTzo = [getTimezoneOffset(pd.to_datetime("1/1/2017"), tz),
+                 getTimezoneOffset(pd.to_datetime("5/1/2017"), tz)]
+
+    rangeOfTzo = np.arange(int(min(minMaxTzo)), int(max(minMaxTzo))+1, 15)
+
+    return rangeOfTzo
+
+
+def tzoRangeWithComparisonTz(days, i, comparisonTz):
+    # if we have a previous timezone estimate, then calcuate the range of
+    # timezone offset values for that time zone
+    if pd.notnull(comparisonTz):
+        rangeTzos = getRangeOfTZOsForTimezone(comparisonTz)
+    else:
+        comparisonTz = np.nan
+        rangeTzos = np.array([])
+
+    return rangeTzos
+
+
+def tzAndTzoRangePreviousDay(days, i):
+    # if we have a previous timezone estimate, then calcuate the range of
+    # timezone offset values for that time zone
+    comparisonTz = days["est.timezone"][i-1]
+
+    rangeTzos = tzoRangeWithComparisonTz(days, i, comparisonTz)
+
+    return comparisonTz, rangeTzos
+
+
+def tzAndTzoRangeWithHomeTz(days, i):
+    # if we have a previous timezone estimate, then calcuate the range of
+    # timezone offset values for that time zone
+    comparisonTz = days["home.imputed.timezone"][i]
+
+    rangeTzos = tzoRangeWithComparisonTz(days, i, comparisonTz)
+
+    return comparisonTz, rangeTzos
+
+
+def assignTzoFromImputedSeries(days, i, imputedSeries):
+    days["est.type"][i] = "DEVICE"
+
+    days["est.timezoneOffset"][i] = \
+        days[imputedSeries + ".timezoneOffset"][i]
+
+    days["est.timezone"][i] = \
+        days[imputedSeries + ".timezone"][i]
+
+    days["est.timeProcessing"][i] = \
+        days[imputedSeries + ".timeProcessing"][i]
+
+    return days
+
+
+def compareDeviceTzoToImputedSeries(days, sIdx, device):
+    for i in sIdx:
+        # if the device tzo = imputed tzo, then chose the imputed tz and tzo
+        # note, dst is accounted for in the imputed tzo
+        for imputedSeries in ["pump.upload.imputed", "cgm.upload.imputed",
+                              "healthkit.upload.imputed", "home.imputed"]:
+            # if the estimate has not already been made
+            if pd.isnull(days["est.timezone"][i]):
+
+                if days[device + ".timezoneOffset"][i] == \
+                  days[imputedSeries + ".timezoneOffset"][i]:
+
+                    assignTzoFromImputedSeries(days, i, imputedSeries)
+
+                    days = addAnnotation(days, i,
+                                         "tz-inferred-from-" + imputedSeries)
+
+                # if the imputed series has a timezone estimate, then see if
+                # the current day is a dst change day
+                elif (pd.notnull(days[imputedSeries + ".timezone"][i])):
+                    imputedTimezone = days[imputedSeries + ".timezone"][i]
+                    if isDSTChangeDay(days["date"][i], imputedTimezone):
+
+                        dstRange = getRangeOfTZOsForTimezone(imputedTimezone)
+                        if ((days[device + ".timezoneOffset"][i] in dstRange)
+                          & (days[imputedSeries + ".timezoneOffset"][i] in dstRange)):
+
+                            assignTzoFromImputedSeries(days, i, imputedSeries)
+
+                            days = addAnnotation(days, i, "dst-change-day")
+                            days = addAnnotation(
+                                    days, i, "tz-inferred-from-" + imputedSeries)
+
+    return days
+
+
+def assignTzoFromPreviousDay(days, i, previousDayTz):
+
+    days["est.type"][i] = "DEVICE"
+    days["est.timezone"][i] = previousDayTz
+    days["est.timezoneOffset"][i] = \
+        getTimezoneOffset(pd.to_datetime(days["date"][i]), previousDayTz)
+
+    days["est.timeProcessing"][i] = days["est.timeProcessing"][i-1]
+    days = addAnnotation(days, i, "tz-inferred-from-prev-day")
+
+    return days
+
+
+def assignTzoFromDeviceTzo(days, i, device):
+
+    days["est.type"][i] = "DEVICE"
+    days["est.timezoneOffset"][i] = \
+        days[device + ".timezoneOffset"][i]
+    days["est.timeProcessing"][i] = \
+        days[device + ".upload.imputed.timeProcessing"][i]
+
+    days = addAnnotation(days, i, "likely-travel")
+    days = addAnnotation(days, i, "tzo-from-" + device)
+
+    return days
+
+
+def compareDeviceTzoToPrevDayTzo(days, sIdx, device):
+
+    deviceTzo = days[device + ".timezoneOffset"]
+    estTzo = days["est.timezoneOffset"]
+    homeTzo = days["home.imputed.timezoneOffset"]
+
+    for i in sIdx[sIdx > 0]:
+
+        # first see if the previous record has a tzo
+        if (pd.notnull(estTzo[i-1])):
+
+            previousDayTz, dstRange = tzAndTzoRangePreviousDay(days, i)
+            timeDiff = abs(deviceTzo[i] - estTzo[i-1])
+
+            # next see if the previous record has a tz
+            if (pd.notnull(days["est.timezone"][i-1])):
+
+                if timeDiff == 0:
+                    assignTzoFromPreviousDay(days, i, previousDayTz)
+
+                # see if the previous day's tzo and device tzo are within the
+                # dst range (as that is a common problem with this data)
+                elif ((deviceTzo[i] in dstRange)
+                      & (estTzo[i-1] in dstRange)):
+
+                    # then see if it is DST change day
+                    if isDSTChangeDay(days["date"][i], previousDayTz):
+
+                        days = addAnnotation(days, i, "dst-change-day")
+                        assignTzoFromPreviousDay(days, i, previousDayTz)
+
+                    # if it is not DST change day, then mark this as uncertain
+                    else:
+                        # also, check to see if the difference between device.
+                        # tzo and prev.tzo is less than the expected dst
+                        # difference. There is a known issue where the BtUTC
+                        # procedure puts clock drift into the device.tzo,
+                        # and as a result the tzo can be off by 15, 30,
+                        # or 45 minutes.
+                        if (((deviceTzo[i] == min(dstRange)) |
+                            (deviceTzo[i] == max(dstRange))) &
+                           ((estTzo[i-1] == min(dstRange)) |
+                            (estTzo[i-1] == max(dstRange)))):
+
+                            days["est.type"][i] = "UNCERTAIN"
+                            days = addAnnotation(days, i,
+                                                 "likely-dst-error-OR-travel")
+
+                        else:
+
+                            days["est.type"][i] = "UNCERTAIN"
+                            days = addAnnotation(days, i,
+                                                 "likely-15-min-dst-error")
+
+                # next see if time difference between device.tzo and prev.tzo
+                # is off by 720 minutes, which is indicative of a common
+                # user AM/PM error
+                elif timeDiff == 720:
+                    days["est.type"][i] = "UNCERTAIN"
+                    days = addAnnotation(days, i, "likely-AM-PM-error")
+
+                # if it doesn't fall into any of these cases, then the
+                # tzo difference is likely due to travel
+                else:
+                    days = assignTzoFromDeviceTzo(days, i, device)
+
+            elif timeDiff == 0:
+                days = assignTzoFromDeviceTzo(days, i, device)
+
+        # if there is no previous record to compare with check for dst errors,
+        # and if there are no errors, it is likely a travel day
+        else:
+
+            comparisonTz, dstRange = tzAndTzoRangeWithHomeTz(days, i)
+            timeDiff = abs(deviceTzo[i] - homeTzo[i])
+
+            if ((deviceTzo[i] in dstRange)
+               & (homeTzo[i] in dstRange)):
+
+                # see if it is DST change day
+                if isDSTChangeDay(days["date"][i], comparisonTz):
+
+                    days = addAnnotation(days, i, "dst-change-day")
+                    days["est.type"][i] = "DEVICE"
+                    days["est.timezoneOffset"][i] = deviceTzo[i]
+                    days["est.timezone"][i] = \
+                        days["home.imputed.timezone"][i]
+                    days["est.timeProcessing"][i] = \
+                        days[device + ".upload.imputed.timeProcessing"][i]
+
+                # if it is not DST change day, then mark this as uncertain
+                else:
+                    # also, check to see if the difference between device.
+                    # tzo and prev.tzo is less than the expected dst
+                    # difference. There is a known issue where the BtUTC
+                    # procedure puts clock drift into the device.tzo,
+                    # and as a result the tzo can be off by 15, 30,
+                    # or 45 minutes.
+                    if (((deviceTzo[i] == min(dstRange)) |
+                        (deviceTzo[i] == max(dstRange))) &
+                       ((homeTzo[i] == min(dstRange)) |
+                        (homeTzo[i] == max(dstRange)))):
+
+                        days["est.type"][i] = "UNCERTAIN"
+                        days = addAnnotation(days, i,
+                                             "likely-dst-error-OR-travel")
+
+                    else:
+
+                        days["est.type"][i] = "UNCERTAIN"
+                        days = addAnnotation(days, i,
+                                             "likely-15-min-dst-error")
+
+            # next see if time difference between device.tzo and prev.tzo
+            # is off by 720 minutes, which is indicative of a common
+            # user AM/PM error
+            elif timeDiff == 720:
+                days["est.type"][i] = "UNCERTAIN"
+                days = addAnnotation(days, i, "likely-AM-PM-error")
+
+            # if it doesn't fall into any of these cases, then the
+            # tzo difference is likely due to travel
+
+            else:
+                days = assignTzoFromDeviceTzo(days, i, device)
+
+    return days
+
+
+def getGaps(isMissing):
+    # run length encoding of the days without an estimate, returns the first
+    # day of each gap and the first day with an estimate after the gap
+    isMissing = np.concatenate([[False], isMissing, [False]])
+    gapEdges = np.flatnonzero(np.diff(isMissing.astype(int)))
+
+    return gapEdges[::2], gapEdges[1::2]
+
+
+def imputeByTimezone(days, currentDay, prevDaywData, nextDaywData):
+
+    gapSize = (nextDaywData - currentDay)
+    gap = np.arange(currentDay, nextDaywData)
+
+    if prevDaywData >= 0:
+
+        if days["est.timezone"][prevDaywData] == \
+          days["est.timezone"][nextDaywData]:
+
+            tz = days["est.timezone"][prevDaywData]
+
+            days["est.timezone"][gap] = tz
+
+            days["est.timezoneOffset"][gap] = \
+                getTimezoneOffsets(days["date"][gap], tz)
+
+            days["est.type"][gap] = "IMPUTE"
+
+            days = addAnnotation(days, gap, "gap=" + str(gapSize))
+            days["est.gapSize"][gap] = gapSize
+
+        # TODO: this logic should be updated to handle the edge case
+        # where the day before and after the gap have differing TZ, but
+        # the same TZO. In that case the gap should be marked as UNCERTAIN
+        elif days["est.timezoneOffset"][prevDaywData] == \
+          days["est.timezoneOffset"][nextDaywData]:
+
+            days["est.timezoneOffset"][gap] = \
+                days["est.timezoneOffset"][prevDaywData]
+
+            days["est.type"][gap] = "IMPUTE"
+
+            days = addAnnotation(days, gap, "gap=" + str(gapSize))
+            days["est.gapSize"][gap] = gapSize
+
+        else:
+            days["est.type"][gap] = "UNCERTAIN"
+            days = addAnnotation(days, gap, "unable-to-impute-tzo")
+
+    else:
+        days["est.type"][gap] = "UNCERTAIN"
+        days = addAnnotation(days, gap, "unable-to-impute-tzo")
+
+    return days
+
+
+def imputeTzAndTzo(days):
+
+    nDays = len(days["date"])
+    isMissing = pd.isnull(days["est.timezoneOffset"])
+    if isMissing.all():
+        days["est.type"][:] = "UNCERTAIN"
+        days["est.annotations"][:] = "unable-to-impute-tzo"
+
+        return days
+
+    # the gaps only depend on the days before and after them, so they are
+    # all found at once
+    gapStarts, gapEnds = getGaps(isMissing)
+    for currentDay, nextDayIdx in zip(gapStarts, gapEnds):
+
+        if nextDayIdx < nDays:
+            days = imputeByTimezone(days, currentDay,
+                                    currentDay - 1, nextDayIdx)
+
+        # try to impute to the last day (earliest day) in the dataset
+        # if the last record has a timezone that is the home record, then
+        # impute using the home timezone
+        else:
+            prevDayWithDay = currentDay - 1
+            gapSize = nDays - 1 - currentDay
+            gap = np.arange(currentDay, nDays)
+
+            if days["est.timezoneOffset"][prevDayWithDay] == \
+              days["home.imputed.timezoneOffset"][prevDayWithDay]:
+
+                days["est.type"][gap] = "IMPUTE"
+
+                days["est.timezoneOffset"][gap] = \
+                    days["home.imputed.timezoneOffset"][gap]
+
+                days["est.timezone"][gap] = \
+                    days["home.imputed.timezone"][gap]
+
+                days = addAnnotation(days, gap, "gap=" + str(gapSize))
+                days["est.gapSize"][gap] = gapSize
+
+            else:
+                days["est.type"][gap] = "UNCERTAIN"
+                days = addAnnotation(days, gap, "unable-to-impute-tzo")
+
+    return days
+
+
+def reorderColumns(cDF):
+    cDF = cDF[["pump.upload.imputed.timezoneOffset",
+               "pump.upload.imputed.timezone",
+               "pump.upload.imputed.timeProcessing",
+               "cgm.upload.imputed.timezoneOffset",
+               "cgm.upload.imputed.timezone",
+               "cgm.upload.imputed.timeProcessing",
+               "healthkit.upload.imputed.timezoneOffset",
+               "healthkit.upload.imputed.timezone",
+               "healthkit.upload.imputed.timeProcessing",
+               "home.imputed.timezoneOffset",
+               "home.imputed.timezone",
+               "home.imputed.timeProcessing",
+               "upload.timezoneOffset",
+               "upload.timezone",
+               "upload.timeProcessing",
+               "cgm.timezoneOffset",
+               "pump.timezoneOffset",
+               "date",
+               "est.type",
+               "est.timezoneOffset",
+               "est.timezone",
+               "est.timeProcessing",
+               "est.annotations",
+               "est.gapSize",
+               "est.version"]]
+    return cDF
+
+
+def readXlsxData(xlsxPathAndFileName):
+    # load xlsx
+    df = pd.read_excel(xlsxPathAndFileName, sheet_name=None, ignore_index=True)
+    cdf = pd.concat(df.values(), ignore_index=True)
+    cdf = cdf.set_index('jsonRowIndex')
+
+    return cdf
+
+
+def checkInputFile(inputFile):
+    if os.path.isfile(inputFile):
+        if os.stat(inputFile).st_size > 1000:
+            if inputFile[-4:] == "json":
+                inputData = pd.read_json(inputFile, orient="records")
+                fileName = os.path.split(inputFile)[-1][:-5]
+            elif inputFile[-4:] == "xlsx":
+                inputData = readXlsxData(inputFile)
+                fileName = os.path.split(inputFile)[-1][:-5]
+            elif inputFile[-3:] == "csv":
+                inputData = pd.read_csv(inputFile, low_memory=False)
+                fileName = os.path.split(inputFile)[-1][:-4]
+            else:
+                sys.exit("{0} is not a json, xlsx, or csv".format(inputFile))
+        else:
+            sys.exit("{0} contains too little data".format(inputFile))
+    else:
+        sys.exit("{0} does not exist".format(inputFile))
+
+    return inputData, fileName
+
+
+def getListOfDSTChangeDays(cDF):
+
+    # get a list of DST change days for the home time zone
+    dstChangeDays = \
+        cDF[abs(cDF["home.imputed.timezoneOffset"] -
+                cDF["home.imputed.timezoneOffset"].shift(-1)) > 0].date
+
+    return dstChangeDays
+
+
+def correctEstimatesAroundDst(df, cDF):
+
+    # get a list of DST change days for the home time zone
+    dstChangeDays = getListOfDSTChangeDays(cDF)
+
+    # get the data within 2 days of a daylight savings time change
+    dstDays = set()
+    for d in dstChangeDays:
+        dstDays.update([d + timedelta(days=-1), d, d + timedelta(days=1)])
+    isDstData = ((df.date.isin(dstDays)) & (df["est.timezone"].notnull()))
+
+    # the offset of each time zone at the exact time of the data, which is
+    # the offset of the utc time shifted to the time zone's standard time
+    utcTime = df.loc[isDstData, "utcTime"]
+    if utcTime.dt.tz is not None:
+        utcTime = utcTime.dt.tz_localize(None)
+    for tz, tzIndex in utcTime.groupby(df.loc[isDstData, "est.timezone"],
+                                       observed=True).groups.items():
+        tzRange = getRangeOfTZOsForTimezone(tz)
+        standardTime = \
+            utcTime[tzIndex] + pd.to_timedelta(min(tzRange), unit="m")
+        tzo = td.tz.get_timezone_offsets(standardTime, tz)
+
+        df.loc[tzIndex, "est.localTime"] = \
+            df.loc[tzIndex, "utcTime"] + pd.to_timedelta(tzo, unit="m")
+        df.loc[tzIndex, "est.timezoneOffset"] = tzo
+
+    return df
+
+
+def applyLocalTimeEstimates(df, cDF):
+    df = pd.merge(df, cDF, how="left", on="date")
+    df["est.localTime"] = \
+        df["utcTime"] + pd.to_timedelta(df["est.timezoneOffset"], unit="m")
+
+    return df
+
+
+def addStageDuration(stats, stage, stageStartTime):
+    # add the duration of a stage to the stats (if any), and return the
+    # start time of the next stage
+    if stats is not None:
+        stats[stage + "Seconds"] = round(time.time() - stageStartTime, 3)
+
+    return time.time()
+
+
+def load_timezone_aliases(timezoneAliasesFilePathAndName,
+                          cacheFilePathAndName=None):
+    '''
+    load the deprecated timezone list as a map from deprecated timezone to
+    its alias. If a cache file is given, the map is saved to (and then
+    loaded from) that json file, until the timezone list changes
+    '''
+    if not os.path.isfile(timezoneAliasesFilePathAndName):
+        sys.exit("{0} is not a valid file".format(
+                timezoneAliasesFilePathAndName))
+
+    if ((cacheFilePathAndName is not None) and
+            os.path.isfile(cacheFilePathAndName) and
+            (os.path.getmtime(cacheFilePathAndName) >=
+             os.path.getmtime(timezoneAliasesFilePathAndName))):
+        with open(cacheFilePathAndName, "r") as cacheFile:
+            return json.load(cacheFile)
+
+    timezoneAliases = getTimezoneAliasMap(
+        pd.read_csv(timezoneAliasesFilePathAndName, low_memory=False)
+    )
+
+    if cacheFilePathAndName is not None:
+        # write to a temporary file first, so the cache is never half written
+        tempFilePathAndName = cacheFilePathAndName + ".tmp" + str(os.getpid())
+        with open(tempFilePathAndName, "w") as cacheFile:
+            json.dump(timezoneAliases, cacheFile)
+        os.replace(tempFilePathAndName, cacheFilePathAndName)
+
+    return timezoneAliases
+
+
+# %% START OF CODE
+def estimate_local_time(data, timezoneAliases, startDate, endDate,
+                        stats=None):
+    '''
+    estimate the local time of each data point of a single dataset
+    INPUTS:
+        * data is a dataframe of tidepool data (e.g., from checkInputFile)
+        * timezoneAliases is the deprecated timezone to alias map (see
+          load_timezone_aliases)
+        * startDate and endDate (YYYY-MM-DD) filter the data
+        * stats (optional) is a dictionary that the number of large timezone
+          offset corrections (nTimezoneOffsetCorrections) and the duration
+          of each stage (e.g., preprocessSeconds) are added to
+    OUTPUTS:
+        * data with the est.* local time estimates
+        * contiguous day series with the timezone and timezone offset
+          estimates of each day
+    '''
+
+    stageStartTime = time.time()
+
+    # %% PREPROCESS DATA: FILTER, CLEAN, & CORRECT DATA
+    # get rid of data that does not have a UTC time
+    data = data[data.time.notnull()]
+
+    # get rid of data that does not fall within a valid date range
+    data = filterByDates(data, startDate, endDate)
+
+    # convert deprecated timezones to their aliases
+    data = convertDeprecatedTimezoneToAlias(data, timezoneAliases)
+
+    # apply the large timezone offset correction (AKA Darin's fix)
+    data, nCorrected = largeTimezoneOffsetCorrection(data)
+    if stats is not None:
+        stats["nTimezoneOffsetCorrections"] = nCorrected
+    stageStartTime = addStageDuration(stats, "preprocess", stageStartTime)
+
+    # %% PREPROCESS DATA: CREATE "DAY" SERIES (cDays)
+    # create a continguous-day-series that spans the data date-range
+    data["utcTime"] = pd.to_datetime(data.time)
+    data["date"] = data["utcTime"].dt.date
+    contiguousDays = createContiguousDaySeries(data)
+
+    # create day series for the upload records, cgm data, and pump data
+    uploadData = getAndPreprocessUploadRecords(data)
+    cgmData = getAndPreprocessNonDexApiCgmRecords(data)
+    pumpData = data[(data.type == "bolus") & (data.timezoneOffset.notnull())]
+    cDays = addDeviceDaySeries(uploadData, cgmData, pumpData, contiguousDays)
+
+    # interpolate between upload records of the same deviceType, and create a
+    # day series for interpolated pump, non-hk-cgm, and healthkit uploads
+    for deviceType in ["pump", "cgm", "healthkit"]:
+        cDays = imputeUploadRecords(cDays, deviceType + ".upload.imputed")
+
+    # add a home timezone that also accounts for daylight savings time changes
+    cDays = addHomeTimezone(data, cDays)
+    stageStartTime = addStageDuration(stats, "daySeries", stageStartTime)
+
+    # %% ESTIMATE TIMEZONE OFFSET & TIMEZONE (IF POSSIBLE)
+    # There are 3 methods at work here:
+    # 1. Use upload records to estimate the TZ and TZO
+    # 2. Use device timezone offsets (TZO) to estimate TZO
+    # 3. Impute the TZ and TZO using the results from methods 1 and 2
+
+    # 1. USE UPLOAD RECORDS TO ESTIMATE TZ AND TZO
+    cDays = estimateTzAndTzoWithUploadRecords(cDays)
+
+    # the day by day estimates of methods 2 and 3 are made on numpy arrays
+    days = getDaySeriesArrays(cDays)
+
+    # 2. USE DEVICE TZOs TO ESTIMATE TZO AND TZ (IF POSSIBLE)
+    # estimates can be made from pump and cgm data that have a TZO
+    # NOTE: the healthkit and dexcom-api cgm data are excluded
+    days = estimateTzAndTzoWithDeviceRecords(days)
+    stageStartTime = addStageDuration(stats, "estimation", stageStartTime)
+
+    # 3. impute, infer, or interpolate gaps in the estimated tzo and tz
+    days = imputeTzAndTzo(days)
+
+    cDays = setDaySeriesEstimates(cDays, days)
+    stageStartTime = addStageDuration(stats, "imputation", stageStartTime)
+
+    # %% APPLY LOCAL TIME ESTIMATES TO ALL DATA
+    # postprocess TZ and TZO day estiamte data
+    cDays["est.version"] = codeVersion
+    # reorder columns
+    cDays = reorderColumns(cDays)
+    # keep the estimated timezones as a categorical, like the data timezones
+    cDays["est.timezone"] = cDays["est.timezone"].astype("category")
+
+    data = applyLocalTimeEstimates(data, cDays)
+    stageStartTime = addStageDuration(stats, "apply", stageStartTime)
+
+    # correct the local time of the data around dst changes
+    data = correctEstimatesAroundDst(data, cDays)
+    addStageDuration(stats, "dstCorrection", stageStartTime)
+
+    return data, cDays
+
+
+def save_local_time_estimates(data, cDays, fileName, outputPath,
+                              daySeriesOutputPath=None):
+    data.to_csv(os.path.join(outputPath, fileName + ".csv"))
+
+    # save the day series data
+    if "PHI" in fileName:
+        daySeriesFileName = fileName[4:]
+    else:
+        daySeriesFileName = fileName
+    if pd.notnull(daySeriesOutputPath):
+        cDays.to_csv(os.path.join(daySeriesOutputPath,
+                                  daySeriesFileName + "-daySeries.csv"))
+
+    return
@@ -13,49 +13,61 @@ import pandas as pd
 import datetime as dt
 import os
 import sys
-import requests
 import json
 import argparse
-envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-if envPath not in sys.path:
-    sys.path.insert(0, envPath)
-import environmentalVariables
+from tidepool_client import TidepoolClient, API_URL
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
-codeDescription = "accepts new donors (shares) and return a list of userids"
-parser = argparse.ArgumentParser(description=codeDescription)
-
-parser.add_argument(
-    "-d",
-    "--date-stamp",
-    dest="date_stamp",
-    default=dt.datetime.now().strftime("%Y-%m-%d"),
-    help="date, in '%Y-%m-%d' format, of the date when " +
-    "donors were accepted"
-)
-
-parser.add_argument(
-    "-o",
-    "--output-data-path",
-    dest="data_path",
-    default=os.path.abspath(
-        os.path.join(
-            os.path.dirname(__file__), "..", "data"
-        )
-    ),
-    help="the output path where the data is stored"
-)
+def get_args():
+    codeDescription = "accepts new donors (shares) and return a list of userids"
+    parser = argparse.ArgumentParser(description=codeDescription)
+
+    parser.add_argument(
+        "-d",
+        "--date-stamp",
+        dest="date_stamp",
+        default=dt.datetime.now().strftime("%Y-%m-%d"),
+        help="date, in '%Y-%m-%d' format, of the date when " +
+        "donors were accepted"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-data-path",
+        dest="data_path",
+        default=os.path.abspath(
+            os.path.join(
+                os.path.dirname(__file__), "..", "data"
+            )
+        ),
+        help="the output path where the data is stored"
+    )
+
+    parser.add_argument(
+        "-s",
+        "--save-donor-list",
+        dest="save_donor_list",
+        default=True,
+        help="specify if you want to save the donor list (True/False)"
+    )
+
+    parser.add_argument(
+        "--api-url",
+        dest="api_url",
+        default=API_URL,
+        help="base url of the tidepool api"
+    )
 
-parser.add_argument(
-    "-s",
-    "--save-donor-list",
-    dest="save_donor_list",
-    default=True,
-    help="specify if you want to save the donor list (True/False)"
-)
+    return parser.parse_args()
 
-args = parser.parse_args()
+
+# define the donor groups
+DONOR_GROUPS = [
+    "bigdata", "AADE", "BT1", "carbdm", "CDN",
+    "CWD", "DHF", "DIATRIBE", "diabetessisters",
+    "DYF", "JDRF", "NSF", "T1DX",
+]
 
 
 # %% FUNCTIONS
@@ -69,46 +81,10 @@ def make_folder_if_doesnt_exist(folder_paths):
     return
 
 
-def login_api(auth):
-    api_call = "https://api.tidepool.org/auth/login"
-    api_response = requests.post(api_call, auth=auth)
-    if(api_response.ok):
-        xtoken = api_response.headers["x-tidepool-session-token"]
-        userid = json.loads(api_response.content.decode())["userid"]
-        headers = {
-            "x-tidepool-session-token": xtoken,
-            "Content-Type": "application/json"
-        }
-
-    else:
-        sys.exit("Error with " + auth[0] + ":" + str(api_response.status_code))
-
-    print("logging into", auth[0], "...")
-
-    return headers, userid
-
-
-def logout_api(auth):
-    api_call = "https://api.tidepool.org/auth/logout"
-    api_response = requests.post(api_call, auth=auth)
-
-    if(api_response.ok):
-        print("successfully logged out of", auth[0])
-
-    else:
-        sys.exit(
-            "Error with logging out for " +
-            auth[0] + ":" + str(api_response.status_code)
-        )
-
-    return
-
-
-def accept_invite_api(headers, userid):
+def accept_invite_api(client):
     print("accepting new donors ...")
     nAccepted = 0
-    api_call = "https://api.tidepool.org/confirm/invitations/" + userid
-    api_response = requests.get(api_call, headers=headers)
+    api_response = client.get_invitations()
     if(api_response.ok):
 
         usersData = json.loads(api_response.content.decode())
@@ -116,18 +92,8 @@ def accept_invite_api(headers, userid):
         for i in range(0, len(usersData)):
             shareKey = usersData[i]["key"]
             shareID = usersData[i]["creatorId"]
-            payload = {
-                "key": shareKey
-            }
 
-            api_call2 = "https://api.tidepool.org/confirm/accept/invite/" + \
-                userid + "/" + shareID
-
-            api_response2 = requests.put(
-                api_call2,
-                headers=headers,
-                json=payload
-            )
+            api_response2 = client.accept_invitation(shareID, shareKey)
 
             if(api_response2.ok):
                 nAccepted = nAccepted + 1
@@ -149,10 +115,9 @@ def accept_invite_api(headers, userid):
     return nAccepted
 
 
-def get_donor_list_api(headers, userid):
+def get_donor_list_api(client):
     print("getting donor list ...")
-    api_call = "https://api.tidepool.org/access/groups/" + userid
-    api_response = requests.get(api_call, headers=headers)
+    api_response = client.get_donor_group()
     if(api_response.ok):
         donors_list = json.loads(api_response.content.decode())
     else:
@@ -165,21 +130,23 @@ def get_donor_list_api(headers, userid):
     return df
 
 
-def accept_new_donors_and_get_donor_list(auth):
-    # login
-    headers, userid = login_api(auth)
+def accept_new_donors_and_get_donor_list(client):
     # accept invitations to the master donor account
-    nAccepted = accept_invite_api(headers, userid)
+    nAccepted = accept_invite_api(client)
     # get a list of donors associated with the master account
-    df = get_donor_list_api(headers, userid)
-    # logout
-    logout_api(auth)
+    df = get_donor_list_api(client)
 
     return nAccepted, df
 
 
 # %% START OF CODE
-def accept_and_get_list(args):
+def accept_and_get_list(args, clients=None):
+    '''
+    accept new donors and get the list of donors of all donor groups.
+    clients (optional) is a dictionary of logged in TidepoolClients by donor
+    group, which are left logged in so they can be used to get the donor data.
+    Otherwise each donor group is logged in and out.
+    '''
     # create output folders
     date_stamp = args.date_stamp  # dt.datetime.now().strftime("%Y-%m-%d")
     phi_date_stamp = "PHI-" + date_stamp
@@ -191,13 +158,6 @@ def accept_and_get_list(args):
         phi_date_stamp + "-uniqueDonorList.csv"
     )
 
-    # define the donor groups
-    donor_groups = [
-        "bigdata", "AADE", "BT1", "carbdm", "CDN",
-        "CWD", "DHF", "DIATRIBE", "diabetessisters",
-        "DYF", "JDRF", "NSF", "T1DX",
-    ]
-
     all_donors_df = pd.DataFrame(columns=["userID", "donorGroup"])
 
     # accounts to ignore (QA testing)
@@ -216,15 +176,19 @@ def accept_and_get_list(args):
         'df54366b1c', 'e67aa71493', 'f2103a44d5', 'dccc3baf63'
     ]
 
-    for donor_group in donor_groups:
-        if donor_group == "bigdata":
-            dg = ""
+    for donor_group in DONOR_GROUPS:
+        if clients is not None:
+            nNewDonors, donors_df = accept_new_donors_and_get_donor_list(
+                clients[donor_group]
+            )
         else:
-            dg = donor_group
-
-        nNewDonors, donors_df = accept_new_donors_and_get_donor_list(
-            environmentalVariables.get_environmental_variables(dg)
-        )
+            client = TidepoolClient.from_donor_group(
+                donor_group, api_url=args.api_url
+            )
+            with client:
+                nNewDonors, donors_df = accept_new_donors_and_get_donor_list(
+                    client
+                )
 
         donors_df["donorGroup"] = donor_group
         print(donor_group, "complete, there are %d new donors\n" % nNewDonors)
@@ -264,4 +228,5 @@ def accept_and_get_list(args):
 
 
 if __name__ == "__main__":
+    args = get_args()
     final_donor_list = accept_and_get_list(args)
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""async_fetcher.py
+Downloads the metadata and datasets of many donors at once with asyncio.
+
+The donors are downloaded concurrently, limited by a global concurrency limit
+and a per-host rate limit. No more than max_donors donors are in progress at
+once, and each of them has no more than a few of its yearly data windows in
+flight (or waiting to be written) at once, so the memory and open files of a
+large batch stay bounded. Failed requests are retried with jittered
+exponential backoff. The data windows are parsed as they download (with
+ijson) and written to the donor's storage sink in batches, in order (newest
+first, like get_data): the oldest window in flight is written as it streams,
+the windows after it are held until it is done. A donor's sink is created
+when its first window arrives.
+"""
+
+# %% REQUIRED LIBRARIES
+import os
+import sys
+import json
+import time
+import base64
+import traceback
+import random
+import asyncio
+import itertools
+import collections
+import aiohttp
+import ijson
+from urllib.parse import urlparse
+envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if envPath not in sys.path:
+    sys.path.insert(0, envPath)
+import donor_data_store
+from tidepool_client import get_data_path
+from get_single_tidepool_dataset import (
+    get_data_windows, format_data_window, make_folder_if_doesnt_exist,
+    STREAM_BATCH_SIZE
+)
+from get_single_donor_metadata import profile_to_metadata
+
+
+# %% DEFAULTS
+MAX_CONCURRENCY = 20
+MAX_DONORS = 20
+MAX_WINDOWS_PER_DONOR = 4
+REQUESTS_PER_SECOND = 10
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 0.5
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+STAGES = ["metadata", "dataset"]
+
+
+# %% FUNCTIONS
+class RateLimiter:
+    '''
+    spaces out the start of requests so there are no more than
+    requests_per_second (None for no limit)
+    '''
+    def __init__(self, requests_per_second):
+        if requests_per_second:
+            self.interval = 1 / requests_per_second
+        else:
+            self.interval = 0
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if self.interval == 0:
+            return
+
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            now = loop.time()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+class FetchError(Exception):
+    pass
+
+
+class AsyncFetcher:
+    '''
+    INPUTS:
+        * session_infos is a dictionary of TidepoolClient.session_info()
+          by donor group, the token of each donor group is reused and
+          refreshed if it expires
+        * max_concurrency is the number of requests in flight at once
+        * max_windows_per_donor is the number of data windows of each donor
+          that are in flight or waiting to be written at once
+        * requests_per_second is the rate limit of each host
+        * max_retries and backoff_seconds control the retries of failed
+          requests, the n-th retry waits a random time between 0 and
+          backoff_seconds * 2**n seconds
+        * batch_size is the number of records of a data window that are
+          written to the sink at a time
+    '''
+    def __init__(
+        self,
+        session_infos,
+        max_concurrency=MAX_CONCURRENCY,
+        requests_per_second=REQUESTS_PER_SECOND,
+        max_retries=MAX_RETRIES,
+        backoff_seconds=BACKOFF_SECONDS,
+        max_windows_per_donor=MAX_WINDOWS_PER_DONOR,
+        batch_size=STREAM_BATCH_SIZE
+    ):
+        self.session_infos = {
+            dg: dict(info) for dg, info in session_infos.items()
+        }
+        self.max_concurrency = max_concurrency
+        self.max_windows_per_donor = max_windows_per_donor
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.batch_size = batch_size
+        self.nRequests = 0
+        self.nRetries = 0
+
+    async def __aenter__(self):
+        # asyncio objects are created here, inside the running event loop
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.rate_limiters = {}
+        self.login_locks = {dg: asyncio.Lock() for dg in self.session_infos}
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            headers={"Content-Type": "application/json"}
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+
+    def get_rate_limiter(self, url):
+        host = urlparse(url).netloc
+        if host not in self.rate_limiters:
+            self.rate_limiters[host] = RateLimiter(self.requests_per_second)
+
+        return self.rate_limiters[host]
+
+    async def login(self, donor_group, expired_token=None):
+        session_info = self.session_infos[donor_group]
+        async with self.login_locks[donor_group]:
+            # another request may have already logged in again
+            if (
+                (session_info["token"] is not None)
+                and (session_info["token"] != expired_token)
+            ):
+                return session_info["token"]
+
+            email, password = session_info["auth"]
+            basic_auth = base64.b64encode(
+                (email + ":" + password).encode()
+            ).decode()
+            async with self.session.post(
+                session_info["api_url"] + "/auth/login",
+                headers={"Authorization": "Basic " + basic_auth}
+            ) as api_response:
+                if api_response.status != 200:
+                    raise FetchError(
+                        "Error with " + email + ":" + str(api_response.status)
+                    )
+                session_info["token"] = \
+                    api_response.headers["x-tidepool-session-token"]
+                session_info["userid"] = \
+                    json.loads(await api_response.read())["userid"]
+
+        return session_info["token"]
+
+    async def request(self, donor_group, path, read_response):
+        '''
+        get an api path, with the concurrency and rate limits, retrying
+        failed requests and logging in again on a 401. read_response is a
+        coroutine function that reads the (successful) response.
+        '''
+        session_info = self.session_infos[donor_group]
+        url = session_info["api_url"] + path
+        token = session_info["token"]
+        if token is None:
+            token = await self.login(donor_group)
+
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.nRetries = self.nRetries + 1
+                await asyncio.sleep(
+                    random.uniform(0, self.backoff_seconds * 2**(attempt - 1))
+                )
+
+            await self.get_rate_limiter(url).wait()
+            try:
+                async with self.semaphore:
+                    self.nRequests = self.nRequests + 1
+                    async with self.session.get(
+                        url,
+                        headers={"x-tidepool-session-token": token}
+                    ) as api_response:
+                        status = api_response.status
+                        if status == 200:
+                            return await read_response(api_response)
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = repr(e)
+                continue
+
+            if status == 401:
+                token = await self.login(donor_group, expired_token=token)
+            elif status not in RETRY_STATUSES:
+                break
+
+        raise FetchError("ERROR getting %s: %s" % (path, status))
+
+    async def get_json(self, donor_group, path):
+        ''' get the json of an api path '''
+        async def read_json(api_response):
+            return json.loads(await api_response.read())
+
+        return await self.request(donor_group, path, read_json)
+
+    async def stream_json(self, donor_group, path, batches):
+        '''
+        incrementally parse the json array of an api path, and put its
+        records on the batches queue, batch_size at a time, followed by None
+        '''
+        async def read_batches(api_response):
+            nBatches = 0
+            batch = []
+            try:
+                async for record in ijson.items_async(
+                    api_response.content, "item", use_float=True
+                ):
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        batches.put_nowait(batch)
+                        nBatches = nBatches + 1
+                        batch = []
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # the batches that were already handed on cannot be taken
+                # back, so a response that breaks off part way is not retried
+                if nBatches > 0:
+                    raise FetchError(
+                        "ERROR reading %s: %s" % (path, repr(e))
+                    )
+                raise
+
+            if len(batch) > 0:
+                batches.put_nowait(batch)
+
+        try:
+            await self.request(donor_group, path, read_batches)
+        finally:
+            batches.put_nowait(None)
+
+    async def get_metadata(self, userid, donor_group):
+        user_profile = await self.get_json(
+            donor_group, "/metadata/%s/profile" % userid
+        )
+
+        return profile_to_metadata(user_profile, userid)
+
+    async def get_dataset(self, userid, donor_group, make_sink, windows):
+        '''
+        stream the data windows of a donor, no more than
+        max_windows_per_donor at once, and write them to a sink in order.
+        The sink (make_sink()) is created when the first window arrives,
+        and is closed once all windows are written, or aborted if a window
+        fails.
+        '''
+        def request_window(window):
+            path = get_data_path(userid, *format_data_window(*window))
+            batches = asyncio.Queue()
+            task = asyncio.ensure_future(
+                self.stream_json(donor_group, path, batches)
+            )
+            return task, batches
+
+        windows = iter(windows)
+        tasks = collections.deque(
+            request_window(window)
+            for window in itertools.islice(windows, self.max_windows_per_donor)
+        )
+
+        loop = asyncio.get_event_loop()
+        sink = None
+        nRecords = 0
+        try:
+            while len(tasks) > 0:
+                task, batches = tasks[0]
+                batch = await batches.get()
+                if batch is None:
+                    # raise the error of a window that failed before it
+                    # had any records
+                    await task
+                if sink is None:
+                    sink = make_sink()
+                while batch is not None:
+                    # parsing and writing is blocking, keep it off the loop
+                    await loop.run_in_executor(
+                        None, sink.write_records, batch
+                    )
+                    nRecords = nRecords + len(batch)
+                    batch = await batches.get()
+
+                # raise the error of a window that failed
+                await task
+                tasks.popleft()
+                for window in itertools.islice(windows, 1):
+                    tasks.append(request_window(window))
+
+            if sink is None:
+                sink = make_sink()
+            await loop.run_in_executor(None, sink.close)
+            sink = None
+        finally:
+            for task, _ in tasks:
+                task.cancel()
+            # a failed (or cancelled) download leaves the saved donor as it
+            # was, and no open files or temporary folders
+            if sink is not None:
+                sink.abort()
+
+        return nRecords
+
+
+def get_sink(storage_format, data_path, date_stamp, userid):
+    ''' the storage sink of a donor dataset '''
+    phi_date_stamp = "PHI-" + date_stamp
+    donor_folder = os.path.join(data_path, phi_date_stamp + "-donor-data")
+
+    if storage_format == "parquet":
+        parquet_path = donor_data_store.get_parquet_dataset_path(
+            data_path, date_stamp
+        )
+        make_folder_if_doesnt_exist(parquet_path)
+        sink = donor_data_store.DonorParquetWriter(parquet_path, userid)
+
+    elif storage_format == "ndjson":
+        ndjson_path = os.path.join(donor_folder, phi_date_stamp + "-ndjsonData")
+        make_folder_if_doesnt_exist(ndjson_path)
+        sink = donor_data_store.DonorNdjsonWriter(
+            os.path.join(ndjson_path, "PHI-" + userid + ".ndjson")
+        )
+
+    else:
+        csv_path = os.path.join(donor_folder, phi_date_stamp + "-csvData")
+        make_folder_if_doesnt_exist(csv_path)
+        sink = donor_data_store.DonorCsvWriter(
+            os.path.join(csv_path, "PHI-" + userid + ".csv")
+        )
+
+    return sink
+
+
+async def get_donor_data(
+    fetcher, userid, donor_group, date_stamp, data_path,
+    storage_format, windows, stages=STAGES, manifest=None
+):
+    '''
+    get and save the metadata and dataset of a single donor, the stages
+    are recorded in the job manifest if one is given
+    '''
+    phi_date_stamp = "PHI-" + date_stamp
+    donor_folder = os.path.join(data_path, phi_date_stamp + "-donor-data")
+    metadata_path = os.path.join(donor_folder, phi_date_stamp + "-metadata")
+    make_folder_if_doesnt_exist(metadata_path)
+
+    nRecords = 0
+    stage = None
+    try:
+        if "metadata" in stages:
+            stage = "metadata"
+            startTime = time.time()
+            if manifest is not None:
+                manifest.start(stage, userid)
+            meta_df = await fetcher.get_metadata(userid, donor_group)
+            meta_df.to_csv(
+                os.path.join(metadata_path, "PHI-" + userid + ".csv")
+            )
+            if manifest is not None:
+                manifest.finish(
+                    stage, userid, duration=round(time.time() - startTime, 3)
+                )
+
+        if "dataset" in stages:
+            stage = "dataset"
+            startTime = time.time()
+            if manifest is not None:
+                manifest.start(stage, userid)
+            nRecords = await fetcher.get_dataset(
+                userid,
+                donor_group,
+                lambda: get_sink(storage_format, data_path, date_stamp, userid),
+                windows
+            )
+            print("saved %s records for %s" % (nRecords, userid))
+            if manifest is not None:
+                manifest.finish(
+                    stage, userid, duration=round(time.time() - startTime, 3)
+                )
+
+    except Exception as e:
+        # any error (e.g., a parse or write error) only fails this donor,
+        # the other donors keep going
+        print(userid, "failed to get data:", repr(e))
+        if (manifest is not None) and (stage is not None):
+            manifest.fail(
+                stage,
+                userid,
+                traceback.format_exc(),
+                duration=round(time.time() - startTime, 3)
+            )
+        nRecords = None
+
+    return nRecords
+
+
+def get_stages(userid, stages, donor_stages=None):
+    ''' the stages of a donor, which are the same for all donors by default '''
+    if donor_stages is not None:
+        return donor_stages[userid]
+
+    return stages
+
+
+async def get_all_donor_data_async(
+    donors,
+    session_infos,
+    date_stamp,
+    data_path,
+    storage_format="parquet",
+    weeks_of_data=52*10,
+    stages=STAGES,
+    donor_stages=None,
+    manifest=None,
+    max_donors=MAX_DONORS,
+    **fetcher_kwargs
+):
+    windows = get_data_windows(weeks_of_data)
+    donor_queue = asyncio.Queue()
+    for donor in donors:
+        donor_queue.put_nowait(donor)
+
+    results = {}
+
+    async def get_donors(fetcher):
+        # each of the max_donors workers gets one donor at a time
+        while not donor_queue.empty():
+            userid, donor_group = donor_queue.get_nowait()
+            results[userid] = await get_donor_data(
+                fetcher, userid, donor_group, date_stamp, data_path,
+                storage_format, windows,
+                stages=get_stages(userid, stages, donor_stages),
+                manifest=manifest
+            )
+
+    async with AsyncFetcher(session_infos, **fetcher_kwargs) as fetcher:
+        await asyncio.gather(*[
+            get_donors(fetcher) for _ in range(min(max_donors, len(donors)))
+        ])
+
+    return {userid: results[userid] for userid, _ in donors}
+
+
+def get_all_donor_data(
+    donors,
+    session_infos,
+    date_stamp,
+    data_path,
+    storage_format="parquet",
+    weeks_of_data=52*10,
+    stages=STAGES,
+    donor_stages=None,
+    manifest=None,
+    max_donors=MAX_DONORS,
+    **fetcher_kwargs
+):
+    '''
+    get and save the metadata and datasets of many donors concurrently
+    INPUTS:
+        * donors is a list of (userid, donor_group)
+        * session_infos is a dictionary of TidepoolClient.session_info()
+          by donor group
+        * storage_format is one of parquet, ndjson or csv
+        * stages (optional) are the stages to run, metadata and/or dataset
+        * donor_stages (optional) is a dictionary of the stages to run for
+          each donor (e.g., the stages that a donor still needs according to
+          the job manifest), which replaces stages
+        * manifest (optional) is a JobManifest that records the stages of
+          each donor
+        * max_donors is the number of donors that are in progress at once
+        * fetcher_kwargs are passed to AsyncFetcher (max_concurrency,
+          requests_per_second, max_retries, backoff_seconds,
+          max_windows_per_donor, batch_size)
+    OUTPUTS:
+        * dictionary with the number of records saved for each donor (None if
+          the donor failed)
+    '''
+    startTime = time.time()
+    results = asyncio.run(
+        get_all_donor_data_async(
+            donors,
+            session_infos,
+            date_stamp,
+            data_path,
+            storage_format=storage_format,
+            weeks_of_data=weeks_of_data,
+            stages=stages,
+            donor_stages=donor_stages,
+            manifest=manifest,
+            max_donors=max_donors,
+            **fetcher_kwargs
+        )
+    )
+    print(
+        "got %d donors in %s seconds" % (
+            len(donors), round(time.time() - startTime, 1)
+        )
+    )
+
+    return results
+
@@ -5,15 +5,28 @@ and then pulls of their datasets for further processing.
 """
 
 # %% REQUIRED LIBRARIES
-from accept_new_donors_and_get_donor_list import accept_and_get_list
+from accept_new_donors_and_get_donor_list import (
+    accept_and_get_list, DONOR_GROUPS
+)
+from get_single_donor_metadata import get_and_save_metadata
+from get_single_tidepool_dataset import (
+    get_and_save_dataset, INCREMENTAL_LOOKBACK_DAYS
+)
+from tidepool_client import TidepoolClient, API_URL
+import async_fetcher
 import datetime as dt
 import pandas as pd
-import subprocess as sub
 import os
+import sys
 import glob
 import time
 import argparse
+import traceback
 from multiprocessing import Pool
+envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if envPath not in sys.path:
+    sys.path.insert(0, envPath)
+from job_manifest import JobManifest
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
@@ -49,59 +62,235 @@ parser.add_argument(
     help="specify if you want to save the donor list (True/False)"
 )
 
+parser.add_argument(
+    "--api-url",
+    dest="api_url",
+    default=API_URL,
+    help="base url of the tidepool api"
+)
+
+parser.add_argument(
+    "--async",
+    dest="use_async",
+    action="store_true",
+    help="download all donors concurrently with asyncio, instead of with " +
+    "a pool of processes"
+)
+
+parser.add_argument(
+    "-f",
+    "--storage-format",
+    dest="storage_format",
+    default="csv",
+    choices=["csv", "parquet", "ndjson"],
+    help="how the datasets are saved"
+)
+
+parser.add_argument(
+    "--max-concurrency",
+    dest="max_concurrency",
+    default=async_fetcher.MAX_CONCURRENCY,
+    type=int,
+    help="number of requests in flight at once when downloading with --async"
+)
+
+parser.add_argument(
+    "--max-donors",
+    dest="max_donors",
+    default=async_fetcher.MAX_DONORS,
+    type=int,
+    help="number of donors that are downloaded at once with --async"
+)
+
+parser.add_argument(
+    "--max-windows-per-donor",
+    dest="max_windows_per_donor",
+    default=async_fetcher.MAX_WINDOWS_PER_DONOR,
+    type=int,
+    help="number of data windows of each donor that are in flight (or " +
+    "waiting to be written) at once when downloading with --async"
+)
+
+parser.add_argument(
+    "--requests-per-second",
+    dest="requests_per_second",
+    default=async_fetcher.REQUESTS_PER_SECOND,
+    type=float,
+    help="maximum number of requests per second when downloading with --async"
+)
+
+parser.add_argument(
+    "--incremental",
+    dest="incremental",
+    action="store_true",
+    help="only download the data that is new since each donor was last " +
+    "saved to the parquet dataset of the date stamp, and merge it in " +
+    "(requires --storage-format parquet)"
+)
+
+parser.add_argument(
+    "--lookback-days",
+    dest="lookback_days",
+    default=INCREMENTAL_LOOKBACK_DAYS,
+    type=int,
+    help="number of days before the latest saved record that an " +
+    "incremental download asks for again, for late arriving data"
+)
+
+parser.add_argument(
+    "--retry-failed",
+    dest="retry_failed",
+    action="store_true",
+    help="also run the donors that failed in a previous run of the date " +
+    "stamp (by default only unfinished donors are run)"
+)
+
+parser.add_argument(
+    "--only",
+    dest="only",
+    default=None,
+    choices=async_fetcher.STAGES,
+    help="only run this stage (get the metadata, or the dataset)"
+)
+
 args = parser.parse_args()
+if args.incremental and (args.storage_format != "parquet"):
+    parser.error("--incremental requires --storage-format parquet")
+if args.incremental and args.use_async:
+    parser.error("--incremental is not supported with --async")
 
 
 # %% FUNCTIONS
-def run_process(func_name, userid, donor_group):
-    func_path = os.path.join(".", func_name)
-
-    p = sub.Popen(
-        [
-             "python", func_path,
-             "-d", args.date_stamp,
-             "-dg", donor_group,
-             "-u", userid,
-             "-o", args.data_path
-         ],
-        stdout=sub.PIPE,
-        stderr=sub.PIPE
-    )
+worker_clients = {}
+worker_settings = {}
 
-    output, errors = p.communicate()
-    output = output.decode("utf-8")
-    errors = errors.decode("utf-8")
 
-    if errors == '':
-        print(output)
-    else:
-        print(errors)
+def init_worker(session_infos, manifest):
+    # each worker reuses the logins of the donor groups (one client and
+    # connection pool per donor group), instead of logging in per donor
+    for donor_group, session_info in session_infos.items():
+        worker_clients[donor_group] = TidepoolClient(**session_info)
+    worker_settings["manifest"] = manifest
 
     return
 
 
-def get_all_data(userid, donor_group):
-
-    run_process("get_single_donor_metadata.py", userid, donor_group)
-    run_process("get_single_tidepool_dataset.py", userid, donor_group)
+def get_all_data(userid, donor_group, stages):
+    client = worker_clients[donor_group]
+    manifest = worker_settings["manifest"]
+    try:
+        if "metadata" in stages:
+            with manifest.track("metadata", userid):
+                get_and_save_metadata(
+                    date_stamp=args.date_stamp,
+                    data_path=args.data_path,
+                    userid_of_shared_user=userid,
+                    client=client
+                )
+        if "dataset" in stages:
+            with manifest.track("dataset", userid):
+                get_and_save_dataset(
+                    date_stamp=args.date_stamp,
+                    data_path=args.data_path,
+                    userid_of_shared_user=userid,
+                    storage_format=args.storage_format,
+                    client=client,
+                    incremental=args.incremental,
+                    lookback_days=args.lookback_days
+                )
+    # the download functions sys.exit on api errors, which should only
+    # stop this donor
+    except (Exception, SystemExit):
+        print(userid, "failed to get data")
+        print(traceback.format_exc())
 
     return
 
 
+# %% LOGIN TO ALL DONOR GROUPS
+clients = {}
+for donor_group in DONOR_GROUPS:
+    clients[donor_group] = TidepoolClient.from_donor_group(
+        donor_group, api_url=args.api_url
+    )
+    clients[donor_group].login()
+
+
 # %% GET LATEST DONOR LIST
-final_donor_list = accept_and_get_list(args)
+final_donor_list = accept_and_get_list(args, clients=clients)
+
+
+# %% GET THE STAGES EACH DONOR STILL NEEDS
+# the job manifest records the donors that are done, so a run that stops
+# part way resumes with the donors that did not finish
+manifest = JobManifest.for_date_stamp(args.data_path, args.date_stamp)
+stages = async_fetcher.STAGES
+if args.only is not None:
+    stages = [args.only]
+
+donor_stages = {userid: [] for userid in final_donor_list["userID"]}
+for stage in stages:
+    manifest.add_jobs(stage, final_donor_list["userID"])
+    # an incremental run refreshes every donor
+    if (stage == "dataset") and args.incremental:
+        unfinished = final_donor_list["userID"]
+    else:
+        unfinished = manifest.get_unfinished(
+            stage, retry_failed=args.retry_failed
+        )
+    for userid in unfinished:
+        if userid in donor_stages:
+            donor_stages[userid].append(stage)
+
+donors = final_donor_list[
+    final_donor_list["userID"].map(lambda u: len(donor_stages[u]) > 0)
+]
+print(
+    "%d of %d donors have stages to run" % (len(donors), len(final_donor_list))
+)
 
 
 # %% GET DONOR META DATA AND DATASETS
 # use multiple cores to process
 startTime = time.time()
 print("starting at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-pool = Pool(os.cpu_count())
-pool.starmap(get_all_data, zip(
-    final_donor_list["userID"],
-    final_donor_list["donorGroup"]
-))
-pool.close()
+session_infos = {dg: c.session_info() for dg, c in clients.items()}
+if args.use_async:
+    # the downloads are network bound, so all donors share one event loop.
+    # each donor only runs the stages it still needs
+    async_fetcher.get_all_donor_data(
+        list(zip(donors["userID"], donors["donorGroup"])),
+        session_infos,
+        args.date_stamp,
+        args.data_path,
+        storage_format=args.storage_format,
+        donor_stages={u: donor_stages[u] for u in donors["userID"]},
+        manifest=manifest,
+        max_donors=args.max_donors,
+        max_concurrency=args.max_concurrency,
+        requests_per_second=args.requests_per_second,
+        max_windows_per_donor=args.max_windows_per_donor
+    )
+else:
+    pool = Pool(
+        os.cpu_count(),
+        initializer=init_worker,
+        initargs=(session_infos, manifest)
+    )
+    pool.starmap(get_all_data, zip(
+        donors["userID"],
+        donors["donorGroup"],
+        [donor_stages[u] for u in donors["userID"]]
+    ))
+    pool.close()
+    pool.join()
+
+print(manifest.summary())
+
+# logout of all donor groups
+for client in clients.values():
+    client.logout()
+
 endTime = time.time()
 print(
   "finshed pulling data at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -116,10 +305,8 @@ phi_date_stamp = "PHI-" + args.date_stamp
 donor_folder = os.path.join(args.data_path, phi_date_stamp + "-donor-data")
 
 metadata_path = os.path.join(
-    args.data_path,
-    "PHI-" + "2019-07-13" + "-donor-data",
-    "PHI-" + "2019-07-13" + "-metadata"
-
+    donor_folder,
+    phi_date_stamp + "-metadata"
 )
 
 all_files = glob.glob(os.path.join(metadata_path, "*.csv"))
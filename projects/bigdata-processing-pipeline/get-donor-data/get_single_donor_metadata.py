@@ -13,83 +13,85 @@ import datetime as dt
 import numpy as np
 import os
 import sys
-import getpass
-import requests
 import json
-import pdb
 import argparse
-envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-if envPath not in sys.path:
-    sys.path.insert(0, envPath)
-import environmentalVariables
+from tidepool_client import TidepoolClient, get_auth, API_URL
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
-codeDescription = "get donor metadata"
-parser = argparse.ArgumentParser(description=codeDescription)
-
-parser.add_argument(
-    "-d",
-    "--date-stamp",
-    dest="date_stamp",
-    default=dt.datetime.now().strftime("%Y-%m-%d"),
-    help="date, in '%Y-%m-%d' format, of the date when " +
-    "donors were accepted"
-)
-
-parser.add_argument(
-    "-dg",
-    "--donor-group",
-    dest="donor_group",
-    default=np.nan,
-    help="name of the donor group in the tidepool .env file"
-)
-
-parser.add_argument(
-    "-u",
-    "--userid",
-    dest="userid_of_shared_user",
-    default=np.nan,
-    help="userid of account shared with the donor group or master account"
-)
-
-parser.add_argument(
-    "-a",
-    "--auth",
-    dest="auth",
-    default=np.nan,
-    help="tuple that contains (email, password)"
-)
-
-parser.add_argument(
-    "-e",
-    "--email",
-    dest="email",
-    default=np.nan,
-    help="email address of the master account"
-)
-
-parser.add_argument(
-    "-p",
-    "--password",
-    dest="password",
-    default=np.nan,
-    help="password of the master account"
-)
-
-parser.add_argument(
-    "-o",
-    "--output-data-path",
-    dest="data_path",
-    default=os.path.abspath(
-        os.path.join(
-            os.path.dirname(__file__), "..", "data"
-        )
-    ),
-    help="the output path where the data is stored"
-)
+def get_args():
+    codeDescription = "get donor metadata"
+    parser = argparse.ArgumentParser(description=codeDescription)
+
+    parser.add_argument(
+        "-d",
+        "--date-stamp",
+        dest="date_stamp",
+        default=dt.datetime.now().strftime("%Y-%m-%d"),
+        help="date, in '%Y-%m-%d' format, of the date when " +
+        "donors were accepted"
+    )
+
+    parser.add_argument(
+        "-dg",
+        "--donor-group",
+        dest="donor_group",
+        default=np.nan,
+        help="name of the donor group in the tidepool .env file"
+    )
 
-args = parser.parse_args()
+    parser.add_argument(
+        "-u",
+        "--userid",
+        dest="userid_of_shared_user",
+        default=np.nan,
+        help="userid of account shared with the donor group or master account"
+    )
+
+    parser.add_argument(
+        "-a",
+        "--auth",
+        dest="auth",
+        default=np.nan,
+        help="tuple that contains (email, password)"
+    )
+
+    parser.add_argument(
+        "-e",
+        "--email",
+        dest="email",
+        default=np.nan,
+        help="email address of the master account"
+    )
+
+    parser.add_argument(
+        "-p",
+        "--password",
+        dest="password",
+        default=np.nan,
+        help="password of the master account"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-data-path",
+        dest="data_path",
+        default=os.path.abspath(
+            os.path.join(
+                os.path.dirname(__file__), "..", "data"
+            )
+        ),
+        help="the output path where the data is stored"
+    )
+
+    parser.add_argument(
+        "--api-url",
+        dest="api_url",
+        default=API_URL,
+        help="base url of the tidepool api"
+    )
+
+    return parser.parse_args()
 
 
 # %% FUNCTIONS
@@ -103,81 +105,70 @@ def make_folder_if_doesnt_exist(folder_paths):
     return
 
 
+def profile_to_metadata(user_profile, userid):
+    ''' turn the profile returned by the api into a row of metadata '''
+    df = pd.DataFrame(
+        dtype=object,
+        columns=[
+            "diagnosisType",
+            "diagnosisDate",
+            "biologicalSex",
+            "birthday",
+            "targetTimezone",
+            "targetDevices",
+            "isOtherPerson",
+            "about"
+        ]
+    )
+
+    if "patient" in user_profile.keys():
+        for k, d in zip(
+            user_profile["patient"].keys(),
+            user_profile["patient"].values()
+        ):
+            df.at[userid, k] = d
+
+    df.index.rename("userid", inplace=True)
+
+    return df
+
+
 def get_shared_metadata(
     donor_group=np.nan,
     userid_of_shared_user=np.nan,
     auth=np.nan,
     email=np.nan,
     password=np.nan,
+    api_url=API_URL,
+    client=None,
 ):
+    '''
+    get the metadata (profile) of a tidepool account. If a (logged in)
+    client is given it is used for the requests, otherwise the function
+    logs in and out itself.
+    '''
     # login
-    if pd.notnull(donor_group):
-        if donor_group == "bigdata":
-            dg = ""
-        else:
-            dg = donor_group
-
-        auth = environmentalVariables.get_environmental_variables(dg)
-
-    if pd.isnull(auth):
-        if pd.isnull(email):
-            email = input("Enter Tidepool email address:\n")
-
-        if pd.isnull(password):
-            password = getpass.getpass("Enter password:\n")
-
-        auth = (email, password)
-
-    api_call = "https://api.tidepool.org/auth/login"
-    api_response = requests.post(api_call, auth=auth)
-    if(api_response.ok):
-        xtoken = api_response.headers["x-tidepool-session-token"]
-        userid_master = json.loads(api_response.content.decode())["userid"]
-        headers = {
-            "x-tidepool-session-token": xtoken,
-            "Content-Type": "application/json"
-        }
-    else:
-        sys.exit("Error with " + auth[0] + ":" + str(api_response.status_code))
+    is_own_client = client is None
+    if is_own_client:
+        client = TidepoolClient(
+            get_auth(donor_group, auth, email, password),
+            api_url=api_url
+        )
+        client.login()
 
     if pd.isnull(userid_of_shared_user):
-        userid_of_shared_user = userid_master
+        userid_of_shared_user = client.get_userid()
         print(
             "getting metadata for the master account since no shared " +
             "user account was given"
         )
 
-    print("logging into", auth[0], "...")
-
     # get shared or donro metadata
     print("get donor metadata for %s ..." % userid_of_shared_user)
-    api_call = (
-        "https://api.tidepool.org/metadata/%s/profile"
-        % userid_of_shared_user
-    )
-    api_response = requests.get(api_call, headers=headers)
-    df = pd.DataFrame(
-        dtype=object,
-        columns=[
-            "diagnosisType",
-            "diagnosisDate",
-            "biologicalSex",
-            "birthday",
-            "targetTimezone",
-            "targetDevices",
-            "isOtherPerson",
-            "about"
-        ]
-    )
-
+    api_response = client.get_profile(userid_of_shared_user)
     if(api_response.ok):
         user_profile = json.loads(api_response.content.decode())
-        if "patient" in user_profile.keys():
-            for k, d in zip(
-                user_profile["patient"].keys(),
-                user_profile["patient"].values()
-            ):
-                df.at[userid_of_shared_user, k] = d
+        df = profile_to_metadata(user_profile, userid_of_shared_user)
     else:
         sys.exit(
             "Error getting metadata API " +
@@ -185,31 +176,25 @@ def get_shared_metadata(
         )
 
     # logout
-    api_call = "https://api.tidepool.org/auth/logout"
-    api_response = requests.post(api_call, auth=auth)
-
-    if(api_response.ok):
-        print("successfully logged out of", auth[0])
-
-    else:
-        sys.exit(
-            "Error with logging out for " +
-            auth[0] + ":" + str(api_response.status_code)
-        )
-    df.index.rename("userid", inplace=True)
+    if is_own_client:
+        client.logout()
 
     return df, userid_of_shared_user
 
 
 # %% START OF CODE
 def get_and_save_metadata(
-    date_stamp=args.date_stamp,
-    data_path=args.data_path,
-    donor_group=args.donor_group,
-    userid_of_shared_user=args.userid_of_shared_user,
-    auth=args.auth,
-    email=args.email,
-    password=args.password
+    date_stamp=dt.datetime.now().strftime("%Y-%m-%d"),
+    data_path=os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data")
+    ),
+    donor_group=np.nan,
+    userid_of_shared_user=np.nan,
+    auth=np.nan,
+    email=np.nan,
+    password=np.nan,
+    api_url=API_URL,
+    client=None
 ):
     # create output folders if they don't exist
     phi_date_stamp = "PHI-" + date_stamp
@@ -227,7 +212,9 @@ def get_and_save_metadata(
         userid_of_shared_user=userid_of_shared_user,
         auth=auth,
         email=email,
-        password=password
+        password=password,
+        api_url=api_url,
+        client=client
     )
 
     # save data
@@ -240,6 +227,7 @@ def get_and_save_metadata(
 
 
 if __name__ == "__main__":
+    args = get_args()
     get_and_save_metadata(
         date_stamp=args.date_stamp,
         data_path=args.data_path,
@@ -247,5 +235,6 @@ if __name__ == "__main__":
         userid_of_shared_user=args.userid_of_shared_user,
         auth=args.auth,
         email=args.email,
-        password=args.password
+        password=args.password,
+        api_url=args.api_url
     )
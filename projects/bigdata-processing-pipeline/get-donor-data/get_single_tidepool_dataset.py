@@ -13,91 +13,139 @@ import datetime as dt
 import numpy as np
 import os
 import sys
-import getpass
-import requests
 import json
-import pdb
 import argparse
+import ijson
 envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if envPath not in sys.path:
     sys.path.insert(0, envPath)
-import environmentalVariables
+import donor_data_store
+from tidepool_client import TidepoolClient, get_auth, API_URL
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
-codeDescription = "get donor metadata"
-parser = argparse.ArgumentParser(description=codeDescription)
-
-parser.add_argument(
-    "-d",
-    "--date-stamp",
-    dest="date_stamp",
-    default=dt.datetime.now().strftime("%Y-%m-%d"),
-    help="date, in '%Y-%m-%d' format, of the date when " +
-    "donors were accepted"
-)
-
-parser.add_argument(
-    "-w",
-    "--weeks-of-data",
-    dest="weeks_of_data",
-    default=52*10,
-    help="enter the number of weeks of data you want to download"
-)
-
-parser.add_argument(
-    "-dg",
-    "--donor-group",
-    dest="donor_group",
-    default=np.nan,
-    help="name of the donor group in the tidepool .env file"
-)
-
-parser.add_argument(
-    "-u",
-    "--userid",
-    dest="userid_of_shared_user",
-    default=np.nan,
-    help="userid of account shared with the donor group or master account"
-)
-
-parser.add_argument(
-    "-a",
-    "--auth",
-    dest="auth",
-    default=np.nan,
-    help="tuple that contains (email, password)"
-)
-
-parser.add_argument(
-    "-e",
-    "--email",
-    dest="email",
-    default=np.nan,
-    help="email address of the master account"
-)
-
-parser.add_argument(
-    "-p",
-    "--password",
-    dest="password",
-    default=np.nan,
-    help="password of the master account"
-)
-
-parser.add_argument(
-    "-o",
-    "--output-data-path",
-    dest="data_path",
-    default=os.path.abspath(
-        os.path.join(
-            os.path.dirname(__file__), "..", "data"
-        )
-    ),
-    help="the output path where the data is stored"
-)
+STREAM_BATCH_SIZE = 10000
+INCREMENTAL_LOOKBACK_DAYS = 14
+
+
+def get_args():
+    codeDescription = "get donor metadata"
+    parser = argparse.ArgumentParser(description=codeDescription)
+
+    parser.add_argument(
+        "-d",
+        "--date-stamp",
+        dest="date_stamp",
+        default=dt.datetime.now().strftime("%Y-%m-%d"),
+        help="date, in '%Y-%m-%d' format, of the date when " +
+        "donors were accepted"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--weeks-of-data",
+        dest="weeks_of_data",
+        default=52*10,
+        type=int,
+        help="enter the number of weeks of data you want to download"
+    )
+
+    parser.add_argument(
+        "-dg",
+        "--donor-group",
+        dest="donor_group",
+        default=np.nan,
+        help="name of the donor group in the tidepool .env file"
+    )
+
+    parser.add_argument(
+        "-u",
+        "--userid",
+        dest="userid_of_shared_user",
+        default=np.nan,
+        help="userid of account shared with the donor group or master account"
+    )
+
+    parser.add_argument(
+        "-a",
+        "--auth",
+        dest="auth",
+        default=np.nan,
+        help="tuple that contains (email, password)"
+    )
+
+    parser.add_argument(
+        "-e",
+        "--email",
+        dest="email",
+        default=np.nan,
+        help="email address of the master account"
+    )
+
+    parser.add_argument(
+        "-p",
+        "--password",
+        dest="password",
+        default=np.nan,
+        help="password of the master account"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-data-path",
+        dest="data_path",
+        default=os.path.abspath(
+            os.path.join(
+                os.path.dirname(__file__), "..", "data"
+            )
+        ),
+        help="the output path where the data is stored"
+    )
+
+    parser.add_argument(
+        "-f",
+        "--storage-format",
+        dest="storage_format",
+        default="csv",
+        choices=["csv", "parquet", "both", "ndjson"],
+        help="save the dataset as a csv file, to the parquet dataset, " +
+        "both, or as a newline delimited json file"
+    )
+
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        help="stream the data straight to disk in batches, instead of " +
+        "loading the whole dataset into memory (parquet or ndjson only)"
+    )
+
+    parser.add_argument(
+        "--api-url",
+        dest="api_url",
+        default=API_URL,
+        help="base url of the tidepool api"
+    )
+
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="only download the data that is new since the donor was last " +
+        "saved to the parquet dataset of the date stamp, and merge it in " +
+        "(parquet only)"
+    )
+
+    parser.add_argument(
+        "--lookback-days",
+        dest="lookback_days",
+        default=INCREMENTAL_LOOKBACK_DAYS,
+        type=int,
+        help="number of days before the latest saved record that an " +
+        "incremental download asks for again, for late arriving data"
+    )
 
-args = parser.parse_args()
+    return parser.parse_args()
 
 
 # %% FUNCTIONS
@@ -111,30 +159,107 @@ def make_folder_if_doesnt_exist(folder_paths):
     return
 
 
-def get_data_api(userid, startDate, endDate, headers):
+def get_data_windows(weeks_of_data, now=None):
+    '''
+    the (startDate, endDate) windows of the data requests, newest first.
+    More than a year of data is requested one year at a time.
+    '''
+    if now is None:
+        now = dt.datetime.now()
+    endDate = now + pd.Timedelta(1, unit="d")
+
+    windows = []
+    if weeks_of_data > 52:
+        years_of_data = int(np.floor(weeks_of_data/52))
+
+        for years in range(0, years_of_data + 1):
+            startDate = dt.datetime(
+                endDate.year - 1,
+                endDate.month,
+                endDate.day + 1
+            )
+            windows.append((startDate, endDate))
+            endDate = (
+                pd.to_datetime(startDate.strftime("%Y-%m-%d") + "T00:00:00.000Z")
+                - pd.Timedelta(1, unit="d")
+            )
+
+    else:
+        startDate = (
+            pd.to_datetime(endDate) - pd.Timedelta(weeks_of_data*7, "d")
+        )
+        windows.append((startDate, endDate))
+
+    return windows
+
+
+def get_incremental_windows(
+    watermark,
+    lookback_days=INCREMENTAL_LOOKBACK_DAYS,
+    now=None
+):
+    '''
+    the data windows that cover everything since the latest time of the
+    watermark (see donor_data_store.update_watermark), less lookback_days
+    '''
+    if now is None:
+        now = dt.datetime.now()
+
+    since = (
+        pd.to_datetime(watermark["maxTime"]).tz_convert(None)
+        - pd.Timedelta(lookback_days, unit="d")
+    )
+    weeks_of_data = int(np.ceil(
+        (pd.to_datetime(now) + pd.Timedelta(1, unit="d") - since)
+        / pd.Timedelta(7, unit="d")
+    ))
+
+    return get_data_windows(weeks_of_data, now=now)
+
 
+def format_data_window(startDate, endDate):
+    ''' the start and end of a data window, as used by the api '''
     startDate = startDate.strftime("%Y-%m-%d") + "T00:00:00.000Z"
     endDate = endDate.strftime("%Y-%m-%d") + "T23:59:59.999Z"
 
-    api_call = (
-        "https://api.tidepool.org/data/" + userid + "?" +
-        "endDate=" + endDate + "&" +
-        "startDate=" + startDate + "&" +
-        "dexcom=true" + "&" +
-        "medtronic=true" + "&" +
-        "carelink=true"
-    )
+    return startDate, endDate
+
 
-    api_response = requests.get(api_call, headers=headers)
+def get_data_api(
+    userid,
+    startDate,
+    endDate,
+    client,
+    sink=None,
+    batch_size=STREAM_BATCH_SIZE
+):
+    '''
+    get the data between startDate and endDate
+    INPUTS:
+        * client is a logged in TidepoolClient
+        * sink (optional) is a writer with a write_records(records) method
+          (see donor_data_store). If given, the response is parsed as it
+          is downloaded and written to the sink in batches of batch_size
+          records, so the data is never held in memory all at once.
+    OUTPUTS:
+        * a dataframe with the data, or the number of records written to
+          the sink if streaming
+        * the endDate of the preceding window
+    '''
+    startDate, endDate = format_data_window(startDate, endDate)
+
+    api_response = client.get_data(
+        userid, startDate, endDate, stream=(sink is not None)
+    )
     if(api_response.ok):
-        json_data = json.loads(api_response.content.decode())
-        df = pd.DataFrame(json_data)
         print("getting data between %s and %s" % (startDate, endDate))
+        df = read_data_response(api_response, sink, batch_size=batch_size)
 
     else:
         sys.exit(
-            "ERROR in getting data between %s and %s" % (startDate, endDate),
-            api_response.status_code
+            "ERROR in getting data between %s and %s: %s" % (
+                startDate, endDate, api_response.status_code
+            )
         )
 
     endDate = pd.to_datetime(startDate) - pd.Timedelta(1, unit="d")
@@ -142,6 +267,91 @@ def get_data_api(userid, startDate, endDate, headers):
     return df, endDate
 
 
+def get_upload_data_api(
+    userid,
+    uploadId,
+    endDate,
+    client,
+    sink=None,
+    batch_size=STREAM_BATCH_SIZE
+):
+    '''
+    get the data of a single upload up to endDate, see get_data_api
+    '''
+    endDate = endDate.strftime("%Y-%m-%d") + "T23:59:59.999Z"
+
+    api_response = client.get_upload_data(
+        userid, uploadId, endDate, stream=(sink is not None)
+    )
+    if(api_response.ok):
+        print("getting data of upload %s up to %s" % (uploadId, endDate))
+        df = read_data_response(api_response, sink, batch_size=batch_size)
+
+    else:
+        sys.exit(
+            "ERROR in getting data of upload %s: %s" % (
+                uploadId, api_response.status_code
+            )
+        )
+
+    return df
+
+
+def get_new_uploadIds(userid, client, watermark):
+    ''' the uploadIds of an account that the watermark has not seen '''
+    api_response = client.get_uploads(userid)
+    if(api_response.ok):
+        uploads = json.loads(api_response.content.decode())
+    else:
+        sys.exit(
+            "ERROR in getting the uploads of %s: %s" % (
+                userid, api_response.status_code
+            )
+        )
+
+    uploadIds = set(u["uploadId"] for u in uploads if "uploadId" in u)
+
+    return sorted(uploadIds - set(watermark["uploadIds"]))
+
+
+def read_data_response(api_response, sink=None, batch_size=STREAM_BATCH_SIZE):
+    '''
+    a dataframe of the records of a data response, or the number of records
+    streamed to the sink
+    '''
+    if sink is None:
+        json_data = json.loads(api_response.content.decode())
+        return pd.DataFrame(json_data)
+
+    return stream_to_sink(api_response, sink, batch_size=batch_size)
+
+
+def stream_to_sink(api_response, sink, batch_size=STREAM_BATCH_SIZE):
+    '''
+    incrementally parse the json array of a (streamed) api response and
+    write the records to the sink in batches
+    '''
+    # let urllib3 undo any gzip/deflate content encoding
+    api_response.raw.decode_content = True
+
+    nRecords = 0
+    batch = []
+    for record in ijson.items(api_response.raw, "item", use_float=True):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            sink.write_records(batch)
+            nRecords = nRecords + len(batch)
+            batch = []
+
+    if len(batch) > 0:
+        sink.write_records(batch)
+        nRecords = nRecords + len(batch)
+
+    api_response.close()
+
+    return nRecords
+
+
 def get_data(
     weeks_of_data=10*52,
     donor_group=np.nan,
@@ -149,111 +359,123 @@ def get_data(
     auth=np.nan,
     email=np.nan,
     password=np.nan,
+    sink=None,
+    api_url=API_URL,
+    client=None,
+    watermark=None,
+    lookback_days=INCREMENTAL_LOOKBACK_DAYS
 ):
+    '''
+    get the data of a tidepool account. If a sink is given the data is
+    streamed to the sink, and the number of records written is returned
+    instead of a dataframe. If a (logged in) client is given it is used
+    for the requests, otherwise the function logs in and out itself.
+
+    If the watermark of a saved dataset is given (see
+    donor_data_store.update_watermark), only the data that is new since
+    it was saved is downloaded: the days since its latest time (less
+    lookback_days), and the older data of any upload it has not seen,
+    e.g. a device that is uploaded for the first time.
+    '''
     # login
-    if pd.notnull(donor_group):
-        if donor_group == "bigdata":
-            dg = ""
-        else:
-            dg = donor_group
-
-        auth = environmentalVariables.get_environmental_variables(dg)
-
-    if pd.isnull(auth):
-        if pd.isnull(email):
-            email = input("Enter Tidepool email address:\n")
-
-        if pd.isnull(password):
-            password = getpass.getpass("Enter password:\n")
-
-        auth = (email, password)
-
-    api_call = "https://api.tidepool.org/auth/login"
-    api_response = requests.post(api_call, auth=auth)
-    if(api_response.ok):
-        xtoken = api_response.headers["x-tidepool-session-token"]
-        userid_master = json.loads(api_response.content.decode())["userid"]
-        headers = {
-            "x-tidepool-session-token": xtoken,
-            "Content-Type": "application/json"
-        }
-    else:
-        sys.exit("Error with " + auth[0] + ":" + str(api_response.status_code))
+    is_own_client = client is None
+    if is_own_client:
+        client = TidepoolClient(
+            get_auth(donor_group, auth, email, password),
+            api_url=api_url
+        )
+        client.login()
 
     if pd.isnull(userid_of_shared_user):
-        userid_of_shared_user = userid_master
+        userid_of_shared_user = client.get_userid()
         print(
             "getting data for the master account since no shared " +
             "user account was given"
         )
 
-    print("logging into", auth[0], "...")
-
     # download user data
     print("downloading data ...")
-    df = pd.DataFrame()
-    endDate = pd.datetime.now() + pd.Timedelta(1, unit="d")
+    nRecords = 0
 
-    if weeks_of_data > 52:
-        years_of_data = int(np.floor(weeks_of_data/52))
+    # when streaming, each window is written to the sink as it arrives,
+    # rather than concatenated onto a growing dataframe
+    if watermark is None:
+        windows = get_data_windows(weeks_of_data)
+    else:
+        windows = get_incremental_windows(watermark, lookback_days)
 
-        for years in range(0, years_of_data + 1):
-            startDate = pd.datetime(
-                endDate.year - 1,
-                endDate.month,
-                endDate.day + 1
-            )
-            year_df, endDate = get_data_api(
+    window_dfs = []
+    for startDate, endDate in windows:
+        window_df, _ = get_data_api(
+            userid_of_shared_user,
+            startDate,
+            endDate,
+            client,
+            sink=sink
+        )
+
+        if sink is None:
+            window_dfs.append(window_df)
+        else:
+            nRecords = nRecords + window_df
+
+    # the windows already cover the new uploads from their oldest start on
+    if watermark is not None:
+        uploadsEndDate = windows[-1][0] - pd.Timedelta(1, unit="d")
+        for uploadId in get_new_uploadIds(
+            userid_of_shared_user, client, watermark
+        ):
+            upload_df = get_upload_data_api(
                 userid_of_shared_user,
-                startDate,
-                endDate,
-                headers
+                uploadId,
+                uploadsEndDate,
+                client,
+                sink=sink
             )
 
+            if sink is None:
+                window_dfs.append(upload_df)
+            else:
+                nRecords = nRecords + upload_df
+
+    if sink is None:
+        if len(window_dfs) > 1:
             df = pd.concat(
-                [df, year_df],
+                [pd.DataFrame()] + window_dfs,
                 ignore_index=True,
                 sort=False
             )
-
-    else:
-        startDate = (
-            pd.to_datetime(endDate) - pd.Timedelta(weeks_of_data*7, "d")
-        )
-
-        df, _ = get_data_api(
-            userid_of_shared_user,
-            startDate,
-            endDate,
-            headers
-            )
+        else:
+            df = window_dfs[0]
 
     # logout
-    api_call = "https://api.tidepool.org/auth/logout"
-    api_response = requests.post(api_call, auth=auth)
+    if is_own_client:
+        client.logout()
 
-    if(api_response.ok):
-        print("successfully logged out of", auth[0])
-
-    else:
-        sys.exit(
-            "Error with logging out for " +
-            auth[0] + ":" + str(api_response.status_code)
-        )
+    if sink is not None:
+        return nRecords, userid_of_shared_user
 
     return df, userid_of_shared_user
 
 
 # %% START OF CODE
 def get_and_save_dataset(
-    date_stamp=args.date_stamp,
-    data_path=args.data_path,
-    weeks_of_data=args.weeks_of_data,
-    donor_group=args.donor_group,
-    userid_of_shared_user=args.userid_of_shared_user,
-    auth=args.auth,
-    email=args.email,
-    password=args.password
+    date_stamp=dt.datetime.now().strftime("%Y-%m-%d"),
+    data_path=os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "data")
+    ),
+    weeks_of_data=52*10,
+    donor_group=np.nan,
+    userid_of_shared_user=np.nan,
+    auth=np.nan,
+    email=np.nan,
+    password=np.nan,
+    storage_format="csv",
+    stream=False,
+    api_url=API_URL,
+    client=None,
+    incremental=False,
+    lookback_days=INCREMENTAL_LOOKBACK_DAYS
 ):
     # create output folders if they don't exist
 
@@ -264,7 +486,97 @@ def get_and_save_dataset(
         donor_folder,
         phi_date_stamp + "-csvData"
     )
-    make_folder_if_doesnt_exist(dataset_path)
+    parquet_path = donor_data_store.get_parquet_dataset_path(
+        data_path, date_stamp
+    )
+    ndjson_path = os.path.join(
+        donor_folder,
+        phi_date_stamp + "-ndjsonData"
+    )
+    if storage_format in ["csv", "both"]:
+        make_folder_if_doesnt_exist(dataset_path)
+    if storage_format in ["parquet", "both"]:
+        make_folder_if_doesnt_exist(parquet_path)
+    if storage_format == "ndjson":
+        make_folder_if_doesnt_exist(ndjson_path)
+
+    # merge only the new data into a donor that was saved before, donors
+    # without a watermark are downloaded in full (below), and get one
+    if incremental:
+        if storage_format != "parquet":
+            sys.exit("incremental downloads are only supported for parquet")
+        if pd.isnull(userid_of_shared_user):
+            sys.exit("incremental downloads require the userid (-u) of the donor")
+
+        watermark = donor_data_store.get_watermark(
+            parquet_path, userid_of_shared_user
+        )
+        if (watermark is not None) and (watermark["maxTime"] is not None):
+            fetched_on = pd.Timestamp.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            data, userid = get_data(
+                donor_group=donor_group,
+                userid_of_shared_user=userid_of_shared_user,
+                auth=auth,
+                email=email,
+                password=password,
+                api_url=api_url,
+                client=client,
+                watermark=watermark,
+                lookback_days=lookback_days
+            )
+            nAdded, nReplaced = donor_data_store.merge_donor_dataset(
+                data,
+                parquet_path,
+                userid,
+                modified_since=watermark["maxModifiedTime"]
+            )
+            donor_data_store.update_watermark(
+                parquet_path, userid, data, fetched_on=fetched_on
+            )
+            print(
+                "added %s and updated %s records for %s" % (
+                    nAdded, nReplaced, userid
+                )
+            )
+
+            return
+
+    # stream the dataset straight to disk
+    if stream:
+        if pd.isnull(userid_of_shared_user):
+            sys.exit("streaming requires the userid (-u) of the donor")
+
+        if storage_format == "parquet":
+            sink = donor_data_store.DonorParquetWriter(
+                parquet_path, userid_of_shared_user
+            )
+        elif storage_format == "ndjson":
+            sink = donor_data_store.DonorNdjsonWriter(
+                os.path.join(
+                    ndjson_path, "PHI-" + userid_of_shared_user + ".ndjson"
+                )
+            )
+        else:
+            sys.exit("streaming is only supported for parquet and ndjson")
+
+        nRecords, userid = get_data(
+            weeks_of_data=weeks_of_data,
+            donor_group=donor_group,
+            userid_of_shared_user=userid_of_shared_user,
+            auth=auth,
+            email=email,
+            password=password,
+            sink=sink,
+            api_url=api_url,
+            client=client
+        )
+        sink.close()
+        print("saved %s records for %s" % (nRecords, userid))
+
+        if incremental:
+            donor_data_store.update_watermark(parquet_path, userid)
+
+        return
 
     # get dataset
     data, userid = get_data(
@@ -273,19 +585,35 @@ def get_and_save_dataset(
         userid_of_shared_user=userid_of_shared_user,
         auth=auth,
         email=email,
-        password=password
+        password=password,
+        api_url=api_url,
+        client=client
     )
 
     # save data
-    dataset_output_path = os.path.join(
-        dataset_path,
-        'PHI-' + userid + ".csv"
-    )
+    if storage_format in ["parquet", "both"]:
+        donor_data_store.save_donor_dataset(data, parquet_path, userid)
+        if incremental:
+            donor_data_store.update_watermark(parquet_path, userid, data)
+
+    if storage_format in ["csv", "both"]:
+        dataset_output_path = os.path.join(
+            dataset_path,
+            'PHI-' + userid + ".csv"
+        )
 
-    data.to_csv(dataset_output_path)
+        data.to_csv(dataset_output_path)
+
+    if storage_format == "ndjson":
+        sink = donor_data_store.DonorNdjsonWriter(
+            os.path.join(ndjson_path, "PHI-" + userid + ".ndjson")
+        )
+        sink.write(data)
+        sink.close()
 
 
 if __name__ == "__main__":
+    args = get_args()
     get_and_save_dataset(
         date_stamp=args.date_stamp,
         data_path=args.data_path,
@@ -294,5 +622,10 @@ if __name__ == "__main__":
         userid_of_shared_user=args.userid_of_shared_user,
         auth=args.auth,
         email=args.email,
-        password=args.password
+        password=args.password,
+        storage_format=args.storage_format,
+        stream=args.stream,
+        api_url=args.api_url,
+        incremental=args.incremental,
+        lookback_days=args.lookback_days
     )
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""tidepool_client.py
+A client for the Tidepool api that logs in once and reuses its session
+(and connections) for every request.
+
+All donors of a donor group are shared with the group's master account, so
+a single client per donor group can accept invitations, and get the metadata
+and datasets of every donor in that group.
+"""
+
+# %% REQUIRED LIBRARIES
+import os
+import sys
+import json
+import getpass
+import requests
+import numpy as np
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if envPath not in sys.path:
+    sys.path.insert(0, envPath)
+import environmentalVariables
+
+
+# %% DEFAULTS
+API_URL = "https://api.tidepool.org"
+
+
+# %% FUNCTIONS
+def get_auth(donor_group=np.nan, auth=np.nan, email=np.nan, password=np.nan):
+    '''
+    get the (email, password) of the donor group from the .env file, or
+    from the email and password, prompting for any that are missing
+    '''
+    if pd.notnull(donor_group):
+        if donor_group == "bigdata":
+            dg = ""
+        else:
+            dg = donor_group
+
+        auth = environmentalVariables.get_environmental_variables(dg)
+
+    if pd.isnull(auth):
+        if pd.isnull(email):
+            email = input("Enter Tidepool email address:\n")
+
+        if pd.isnull(password):
+            password = getpass.getpass("Enter password:\n")
+
+        auth = (email, password)
+
+    return auth
+
+
+def get_data_path(userid, startDate, endDate):
+    '''
+    the api path of a data window, startDate and endDate are strings in the
+    format "%Y-%m-%dT%H:%M:%S.%fZ"
+    '''
+    path = (
+        "/data/" + userid + "?" +
+        "endDate=" + endDate + "&" +
+        "startDate=" + startDate + "&" +
+        "dexcom=true" + "&" +
+        "medtronic=true" + "&" +
+        "carelink=true"
+    )
+
+    return path
+
+
+def get_uploads_path(userid):
+    ''' the api path of the upload records of an account '''
+    return "/data/" + userid + "?type=upload"
+
+
+def get_upload_data_path(userid, uploadId, endDate):
+    '''
+    the api path of the data of a single upload up to endDate (a string in
+    the format "%Y-%m-%dT%H:%M:%S.%fZ")
+    '''
+    path = (
+        "/data/" + userid + "?" +
+        "uploadId=" + uploadId + "&" +
+        "endDate=" + endDate + "&" +
+        "dexcom=true" + "&" +
+        "medtronic=true" + "&" +
+        "carelink=true"
+    )
+
+    return path
+
+
+class TidepoolClient:
+    '''
+    INPUTS:
+        * auth is the (email, password) of the account
+        * api_url is the base url of the tidepool api
+        * token and userid (optional) are the session token and userid of
+          an existing login (see session_info), so a client can be handed to
+          another process without logging in again
+        * pool_maxsize is the number of connections kept open per host
+        * max_retries is the number of times a failed connection is retried
+    '''
+    def __init__(
+        self,
+        auth,
+        api_url=API_URL,
+        token=None,
+        userid=None,
+        pool_maxsize=10,
+        max_retries=3
+    ):
+        self.auth = auth
+        self.api_url = api_url
+        self.token = token
+        self.userid = userid
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_maxsize,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=max_retries,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],
+                raise_on_status=False
+            )
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if token is not None:
+            self.session.headers.update({"x-tidepool-session-token": token})
+
+    @classmethod
+    def from_donor_group(cls, donor_group, **kwargs):
+        return cls(get_auth(donor_group=donor_group), **kwargs)
+
+    def __enter__(self):
+        if self.token is None:
+            self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.logout()
+
+    def session_info(self):
+        ''' the details needed to reuse this login in another client '''
+        return {
+            "auth": self.auth,
+            "api_url": self.api_url,
+            "token": self.token,
+            "userid": self.userid
+        }
+
+    def login(self):
+        api_call = self.api_url + "/auth/login"
+        api_response = self.session.post(api_call, auth=self.auth)
+        if(api_response.ok):
+            self.token = api_response.headers["x-tidepool-session-token"]
+            self.userid = json.loads(api_response.content.decode())["userid"]
+            self.session.headers.update(
+                {"x-tidepool-session-token": self.token}
+            )
+        else:
+            sys.exit(
+                "Error with " + self.auth[0] + ":" +
+                str(api_response.status_code)
+            )
+
+        print("logging into", self.auth[0], "...")
+
+        return self.userid
+
+    def logout(self):
+        if self.token is None:
+            return
+
+        api_call = self.api_url + "/auth/logout"
+        api_response = self.session.post(api_call, auth=self.auth)
+
+        if(api_response.ok):
+            print("successfully logged out of", self.auth[0])
+
+        else:
+            sys.exit(
+                "Error with logging out for " +
+                self.auth[0] + ":" + str(api_response.status_code)
+            )
+
+        self.token = None
+        self.session.headers.pop("x-tidepool-session-token", None)
+        self.session.close()
+
+        return
+
+    def request(self, method, path, **kwargs):
+        '''
+        make a request, logging in first if needed, and logging in again if
+        the session token has expired (401)
+        '''
+        if self.token is None:
+            self.login()
+
+        api_call = self.api_url + path
+        api_response = self.session.request(method, api_call, **kwargs)
+
+        if api_response.status_code == 401:
+            api_response.close()
+            self.login()
+            api_response = self.session.request(method, api_call, **kwargs)
+
+        return api_response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def get_profile(self, userid):
+        return self.get("/metadata/%s/profile" % userid)
+
+    def get_data(self, userid, startDate, endDate, stream=False):
+        return self.get(
+            get_data_path(userid, startDate, endDate), stream=stream
+        )
+
+    def get_uploads(self, userid):
+        return self.get(get_uploads_path(userid))
+
+    def get_upload_data(self, userid, uploadId, endDate, stream=False):
+        return self.get(
+            get_upload_data_path(userid, uploadId, endDate), stream=stream
+        )
+
+    def get_invitations(self):
+        return self.get("/confirm/invitations/" + self.get_userid())
+
+    def accept_invitation(self, shareID, shareKey):
+        return self.put(
+            "/confirm/accept/invite/" + self.get_userid() + "/" + shareID,
+            json={"key": shareKey}
+        )
+
+    def get_donor_group(self):
+        return self.get("/access/groups/" + self.get_userid())
+
+    def get_userid(self):
+        if self.userid is None:
+            self.login()
+
+        return self.userid
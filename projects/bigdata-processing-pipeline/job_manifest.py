@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: a persistent record of the per donor jobs of the batch scripts
+dependencies:
+    * sqlite3 (python standard library)
+license: BSD-2-Clause
+
+The manifest is a sqlite database in the date stamped donor folder:
+
+    PHI-<date>-donor-data/PHI-<date>-jobManifest.sqlite
+
+with one row per (stage, userid). Each job is pending, running, done,
+skipped (nothing to process) or failed, with its number of attempts, start
+and finish times, duration, input bytes and the error of its last failure.
+
+The batch scripts add their donors as pending jobs, and only run the jobs
+that have not finished, so a run that crashes can be started again and
+resumes where it stopped. A job that is still "running" when a run starts
+was interrupted, and is run again. Failed jobs are only run again with
+--retry-failed.
+
+The state of a manifest can be printed with:
+
+    python job_manifest.py -d <date-stamp> -o <data-path> [--only <stage>]
+"""
+
+# %% load in required libraries
+import os
+import time
+import sqlite3
+import argparse
+import traceback
+import contextlib
+import datetime as dt
+import pandas as pd
+
+
+# %% define constants
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+SKIPPED = "skipped"
+FAILED = "failed"
+FINISHED = [DONE, SKIPPED]
+
+
+# %% define functions
+def get_manifest_path(data_path, date_stamp):
+    ''' path of the job manifest of a date stamp '''
+    phi_date_stamp = "PHI-" + date_stamp
+    donor_folder = os.path.join(data_path, phi_date_stamp + "-donor-data")
+
+    return os.path.join(donor_folder, phi_date_stamp + "-jobManifest.sqlite")
+
+
+def _now():
+    return dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class JobManifest:
+    '''
+    INPUTS:
+        * manifest_path is the path of the sqlite database, which is
+          created if it does not exist
+        * timeout is the number of seconds to wait for another process
+          that is writing to the manifest
+    The manifest can be shared with worker processes: each process opens
+    its own connection the first time it uses the manifest.
+    '''
+    def __init__(self, manifest_path, timeout=60):
+        self.manifest_path = manifest_path
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+
+        manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+        if not os.path.exists(manifest_folder):
+            os.makedirs(manifest_folder)
+
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "stage TEXT NOT NULL, "
+            "userid TEXT NOT NULL, "
+            "status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "startedOn TEXT, "
+            "finishedOn TEXT, "
+            "duration REAL, "
+            "inputBytes INTEGER, "
+            "error TEXT, "
+            "PRIMARY KEY (stage, userid))"
+        )
+
+    @classmethod
+    def for_date_stamp(cls, data_path, date_stamp, **kwargs):
+        return cls(get_manifest_path(data_path, date_stamp), **kwargs)
+
+    @property
+    def connection(self):
+        # connections can not be shared with forked processes
+        if (self._connection is None) or (self._pid != os.getpid()):
+            self._connection = sqlite3.connect(
+                self.manifest_path,
+                timeout=self.timeout,
+                isolation_level=None
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __getstate__(self):
+        return {"manifest_path": self.manifest_path, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def add_jobs(self, stage, userids):
+        ''' add the donors of a stage as pending jobs, if they are new '''
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO jobs (stage, userid, status) "
+            "VALUES (?, ?, ?)",
+            [(stage, str(userid), PENDING) for userid in userids]
+        )
+
+    def get_unfinished(self, stage, userids=None, retry_failed=False):
+        '''
+        the userids of a stage that still need to run: pending jobs, jobs
+        that were interrupted while running, and failed jobs if retry_failed
+        INPUTS:
+            * userids (optional) limits the result to these donors, in
+              their order. Donors that are not in the manifest need to run.
+        '''
+        statuses = [PENDING, RUNNING]
+        if retry_failed:
+            statuses.append(FAILED)
+
+        jobs = self.get_jobs(stage)
+        if userids is None:
+            return list(jobs.loc[jobs["status"].isin(statuses), "userid"])
+
+        status = jobs.set_index("userid")["status"]
+        return [
+            userid for userid in userids
+            if status.get(str(userid), PENDING) in statuses
+        ]
+
+    def start(self, stage, userid, input_bytes=None):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO jobs (stage, userid, status) "
+            "VALUES (?, ?, ?)",
+            (stage, str(userid), PENDING)
+        )
+        self.connection.execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+            "startedOn = ?, finishedOn = NULL, duration = NULL, "
+            "inputBytes = ?, error = NULL "
+            "WHERE stage = ? AND userid = ?",
+            (RUNNING, _now(), input_bytes, stage, str(userid))
+        )
+
+    def finish(self, stage, userid, status=DONE, duration=None,
+               input_bytes=None, error=None):
+        self.connection.execute(
+            "UPDATE jobs SET status = ?, finishedOn = ?, duration = ?, "
+            "inputBytes = COALESCE(?, inputBytes), error = ? "
+            "WHERE stage = ? AND userid = ?",
+            (status, _now(), duration, input_bytes, error, stage, str(userid))
+        )
+
+    def fail(self, stage, userid, error, duration=None):
+        self.finish(
+            stage, userid, status=FAILED, duration=duration, error=error
+        )
+
+    @contextlib.contextmanager
+    def track(self, stage, userid, input_bytes=None):
+        '''
+        record a job as running, and as done (or failed, with the
+        traceback) when the block exits. Errors are re-raised. A job that is
+        interrupted (e.g. KeyboardInterrupt) is left running, so it is run
+        again when the batch is resumed.
+        '''
+        self.start(stage, userid, input_bytes=input_bytes)
+        startTime = time.time()
+        try:
+            yield
+        except (Exception, SystemExit):
+            self.fail(
+                stage,
+                userid,
+                traceback.format_exc(),
+                duration=round(time.time() - startTime, 3)
+            )
+            raise
+        self.finish(
+            stage, userid, duration=round(time.time() - startTime, 3)
+        )
+
+    def get_jobs(self, stage=None):
+        ''' a dataframe of the jobs (of a stage) '''
+        query = "SELECT * FROM jobs"
+        params = ()
+        if stage is not None:
+            query = query + " WHERE stage = ?"
+            params = (stage,)
+
+        return pd.read_sql_query(
+            query + " ORDER BY stage, userid", self.connection, params=params
+        )
+
+    def summary(self, stage=None):
+        ''' the number of jobs of each stage by status '''
+        jobs = self.get_jobs(stage)
+
+        return jobs.groupby(["stage", "status"]).size().unstack(fill_value=0)
+
+    def close(self):
+        if (self._connection is not None) and (self._pid == os.getpid()):
+            self._connection.close()
+        self._connection = None
+
+
+# %% print the state of a manifest
+if __name__ == "__main__":
+    codeDescription = "print the state of the job manifest of a date stamp"
+    parser = argparse.ArgumentParser(description=codeDescription)
+
+    parser.add_argument(
+        "-d",
+        "--date-stamp",
+        dest="date_stamp",
+        default=dt.datetime.now().strftime("%Y-%m-%d"),
+        help="date, in '%Y-%m-%d' format, of the date when " +
+        "donors were accepted"
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output-data-path",
+        dest="data_path",
+        default=os.path.abspath(
+            os.path.join(os.path.dirname(__file__), "data")
+        ),
+        help="the output path where the data is stored"
+    )
+
+    parser.add_argument(
+        "--only",
+        dest="only",
+        default=None,
+        help="only show the jobs of this stage"
+    )
+
+    args = parser.parse_args()
+
+    manifest = JobManifest.for_date_stamp(args.data_path, args.date_stamp)
+    print(manifest.summary(args.only))
+
+    jobs = manifest.get_jobs(args.only)
+    for job in jobs[jobs["status"] == FAILED].itertuples():
+        print("\n%s %s failed (attempt %s):" % (
+            job.stage, job.userid, job.attempts
+        ))
+        print(job.error)
@@ -7,12 +7,15 @@ This is a wrapper script that qualifies all bigdata donation project donors.
 import datetime as dt
 import os
 import argparse
+import ast
 import time
 import json
 import glob
-import subprocess as sub
+import traceback
 import pandas as pd
 from multiprocessing import Pool
+import qualify_single_dataset as qsd
+from job_manifest import JobManifest
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
@@ -61,39 +64,99 @@ parser.add_argument(
     help="save the day stats used for qualifying (True/False)"
 )
 
+parser.add_argument(
+    "-w",
+    "--workers",
+    dest="workers",
+    default=os.cpu_count(),
+    type=int,
+    help="number of worker processes used to qualify the donor datasets"
+)
+
+parser.add_argument(
+    "--chunksize",
+    dest="chunksize",
+    default=1,
+    type=int,
+    help="number of donors handed to a worker at a time"
+)
+
+parser.add_argument(
+    "--maxtasksperchild",
+    dest="maxtasksperchild",
+    default=None,
+    type=int,
+    help="number of donors a worker qualifies before it is replaced " +
+    "with a fresh process (default: workers are never replaced)"
+)
+
+parser.add_argument(
+    "--retry-failed",
+    dest="retry_failed",
+    action="store_true",
+    help="also qualify the donors that failed in a previous run (by " +
+    "default only the donors that have not finished are qualified)"
+)
+
 args = parser.parse_args()
 
 
 # %% FUNCTIONS
-def qualify_data(userid):
+worker_settings = {}
 
-    qualify_path = os.path.join(
-        ".", "qualify_single_dataset.py"
-    )
 
-    p = sub.Popen(
-        [
-             "python", qualify_path,
-             "-d", args.date_stamp,
-             "-u", userid,
-#             "-q", args.qualification_criteria,
-             "-s", args.save_dayStats,
-             "-o", args.data_path
-         ],
-        stdout=sub.PIPE,
-        stderr=sub.PIPE
-    )
+def init_worker(qualCriteria, paths, save_dayStats, manifest, stage):
+    # the criteria and paths are the same for every donor, so they are sent
+    # to each worker once instead of with every task
+    worker_settings["qualCriteria"] = qualCriteria
+    worker_settings["paths"] = paths
+    worker_settings["save_dayStats"] = save_dayStats
+    worker_settings["manifest"] = manifest
+    worker_settings["stage"] = stage
 
-    output, errors = p.communicate()
-    output = output.decode("utf-8")
-    errors = errors.decode("utf-8")
+    return
 
-    if errors == '':
-        print(output)
-    else:
-        print(errors)
 
-    return
+def qualify_data(userid):
+    manifest = worker_settings["manifest"]
+    stage = worker_settings["stage"]
+    try:
+        startTime = time.time()
+        manifest.start(stage, userid)
+        metadata = qsd.qualify_dataset(
+            userid,
+            worker_settings["qualCriteria"],
+            worker_settings["paths"],
+            save_dayStats=worker_settings["save_dayStats"]
+        )
+        # donors without a dataset have no fileSize. They are failed rather
+        # than skipped, so that --retry-failed qualifies them once their
+        # data has been downloaded
+        if "fileSize" in list(metadata):
+            manifest.finish(
+                stage,
+                userid,
+                duration=round(time.time() - startTime, 3),
+                input_bytes=int(metadata["fileSize"].iloc[0])
+            )
+        else:
+            manifest.fail(
+                stage,
+                userid,
+                "no dataset: " + metadata["outputMessage"].iloc[0],
+                duration=round(time.time() - startTime, 3)
+            )
+    except Exception:
+        manifest.fail(
+            stage,
+            userid,
+            traceback.format_exc(),
+            duration=round(time.time() - startTime, 3)
+        )
+        print(userid, "failed to qualify")
+        print(traceback.format_exc())
+
+    return userid
 
 
 # %% START OF CODE
@@ -110,19 +173,47 @@ qualCriteria = json.load(args.qualification_criteria)
 qualCriteria_df = pd.DataFrame(qualCriteria)
 qualifiedOn = dt.datetime.now().strftime("%Y-%m-%d")
 
-qualify_path = os.path.join(
-    donor_folder,
-    args.date_stamp + "-qualified-by-" + qualCriteria["name"] + "-criteria"
-)
+paths = qsd.get_qualify_paths(args.data_path, args.date_stamp, qualCriteria)
+qualify_path = paths["qualify"]
 
 final_donor_list = pd.read_csv(uniqueDonorList_path, low_memory=False)
 
-# use multiple cores to process
+# the job manifest records the donors that are done, so a run that stops
+# part way resumes with the donors that did not finish
+manifest = JobManifest.for_date_stamp(args.data_path, args.date_stamp)
+stage = "qualify-" + qualCriteria["name"]
+manifest.add_jobs(stage, final_donor_list.userID.values)
+unfinished = manifest.get_unfinished(
+    stage, final_donor_list.userID.values, retry_failed=args.retry_failed
+)
+print(
+    "%d of %d donors left to qualify" % (len(unfinished), len(final_donor_list))
+)
+
+# use multiple cores to process, the workers are started once and reused
 startTime = time.time()
 print("starting at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-pool = Pool(os.cpu_count())
-pool.map(qualify_data, final_donor_list.userID.values)
+pool = Pool(
+    processes=args.workers,
+    initializer=init_worker,
+    initargs=(
+        qualCriteria,
+        paths,
+        ast.literal_eval(args.save_dayStats),
+        manifest,
+        stage
+    ),
+    maxtasksperchild=args.maxtasksperchild
+)
+for userid in pool.imap_unordered(
+    qualify_data,
+    unfinished,
+    chunksize=args.chunksize
+):
+    pass
 pool.close()
+pool.join()
+print(manifest.summary(stage))
 
 endTime = time.time()
 print("finshed at " + dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
@@ -131,7 +222,7 @@ print("total duration was %s minutes" % total_duration)
 
 # save all metadata
 all_metadata = pd.DataFrame()
-metadata_path = os.path.join(qualify_path, "metadata")
+metadata_path = paths["metadata"]
 
 all_files = glob.glob(os.path.join(metadata_path, "*.csv"))
 for f in all_files:
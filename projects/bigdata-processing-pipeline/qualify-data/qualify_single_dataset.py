@@ -13,6 +13,20 @@ import ast
 import pandas as pd
 import datetime as dt
 import numpy as np
+from collections import deque
+# load tidals package locally if it does not exist globally
+import sys
+import importlib
+if importlib.util.find_spec("tidals") is None:
+    tidalsPath = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                      "..", "..", "..", "tidepool-analysis-tools"))
+    if tidalsPath not in sys.path:
+        sys.path.insert(0, tidalsPath)
+import tidals as td
+envPath = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if envPath not in sys.path:
+    sys.path.insert(0, envPath)
+import donor_data_store
 
 
 # %% USER INPUTS (choices to be made in order to run the code)
@@ -69,7 +83,6 @@ parser.add_argument(
     help="save the day stats used for qualifying (True/False)"
 )
 
-args = parser.parse_args()
 
 
 # %% FUNCTIONS
@@ -99,7 +112,7 @@ def removeNegativeDurations(df):
 
 
 def add_uploadDateTime(df):
-    if "upload" in data.type.unique():
+    if "upload" in df.type.unique():
         uploadTimes = pd.DataFrame(
             df[df.type == "upload"].groupby("uploadId").time.describe()["top"]
         )
@@ -315,49 +328,115 @@ def getSummaryStats(df, dayStatsDF):
     return df
 
 
-def getQualifyingTier(df, criteriaName, contDayCriteria,
-                      avgBolusCalculationsCriteria, percQualDayCriteria,
-                      maxGapToContRatioCriteria):
-
-    tempDF = pd.DataFrame(columns=["avgBolusCalculationsPerDay",
+def windowSums(values, windowSize):
+    # sum of each window of <windowSize> values, using prefix sums
+    prefixSum = np.concatenate([[0], np.cumsum(values)])
+    return prefixSum[windowSize:] - prefixSum[:-windowSize]
+
+
+def getMaxGapRunInWindow(gapGroup, windowSize):
+    # the number of days in the longest gap (i.e., run of non-qualifying days)
+    # inside each window of <windowSize> days. A gap is either cut by the left
+    # edge of the window, cut by the right edge of the window, or fully inside
+    # the window, where the longest of the latter is tracked with a monotonic
+    # deque over the gaps that are ordered by when they start
+    nWindows = len(gapGroup) - windowSize + 1
+    isGap = gapGroup > 0
+    isRunStart = isGap & (gapGroup != np.concatenate([[0], gapGroup[:-1]]))
+    isRunEnd = isGap & (gapGroup != np.concatenate([gapGroup[1:], [0]]))
+    runStarts = np.flatnonzero(isRunStart)
+    runEnds = np.flatnonzero(isRunEnd) + 1
+    runLengths = runEnds - runStarts
+
+    # the start and end of the gap that each day belongs to
+    runId = np.cumsum(isRunStart) - 1
+    runStartOfDay = np.zeros(len(gapGroup), dtype=int)
+    runStartOfDay[isGap] = runStarts[runId[isGap]]
+    runEndOfDay = np.zeros(len(gapGroup), dtype=int)
+    runEndOfDay[isGap] = runEnds[runId[isGap]]
+
+    windowStarts = np.arange(nWindows)
+    windowEnds = windowStarts + windowSize
+    leftGap = np.where(isGap[:nWindows],
+                       np.minimum(runEndOfDay[:nWindows], windowEnds) - windowStarts,
+                       0)
+    lastDays = windowEnds - 1
+    rightGap = np.where(isGap[lastDays],
+                        windowEnds - np.maximum(runStartOfDay[lastDays], windowStarts),
+                        0)
+
+    insideGap = np.zeros(nWindows, dtype=int)
+    dq = deque()
+    nextRun = 0
+    for i in range(nWindows):
+        while ((nextRun < len(runStarts)) and
+               (runEnds[nextRun] <= windowEnds[i])):
+            while dq and (runLengths[dq[-1]] <= runLengths[nextRun]):
+                dq.pop()
+            dq.append(nextRun)
+            nextRun = nextRun + 1
+        while dq and (runStarts[dq[0]] < i):
+            dq.popleft()
+        if dq:
+            insideGap[i] = runLengths[dq[0]]
+
+    return np.maximum(np.maximum(leftGap, rightGap), insideGap)
+
+
+def getSlidingWindowStats(df, contDayCriteria):
+    # calculate the stats of every window of <contDayCriteria> days in one pass
+    nWindows = max(len(df) - (contDayCriteria - 1), 0)
+    tempDF = pd.DataFrame(index=range(nWindows),
+                          columns=["avgBolusCalculationsPerDay",
                                    "numberContiguousDays",
                                    "percentQualifyingDays",
                                    "maxGapToContiguousRatio",
-                                   "tier"])
-
-    for i in range(0, len(df)-(contDayCriteria-1)):
-
-        tempIndex = min(i+contDayCriteria, len(df))
-
-        numberContiguousDays = df["date"].iloc[i:tempIndex].count()
-        tempDF.loc[i, "numberContiguousDays"] = numberContiguousDays
-
-        avgBolusCalculationsPerDay = \
-            df["calculator.count"].iloc[i:tempIndex].mean()
-        tempDF.loc[i, "avgBolusCalculationsPerDay"] = \
-            avgBolusCalculationsPerDay
-
-        percentQualifyingDays = \
-            df.qualifyingDay.iloc[i:tempIndex].sum() / contDayCriteria * 100
-        tempDF.loc[i, "percentQualifyingDays"] = percentQualifyingDays
+                                   "tier"],
+                          dtype=object)
+
+    if nWindows > 0:
+        tempDF["numberContiguousDays"] = \
+            windowSums(df["date"].notnull().values.astype(int),
+                       contDayCriteria).astype(object)
+
+        calculatorCount = df["calculator.count"].astype(float).values
+        isCalculatorCount = ~np.isnan(calculatorCount)
+        nCalculatorCounts = windowSums(isCalculatorCount.astype(int),
+                                       contDayCriteria)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avgBolusCalculationsPerDay = \
+                windowSums(np.where(isCalculatorCount, calculatorCount, 0),
+                           contDayCriteria) / nCalculatorCounts
+        tempDF["avgBolusCalculationsPerDay"] = \
+            avgBolusCalculationsPerDay.astype(object)
+
+        tempDF["percentQualifyingDays"] = \
+            (windowSums(df["qualifyingDay"].values.astype(int),
+                        contDayCriteria) / contDayCriteria * 100).astype(object)
+
+        maxGapRun = getMaxGapRunInWindow(df["gapGroup"].values.astype(int),
+                                         contDayCriteria)
+        maxGapToContiguousRatio = (maxGapRun / contDayCriteria * 100).astype(object)
+        maxGapToContiguousRatio[maxGapRun == 0] = 0
+        tempDF["maxGapToContiguousRatio"] = maxGapToContiguousRatio
+
+    return tempDF
 
-        gapGroups = \
-            df.gapGroup.iloc[i:tempIndex].loc[df.gapGroup > 0].astype(str)
 
-        if len(gapGroups) > 0:
-            maxGapToContiguousRatio = \
-                gapGroups.describe()["freq"] / contDayCriteria * 100
-        else:
-            maxGapToContiguousRatio = 0
-
-        tempDF.loc[i, "maxGapToContiguousRatio"] = maxGapToContiguousRatio
+def getQualifyingTier(df, criteriaName, contDayCriteria,
+                      avgBolusCalculationsCriteria, percQualDayCriteria,
+                      maxGapToContRatioCriteria):
 
-        tier = (numberContiguousDays == contDayCriteria
-                and avgBolusCalculationsPerDay >= avgBolusCalculationsCriteria
-                and percentQualifyingDays >= percQualDayCriteria
-                and maxGapToContiguousRatio <= maxGapToContRatioCriteria)
+    tempDF = getSlidingWindowStats(df, contDayCriteria)
 
-        tempDF.loc[i, "tier"] = tier
+    tempDF["tier"] = \
+        ((tempDF["numberContiguousDays"] == contDayCriteria) &
+         (tempDF["avgBolusCalculationsPerDay"].astype(float) >=
+          avgBolusCalculationsCriteria) &
+         (tempDF["percentQualifyingDays"].astype(float) >=
+          percQualDayCriteria) &
+         (tempDF["maxGapToContiguousRatio"].astype(float) <=
+          maxGapToContRatioCriteria)).astype(object)
 
     df = pd.concat([df, tempDF.add_prefix(criteriaName + ".")], axis=1)
 
@@ -408,113 +487,6 @@ def qualify(df, metaDF, q, idx):
     return df, metaDF
 
 
-def temp_remove_fields(df, removeFields):
-
-    tempRemoveFields = list(set(df) & set(removeFields))
-    tempDf = df[tempRemoveFields]
-    df = df.drop(columns=tempRemoveFields)
-
-    return df, tempDf
-
-
-def flatten_json(df, doNotFlattenList):
-    # remove fields that we don't want to flatten
-    df, holdData = temp_remove_fields(df, doNotFlattenList)
-
-    # get a list of data types of column headings
-    columnHeadings = list(df)
-
-    # loop through each columnHeading
-    newDataFrame = pd.DataFrame()
-
-    for colHead in columnHeadings:
-        if any(isinstance(item, list) for item in df[colHead]):
-            listBlob = df[colHead][df[colHead].astype(str).str[0] == "["]
-            df.loc[listBlob.index, colHead] = df.loc[listBlob.index, colHead].str[0]
-
-        # if the df field has embedded json
-        if any(isinstance(item, dict) for item in df[colHead]):
-            # grab the data that is in brackets
-            jsonBlob = df[colHead][df[colHead].astype(str).str[0] == "{"]
-
-            # replace those values with nan
-            df.loc[jsonBlob.index, colHead] = np.nan
-
-            # turn jsonBlob to dataframe
-            newDataFrame = pd.concat([newDataFrame, pd.DataFrame(jsonBlob.tolist(),
-                                     index=jsonBlob.index).add_prefix(colHead + '.')], axis=1)
-
-    df = pd.concat([df, newDataFrame, holdData], axis=1)
-
-    df.sort_index(axis=1, inplace=True)
-
-    return df
-
-
-def round_time(df, timeIntervalMinutes=5, timeField="time",
-               roundedTimeFieldName="roundedTime", startWithFirstRecord=True,
-               verbose=False):
-    '''
-    A general purpose round time function that rounds the "time"
-    field to nearest <timeIntervalMinutes> minutes
-    INPUTS:
-        * a dataframe (df) that contains a time field that you want to round
-        * timeIntervalMinutes (defaults to 5 minutes given that most cgms output every 5 minutes)
-        * timeField to round (defaults to the UTC time "time" field)
-        * roundedTimeFieldName is a user specified column name (defaults to roundedTime)
-        * startWithFirstRecord starts the rounding with the first record if True, and the last record if False (defaults to True)
-        * verbose specifies whether the extra columns used to make calculations are returned
-    '''
-
-    df.sort_values(by=timeField, ascending=startWithFirstRecord, inplace=True)
-    df.reset_index(drop=True, inplace=True)
-
-    # make sure the time field is in the right form
-    t = pd.to_datetime(df[timeField].astype('datetime64[ns]'))
-
-    # calculate the time between consecutive records
-    t_shift = pd.to_datetime(df[timeField].astype('datetime64[ns]').shift(1))
-    df["timeBetweenRecords"] = \
-        round((t - t_shift).dt.days*(86400/(60 * timeIntervalMinutes)) +
-              (t - t_shift).dt.seconds/(60 * timeIntervalMinutes)) * timeIntervalMinutes
-
-    # separate the data into chunks if timeBetweenRecords is greater than
-    # 2 times the <timeIntervalMinutes> minutes so the rounding process starts over
-    largeGaps = list(df.query("abs(timeBetweenRecords) > " + str(timeIntervalMinutes * 2)).index)
-    largeGaps.insert(0, 0)
-    largeGaps.append(len(df))
-
-    for gIndex in range(0, len(largeGaps) - 1):
-        chunk = t[largeGaps[gIndex]:largeGaps[gIndex+1]]
-        firstRecordChunk = t[largeGaps[gIndex]]
-
-        # calculate the time difference between each time record and the first record
-        df.loc[largeGaps[gIndex]:largeGaps[gIndex+1], "minutesFromFirstRecord"] = \
-            (chunk - firstRecordChunk).dt.days*(86400/(60)) + (chunk - firstRecordChunk).dt.seconds/(60)
-
-        # then round to the nearest X Minutes
-        # NOTE: the ".000001" ensures that mulitples of 2:30 always rounds up.
-        df.loc[largeGaps[gIndex]:largeGaps[gIndex+1], "roundedMinutesFromFirstRecord"] = \
-            round((df.loc[largeGaps[gIndex]:largeGaps[gIndex+1],
-                          "minutesFromFirstRecord"] / timeIntervalMinutes) + 0.000001) * (timeIntervalMinutes)
-
-        roundedFirstRecord = (firstRecordChunk + pd.Timedelta("1microseconds")).round(str(timeIntervalMinutes) + "min")
-        df.loc[largeGaps[gIndex]:largeGaps[gIndex+1], roundedTimeFieldName] = \
-            roundedFirstRecord + \
-            pd.to_timedelta(df.loc[largeGaps[gIndex]:largeGaps[gIndex+1],
-                                   "roundedMinutesFromFirstRecord"], unit="m")
-
-    # sort by time and drop fieldsfields
-    df.sort_values(by=timeField, ascending=startWithFirstRecord, inplace=True)
-    df.reset_index(drop=True, inplace=True)
-    if verbose is False:
-        df.drop(columns=["timeBetweenRecords",
-                         "minutesFromFirstRecord",
-                         "roundedMinutesFromFirstRecord"], inplace=True)
-
-    return df
-
-
 def make_folder_if_doesnt_exist(folder_paths):
     ''' function requires a single path or a list of paths'''
     if not isinstance(folder_paths, list):
@@ -525,240 +497,300 @@ def make_folder_if_doesnt_exist(folder_paths):
     return
 
 
-# %% load in all data for user
-userid = args.userid
-if pd.isnull(userid):
-    userid = input("Enter Tidepool userid:\n")
-
-metadata = pd.DataFrame(index=[userid])
-
-phi_date_stamp = "PHI-" + args.date_stamp
-donor_folder = os.path.join(args.data_path, phi_date_stamp + "-donor-data")
-
-qualCriteria = json.load(args.qualificationCriteria)
-criteriaMaxCgmPointsPerDay = 1440 / qualCriteria["timeFreqMin"]
-qualifiedOn = dt.datetime.now().strftime("%Y-%m-%d")
-
-qualify_path = os.path.join(
-    donor_folder,
-    args.date_stamp + "-qualified-by-" + qualCriteria["name"] + "-criteria"
-)
-
-metadata_path = os.path.join(qualify_path, "metadata")
-dayStats_path = os.path.join(qualify_path, "dayStats")
-make_folder_if_doesnt_exist([metadata_path, dayStats_path])
-
-dataset_path = os.path.join(donor_folder, phi_date_stamp + "-csvData")
-file_path = os.path.join(dataset_path, "PHI-" + userid + ".csv")
-
-if os.path.exists(file_path):
-    file_size = os.stat(file_path).st_size
-    metadata["fileSize"] = file_size
-    if file_size > 1000:
-        data = pd.read_csv(file_path, low_memory=False)
-
-        # attach upload time to each record, for resolving duplicates
-        data = add_uploadDateTime(data)
-
-        # remove extra data types that are not needed for qualification
-        data = data[
-            (data["type"] == "cbg") |
-            (data["type"] == "basal") |
-            (data["type"] == "bolus") |
-            (data["type"] == "wizard")
-        ]
-
-        # filter by only hybridClosedLoop data
-        if "hClosedLoop" in qualCriteria["name"]:
-            if "basal" in data.type.unique():
-                data["date"] = pd.to_datetime(data.time).dt.date
-                bd = data[(data.type == "basal") & (data.deliveryType == "temp")]
-                tempBasalCounts = pd.DataFrame(bd.groupby("date").deliveryType.count()).reset_index()
-                tempBasalCounts.rename({"deliveryType": "tempBasalCounts"}, axis=1, inplace=True)
-                data = pd.merge(data, tempBasalCounts, on="date")
-                data = data[data.tempBasalCounts >= qualCriteria["nTempBasalsPerDayIsClosedLoop"]]
-            else:
-                data = pd.DataFrame(columns=list(data))
-
-        # filter by only 670g data
-        if "m670g" in qualCriteria["name"]:
-            data = data[data.deviceId.str.contains("1780")]
-
-        # flatten json
-        do_not_flatten_list = ["suppressed", "recommended", "payload"]
-        data = flatten_json(data, do_not_flatten_list)
-
-        if (("cbg" in data.type.unique()) and ("bolus" in data.type.unique())):
-
-            # get rid of all negative durations
-            data, numberOfNegativeDurations = removeNegativeDurations(data)
-            metadata["all.negativeDurationsRemoved.count"] = numberOfNegativeDurations
+def get_qualify_paths(data_path, date_stamp, qualCriteria):
+    '''
+    returns a dictionary with the input (dataset) and output (metadata and
+    dayStats) paths of a qualification run, and creates the output folders
+    '''
+    phi_date_stamp = "PHI-" + date_stamp
+    donor_folder = os.path.join(data_path, phi_date_stamp + "-donor-data")
 
-            # group data by type
-            groupedData = data.groupby(by="type")
+    qualify_path = os.path.join(
+        donor_folder,
+        date_stamp + "-qualified-by-" + qualCriteria["name"] + "-criteria"
+    )
 
-            # %% CGM
-            # filter by cgm and sort by time
-            cgmData = filterAndSort(groupedData, "cbg", "time")
+    paths = {
+        "dataset": os.path.join(donor_folder, phi_date_stamp + "-csvData"),
+        "parquetDataset": os.path.join(
+            donor_folder, phi_date_stamp + "-parquetData"
+        ),
+        "qualify": qualify_path,
+        "metadata": os.path.join(qualify_path, "metadata"),
+        "dayStats": os.path.join(qualify_path, "dayStats"),
+    }
+    make_folder_if_doesnt_exist([paths["metadata"], paths["dayStats"]])
 
-            # get rid of cbg values too low/high (< 38 & > 402 mg/dL)
-            cgmData, numberOfInvalidCgmValues = removeInvalidCgmValues(cgmData)
-            metadata["cgm.invalidValues.count"] = numberOfInvalidCgmValues
+    return paths
 
-            # get rid of duplicates that have the same ["deviceTime", "value"]
-            cgmData, nDuplicatesRemovedDeviceTime = removeCgmDuplicates(cgmData, "deviceTime")
-            metadata["cgm.nDuplicatesRemovedDeviceTime.count"] = nDuplicatesRemovedDeviceTime
 
-            # get rid of duplicates that have the same ["time", "value"]
-            cgmData, nDuplicatesRemovedUtcTime = removeCgmDuplicates(cgmData, "time")
+# %% START OF CODE
+def qualify_dataset(userid, qualCriteria, paths, save_dayStats=False):
+    '''
+    qualify a single donor dataset
+    INPUTS:
+        * userid of the donor
+        * qualCriteria is the (loaded) qualification criteria json
+        * paths is the dictionary returned by get_qualify_paths
+        * save_dayStats saves the day stats used for qualifying if True
+    OUTPUTS:
+        * the metadata of the dataset, which is also saved to the metadata path
+    '''
+    metadata = pd.DataFrame(index=[userid])
+    criteriaMaxCgmPointsPerDay = 1440 / qualCriteria["timeFreqMin"]
+    file_path = os.path.join(paths["dataset"], "PHI-" + userid + ".csv")
+
+    # prefer the parquet dataset, which only reads the types that are needed
+    parquet_path = paths.get("parquetDataset")
+    is_parquet = (
+        (parquet_path is not None)
+        and donor_data_store.donor_exists(parquet_path, userid)
+    )
 
-            metadata["cgm.nDuplicatesRemovedUtcTime.count"] = \
-                nDuplicatesRemovedUtcTime
+    if is_parquet or os.path.exists(file_path):
 
-            # round time to the nearest 5 minutes
-            cgmData = round_time(
-                cgmData,
-                timeIntervalMinutes=5,
-                timeField="time",
-                roundedTimeFieldName="roundedTime",
-                verbose=False
+        if is_parquet:
+            file_size = donor_data_store.get_donor_size(parquet_path, userid)
+        else:
+            file_size = os.stat(file_path).st_size
+        metadata["fileSize"] = file_size
+        if file_size > 1000:
+            if is_parquet:
+                data = donor_data_store.load_donor_dataset(
+                    parquet_path,
+                    userid,
+                    types=["upload", "cbg", "basal", "bolus", "wizard"]
+                )
+            else:
+                data = pd.read_csv(file_path, low_memory=False)
+
+            # attach upload time to each record, for resolving duplicates
+            data = add_uploadDateTime(data)
+
+            # remove extra data types that are not needed for qualification
+            data = data[
+                (data["type"] == "cbg") |
+                (data["type"] == "basal") |
+                (data["type"] == "bolus") |
+                (data["type"] == "wizard")
+            ]
+
+            # filter by only hybridClosedLoop data
+            if "hClosedLoop" in qualCriteria["name"]:
+                if "basal" in data.type.unique():
+                    data["date"] = pd.to_datetime(data.time).dt.date
+                    bd = data[(data.type == "basal") & (data.deliveryType == "temp")]
+                    tempBasalCounts = pd.DataFrame(bd.groupby("date").deliveryType.count()).reset_index()
+                    tempBasalCounts.rename({"deliveryType": "tempBasalCounts"}, axis=1, inplace=True)
+                    data = pd.merge(data, tempBasalCounts, on="date")
+                    data = data[data.tempBasalCounts >= qualCriteria["nTempBasalsPerDayIsClosedLoop"]]
+                else:
+                    data = pd.DataFrame(columns=list(data))
+
+            # filter by only 670g data
+            if "m670g" in qualCriteria["name"]:
+                data = data[data.deviceId.str.contains("1780")]
+
+            # flatten json
+            do_not_flatten_list = ["suppressed", "recommended", "payload"]
+            data = td.clean.flatten_json(
+                data,
+                do_not_flatten=do_not_flatten_list,
+                first_of_lists=True
             )
-
-            # get rid of duplicates that have the same "roundedTime"
-            cgmData, nDuplicatesRemovedRoundedTime = removeDuplicates(cgmData, "roundedTime")
-
-            metadata["cgm.nDuplicatesRemovedRoundedTime.count"] = nDuplicatesRemovedRoundedTime
-
-            # calculate day or date of data
-            cgmData["dayIndex"] = cgmData.roundedTime.dt.date
-
-            # get start and end times
-            cgmBeginDate, cgmEndDate = getStartAndEndTimes(cgmData, "dayIndex")
-            metadata["cgm.beginDate"] = cgmBeginDate
-            metadata["cgm.endDate"] = cgmEndDate
-
-            # get a list of dexcom cgms
-            cgmData, percentDexcom = getListOfDexcomCGMDays(cgmData)
-            metadata["cgm.percentDexcomCGM"] = percentDexcom
-
-            # group by date (day) and get stats
-            catDF = cgmData.groupby(cgmData["dayIndex"])
-            cgmRecordsPerDay = \
-                pd.DataFrame(catDF.value.count()). \
-                rename(columns={"value": "cgm.count"})
-            dayDate = catDF.dayIndex.describe()["top"]
-            dexcomCGM = catDF.dexcomCGM.describe()["top"]
-            nTypesCGM = catDF.dexcomCGM.describe()["unique"]
-            cgmRecordsPerDay["cgm.dexcomOnly"] = \
-                (dexcomCGM & (nTypesCGM == 1))
-            cgmRecordsPerDay["date"] = cgmRecordsPerDay.index
-
-            # %% BOLUS
-            # filter by bolus and sort by time
-            bolusData = filterAndSort(groupedData, "bolus", "time")
-
-            # get rid of duplicates
-            bolusData, nDuplicatesRemoved = removeDuplicates(bolusData, ["time", "normal"])
-            metadata["bolus.duplicatesRemoved.count"] = nDuplicatesRemoved
-
-            # calculate day or date of data
-            bolusData["dayIndex"] = pd.DatetimeIndex(bolusData.time).date
-
-            # get start and end times
-            bolusBeginDate, bolusEndDate = getStartAndEndTimes(bolusData,
-                                                               "dayIndex")
-            metadata["bolus.beginDate"] = bolusBeginDate
-            metadata["bolus.endDate"] = bolusEndDate
-
-            # group by date and get bolusRecordsPerDay
-            catDF = bolusData.groupby(bolusData["dayIndex"])
-            bolusRecordsPerDay = \
-                pd.DataFrame(catDF.subType.count()). \
-                rename(columns={"subType": "bolus.count"})
-
-            bolusRecordsPerDay["date"] = bolusRecordsPerDay.index
-
-            # % GET CALCULATOR DATA (AKA WIZARD DATA)
-            calculatorRecordsPerDay, metadata = getCalculatorCounts(groupedData, metadata)
-
-            # % GET CLOSED LOOP DAYS WITH TEMP BASAL DATA
-            isClosedLoopDay, is670g, metadata = \
-                getClosedLoopDays(groupedData, qualCriteria, metadata)
-
-            # % CONTIGUOUS DATA
-            # calculate the start and end of contiguous data
-            contiguousBeginDate = max(cgmBeginDate, bolusBeginDate)
-            contiguousEndDate = min(cgmEndDate, bolusEndDate)
-            metadata["contiguous.beginDate"] = contiguousBeginDate
-            metadata["contiguous.endDate"] = contiguousEndDate
-
-            # create a dataframe over the contiguous time series
-            rng = pd.date_range(contiguousBeginDate, contiguousEndDate).date
-            contiguousData = pd.DataFrame(rng, columns=["date"])
-
-            # merge data
-            contiguousData = pd.merge(contiguousData, bolusRecordsPerDay,
-                                      on="date", how="left")
-            contiguousData = pd.merge(contiguousData, cgmRecordsPerDay,
-                                      on="date", how="left")
-            contiguousData = pd.merge(contiguousData, calculatorRecordsPerDay,
-                                      on="date", how="left")
-            contiguousData = pd.merge(contiguousData, isClosedLoopDay,
-                                      on="date", how="left")
-            contiguousData = pd.merge(contiguousData, is670g,
-                                      on="date", how="left")
-
-            # fill in nan's with 0s
-            for dataType in ["bolus", "cgm", "calculator", "basal.temp"]:
-                dataType = dataType + ".count"
-
-                if dataType in list(contiguousData):
-                    contiguousData[dataType] = \
-                        contiguousData[dataType].fillna(0)
-
-            if ((len(contiguousData) > 0) &
-               (sum(contiguousData["cgm.count"] > 0) > 0) &
-               (sum(contiguousData["bolus.count"] > 0) > 0)):
-
-                # % QUALIFICATION AT DAY LEVEL
-                # dexcom specific qualification criteria
-                if qualCriteria["name"] == "dexcom":
-                    contiguousData = dexcomCriteria(contiguousData)
-
-                # determine if each day qualifies
-                contiguousData = \
-                    isQualifyingDay(contiguousData,
-                                    qualCriteria["bolusesPerDay"],
-                                    qualCriteria["cgmPercentPerDay"],
-                                    criteriaMaxCgmPointsPerDay)
-                # calcuate summary stats
-                metadata = getSummaryStats(metadata, contiguousData)
-
-                # % QUALIFICATION OF DATASET
-                contiguousData, metadata = qualify(contiguousData, metadata,
-                                                   qualCriteria, userid)
-
-                # % SAVE RESULTS
-                tier = metadata[qualCriteria["tierAbbr"] + ".topTier"].values[0]
-                contiguousData.index.name = "dayIndex"
-                if ast.literal_eval(args.save_dayStats):
-                    contiguousData.to_csv(
-                        os.path.join(dayStats_path, userid + ".csv")
-                    )
-
-                # update on progress
-                output_message = "qualifed as %s" % tier
+            data.sort_index(axis=1, inplace=True)
+
+            if (("cbg" in data.type.unique()) and ("bolus" in data.type.unique())):
+
+                # get rid of all negative durations
+                data, numberOfNegativeDurations = removeNegativeDurations(data)
+                metadata["all.negativeDurationsRemoved.count"] = numberOfNegativeDurations
+
+                # group data by type
+                groupedData = data.groupby(by="type")
+
+                # %% CGM
+                # filter by cgm and sort by time
+                cgmData = filterAndSort(groupedData, "cbg", "time")
+
+                # get rid of cbg values too low/high (< 38 & > 402 mg/dL)
+                cgmData, numberOfInvalidCgmValues = removeInvalidCgmValues(cgmData)
+                metadata["cgm.invalidValues.count"] = numberOfInvalidCgmValues
+
+                # get rid of duplicates that have the same ["deviceTime", "value"]
+                cgmData, nDuplicatesRemovedDeviceTime = removeCgmDuplicates(cgmData, "deviceTime")
+                metadata["cgm.nDuplicatesRemovedDeviceTime.count"] = nDuplicatesRemovedDeviceTime
+
+                # get rid of duplicates that have the same ["time", "value"]
+                cgmData, nDuplicatesRemovedUtcTime = removeCgmDuplicates(cgmData, "time")
+
+                metadata["cgm.nDuplicatesRemovedUtcTime.count"] = \
+                    nDuplicatesRemovedUtcTime
+
+                # round time to the nearest 5 minutes
+                cgmData = td.clean.round_time_from_first_record(
+                    cgmData,
+                    timeIntervalMinutes=5,
+                    timeField="time",
+                    roundedTimeFieldName="roundedTime",
+                    verbose=False
+                )
+
+                # get rid of duplicates that have the same "roundedTime"
+                cgmData, nDuplicatesRemovedRoundedTime = removeDuplicates(cgmData, "roundedTime")
+
+                metadata["cgm.nDuplicatesRemovedRoundedTime.count"] = nDuplicatesRemovedRoundedTime
+
+                # calculate day or date of data
+                cgmData["dayIndex"] = cgmData.roundedTime.dt.date
+
+                # get start and end times
+                cgmBeginDate, cgmEndDate = getStartAndEndTimes(cgmData, "dayIndex")
+                metadata["cgm.beginDate"] = cgmBeginDate
+                metadata["cgm.endDate"] = cgmEndDate
+
+                # get a list of dexcom cgms
+                cgmData, percentDexcom = getListOfDexcomCGMDays(cgmData)
+                metadata["cgm.percentDexcomCGM"] = percentDexcom
+
+                # group by date (day) and get stats
+                catDF = cgmData.groupby(cgmData["dayIndex"])
+                cgmRecordsPerDay = \
+                    pd.DataFrame(catDF.value.count()). \
+                    rename(columns={"value": "cgm.count"})
+                dayDate = catDF.dayIndex.describe()["top"]
+                dexcomCGM = catDF.dexcomCGM.describe()["top"]
+                nTypesCGM = catDF.dexcomCGM.describe()["unique"]
+                cgmRecordsPerDay["cgm.dexcomOnly"] = \
+                    (dexcomCGM & (nTypesCGM == 1))
+                cgmRecordsPerDay["date"] = cgmRecordsPerDay.index
+
+                # %% BOLUS
+                # filter by bolus and sort by time
+                bolusData = filterAndSort(groupedData, "bolus", "time")
+
+                # get rid of duplicates
+                bolusData, nDuplicatesRemoved = removeDuplicates(bolusData, ["time", "normal"])
+                metadata["bolus.duplicatesRemoved.count"] = nDuplicatesRemoved
+
+                # calculate day or date of data
+                bolusData["dayIndex"] = pd.DatetimeIndex(bolusData.time).date
+
+                # get start and end times
+                bolusBeginDate, bolusEndDate = getStartAndEndTimes(bolusData,
+                                                                   "dayIndex")
+                metadata["bolus.beginDate"] = bolusBeginDate
+                metadata["bolus.endDate"] = bolusEndDate
+
+                # group by date and get bolusRecordsPerDay
+                catDF = bolusData.groupby(bolusData["dayIndex"])
+                bolusRecordsPerDay = \
+                    pd.DataFrame(catDF.subType.count()). \
+                    rename(columns={"subType": "bolus.count"})
+
+                bolusRecordsPerDay["date"] = bolusRecordsPerDay.index
+
+                # % GET CALCULATOR DATA (AKA WIZARD DATA)
+                calculatorRecordsPerDay, metadata = getCalculatorCounts(groupedData, metadata)
+
+                # % GET CLOSED LOOP DAYS WITH TEMP BASAL DATA
+                isClosedLoopDay, is670g, metadata = \
+                    getClosedLoopDays(groupedData, qualCriteria, metadata)
+
+                # % CONTIGUOUS DATA
+                # calculate the start and end of contiguous data
+                contiguousBeginDate = max(cgmBeginDate, bolusBeginDate)
+                contiguousEndDate = min(cgmEndDate, bolusEndDate)
+                metadata["contiguous.beginDate"] = contiguousBeginDate
+                metadata["contiguous.endDate"] = contiguousEndDate
+
+                # create a dataframe over the contiguous time series
+                rng = pd.date_range(contiguousBeginDate, contiguousEndDate).date
+                contiguousData = pd.DataFrame(rng, columns=["date"])
+
+                # merge data
+                contiguousData = pd.merge(contiguousData, bolusRecordsPerDay,
+                                          on="date", how="left")
+                contiguousData = pd.merge(contiguousData, cgmRecordsPerDay,
+                                          on="date", how="left")
+                contiguousData = pd.merge(contiguousData, calculatorRecordsPerDay,
+                                          on="date", how="left")
+                contiguousData = pd.merge(contiguousData, isClosedLoopDay,
+                                          on="date", how="left")
+                contiguousData = pd.merge(contiguousData, is670g,
+                                          on="date", how="left")
+
+                # fill in nan's with 0s
+                for dataType in ["bolus", "cgm", "calculator", "basal.temp"]:
+                    dataType = dataType + ".count"
+
+                    if dataType in list(contiguousData):
+                        contiguousData[dataType] = \
+                            contiguousData[dataType].fillna(0)
+
+                if ((len(contiguousData) > 0) &
+                   (sum(contiguousData["cgm.count"] > 0) > 0) &
+                   (sum(contiguousData["bolus.count"] > 0) > 0)):
+
+                    # % QUALIFICATION AT DAY LEVEL
+                    # dexcom specific qualification criteria
+                    if qualCriteria["name"] == "dexcom":
+                        contiguousData = dexcomCriteria(contiguousData)
+
+                    # determine if each day qualifies
+                    contiguousData = \
+                        isQualifyingDay(contiguousData,
+                                        qualCriteria["bolusesPerDay"],
+                                        qualCriteria["cgmPercentPerDay"],
+                                        criteriaMaxCgmPointsPerDay)
+                    # calcuate summary stats
+                    metadata = getSummaryStats(metadata, contiguousData)
+
+                    # % QUALIFICATION OF DATASET
+                    contiguousData, metadata = qualify(contiguousData, metadata,
+                                                       qualCriteria, userid)
+
+                    # % SAVE RESULTS
+                    tier = metadata[qualCriteria["tierAbbr"] + ".topTier"].values[0]
+                    contiguousData.index.name = "dayIndex"
+                    if save_dayStats:
+                        contiguousData.to_csv(
+                            os.path.join(paths["dayStats"], userid + ".csv")
+                        )
+
+                    # update on progress
+                    output_message = "qualifed as %s" % tier
+                    print(userid, output_message)
+            else:
+                output_message = "file does not contain cgm and bolus data"
                 print(userid, output_message)
         else:
-            output_message = "file does not contain cgm and bolus data"
+            output_message = "file does not contain enough data"
             print(userid, output_message)
     else:
-        output_message = "file does not contain enough data"
+        output_message = "file does not exist"
         print(userid, output_message)
-else:
-    output_message = "file does not exist"
-    print(userid, output_message)
-metadata["outputMessage"] = output_message
-metadata.to_csv(
-    os.path.join(metadata_path, userid + ".csv")
-)
+    metadata["outputMessage"] = output_message
+    metadata.to_csv(
+        os.path.join(paths["metadata"], userid + ".csv")
+    )
+
+    return metadata
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    userid = args.userid
+    if pd.isnull(userid):
+        userid = input("Enter Tidepool userid:\n")
+
+    qualCriteria = json.load(args.qualificationCriteria)
+    paths = get_qualify_paths(args.data_path, args.date_stamp, qualCriteria)
+
+    qualify_dataset(
+        userid,
+        qualCriteria,
+        paths,
+        save_dayStats=ast.literal_eval(args.save_dayStats)
+    )
@@ -242,12 +242,8 @@ def sort_and_pretty_stat_output(df):
 
 
 def get_timeZoneOffset(currentDate, userTz):
-    tz = timezone(userTz)
-    tzoNum = int(tz.localize(pd.to_datetime(currentDate) + timedelta(days=1)).strftime("%z"))
-    tzoHours = np.floor(tzoNum / 100)
-    tzoMinutes = round((tzoNum / 100 - tzoHours) * 100, 0)
-    tzoSign = np.sign(tzoHours)
-    tzo = int((tzoHours * 60) + (tzoMinutes * tzoSign))
+    # the offsets of whole dates are kept in the tidals timezone calendars
+    tzo = td.tz.get_date_offset(pd.to_datetime(currentDate) + timedelta(days=1), userTz)
     return tzo
 
 
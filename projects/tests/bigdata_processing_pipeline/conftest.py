@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+from mock_tidepool_api import start_mock_api, stop_mock_api
+
+pipelinePath = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__), "..", "..", "bigdata-processing-pipeline"
+    )
+)
+getDonorDataPath = os.path.join(pipelinePath, "get-donor-data")
+estimateLocalTimePath = os.path.join(pipelinePath, "estimate-local-time")
+qualifyDataPath = os.path.join(pipelinePath, "qualify-data")
+for path in [
+    pipelinePath, getDonorDataPath, estimateLocalTimePath, qualifyDataPath
+]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def mock_api():
+    server = start_mock_api()
+    yield server
+    stop_mock_api(server)
+
+
+@pytest.fixture
+def api_url(mock_api):
+    return mock_api.url
@@ -0,0 +1,226 @@
+"""a local stand in for the parts of the tidepool api used by get-donor-data"""
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+RECORDS = [
+    {"id": "a1", "type": "cbg", "value": 5.5, "time": "2019-01-01T00:00:00Z"},
+    {"id": "a2", "type": "cbg", "value": 6.1, "time": "2019-01-01T00:05:00Z"},
+    {"id": "a3", "type": "bolus", "normal": 1.5, "time": "2019-01-01T00:06:00Z"},
+    {
+        "id": "a4",
+        "type": "basal",
+        "rate": 0.8,
+        "suppressed": {"type": "basal", "rate": 1.0},
+        "time": "2019-01-01T00:07:00Z"
+    },
+    {"id": "a5", "type": "upload", "deviceTags": ["cgm", "insulin-pump"]},
+]
+
+PROFILE = {
+    "fullName": "Jill Jellyfish",
+    "patient": {"diagnosisType": "type1", "birthday": "1990-01-01"}
+}
+
+
+class MockTidepoolApi(ThreadingHTTPServer):
+    '''
+    keeps count of the logins, requests and connections, and accepts the
+    tokens it has issued. expire_token() invalidates all of the tokens.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockTidepoolHandler)
+        self.nLogins = 0
+        self.nLogouts = 0
+        self.requests = []
+        self.connections = set()
+        # stub settings for the data endpoint
+        self.data_delay = 0
+        self.data_failures = 0
+        self.tag_windows = False
+        # records of an account that are filtered by the query, like the
+        # real api (RECORDS are sent unfiltered if not set)
+        self.records = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.tokens = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server_port
+
+    def expire_token(self):
+        self.tokens = set()
+
+    def handle_error(self, request, client_address):
+        # clients closing their keep-alive connections is not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def fail_data_requests(self, n):
+        ''' the next n data requests fail with a 503 '''
+        self.data_failures = n
+
+
+class MockTidepoolHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    def send_json(self, status, data, headers={}):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def is_authorized(self):
+        return self.headers.get("x-tidepool-session-token") in self.server.tokens
+
+    def read_request(self):
+        # read the body, so the connection can be reused (keep-alive)
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0:
+            self.rfile.read(length)
+        with self.server.lock:
+            self.server.connections.add(self.client_address)
+
+    def do_POST(self):
+        self.read_request()
+        if self.path == "/auth/login":
+            with self.server.lock:
+                self.server.nLogins = self.server.nLogins + 1
+                token = "token-%d" % self.server.nLogins
+                self.server.tokens.add(token)
+            self.send_json(
+                200,
+                {"userid": "master"},
+                headers={"x-tidepool-session-token": token}
+            )
+        elif self.path == "/auth/logout":
+            with self.server.lock:
+                self.server.nLogouts = self.server.nLogouts + 1
+            self.send_json(200, {})
+        else:
+            self.send_json(404, {})
+
+    def do_PUT(self):
+        self.read_request()
+        if not self.is_authorized():
+            self.send_json(401, {})
+            return
+        with self.server.lock:
+            self.server.requests.append(("PUT", self.path))
+        self.send_json(200, {})
+
+    def do_GET(self):
+        self.read_request()
+        if not self.is_authorized():
+            self.send_json(401, {})
+            return
+
+        with self.server.lock:
+            self.server.requests.append(("GET", self.path))
+
+        if self.path.startswith("/metadata/"):
+            self.send_json(200, PROFILE)
+        elif self.path.startswith("/confirm/invitations/"):
+            self.send_json(200, [{"key": "k1", "creatorId": "donor"}])
+        elif self.path.startswith("/access/groups/"):
+            self.send_json(200, {"master": {}, "donor": {}})
+        elif self.path.startswith("/data/"):
+            self.send_data()
+        else:
+            self.send_json(404, {})
+
+    def send_data(self):
+        with self.server.lock:
+            fail = self.server.data_failures > 0
+            if fail:
+                self.server.data_failures = self.server.data_failures - 1
+            self.server.in_flight = self.server.in_flight + 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+        try:
+            time.sleep(self.server.data_delay)
+            if fail:
+                self.send_json(503, {})
+            else:
+                self.send_records()
+        finally:
+            with self.server.lock:
+                self.server.in_flight = self.server.in_flight - 1
+
+    def send_records(self):
+        records = RECORDS
+        query = parse_qs(urlparse(self.path).query)
+        if self.server.records is not None:
+            records = [
+                r for r in self.server.records if matches_query(r, query)
+            ]
+        if self.server.tag_windows:
+            # tag each record with the start of its window
+            records = [
+                dict(r, id=r["id"] + "-" + query["startDate"][0][:10])
+                for r in RECORDS
+            ]
+
+        # send the json array in small chunks, like a long download
+        body = json.dumps(records).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(body), 16):
+            chunk = body[i:i + 16]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def parse_time(time_string):
+    return datetime.strptime(time_string[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def matches_query(record, query):
+    for field in ["type", "uploadId"]:
+        if (field in query) and (record.get(field) != query[field][0]):
+            return False
+
+    for field, is_after in [("startDate", True), ("endDate", False)]:
+        if field in query:
+            if "time" not in record:
+                return False
+            recordTime = parse_time(record["time"])
+            queryTime = parse_time(query[field][0])
+            if (recordTime < queryTime) if is_after else (recordTime > queryTime):
+                return False
+
+    return True
+
+
+def start_mock_api():
+    server = MockTidepoolApi()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+
+    return server
+
+
+def stop_mock_api(server):
+    server.shutdown()
+    server.server_close()
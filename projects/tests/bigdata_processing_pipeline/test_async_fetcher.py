@@ -0,0 +1,374 @@
+import asyncio
+import datetime as dt
+import os
+import time
+
+import pandas as pd
+
+import async_fetcher
+import donor_data_store
+from get_single_tidepool_dataset import get_data_windows
+from job_manifest import JobManifest
+from mock_tidepool_api import RECORDS
+
+
+def get_session_infos(mock_api, donor_groups=["bigdata"]):
+    return {
+        dg: {
+            "auth": ("email", "password"),
+            "api_url": mock_api.url,
+            "token": None,
+            "userid": None
+        }
+        for dg in donor_groups
+    }
+
+
+def test_get_all_donor_data(mock_api, tmpdir):
+    mock_api.tag_windows = True
+    donors = [("donor1", "bigdata"), ("donor2", "JDRF"), ("donor3", "bigdata")]
+
+    results = async_fetcher.get_all_donor_data(
+        donors,
+        get_session_infos(mock_api, ["bigdata", "JDRF"]),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=52*3,
+        requests_per_second=None
+    )
+
+    # one login per donor group, 4 yearly windows per donor
+    nWindows = len(get_data_windows(52*3))
+    assert nWindows == 4
+    assert results == {u: len(RECORDS) * nWindows for u, _ in donors}
+    assert mock_api.nLogins == 2
+
+    # the windows are saved in order, newest first
+    ndjson = os.path.join(
+        str(tmpdir), "PHI-2020-01-01-donor-data", "PHI-2020-01-01-ndjsonData",
+        "PHI-donor1.ndjson"
+    )
+    saved = pd.read_json(ndjson, lines=True)
+    windowStarts = saved["id"].str.split("-", n=1).str[1]
+    assert windowStarts.is_monotonic_decreasing
+    assert windowStarts.nunique() == nWindows
+
+    metadata = pd.read_csv(
+        os.path.join(
+            str(tmpdir), "PHI-2020-01-01-donor-data", "PHI-2020-01-01-metadata",
+            "PHI-donor2.csv"
+        ),
+        index_col="userid"
+    )
+    assert metadata.loc["donor2", "diagnosisType"] == "type1"
+
+
+def test_get_all_donor_data_to_parquet(mock_api, tmpdir):
+    async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="parquet",
+        weeks_of_data=4
+    )
+
+    cbg = donor_data_store.load_donor_dataset(
+        donor_data_store.get_parquet_dataset_path(str(tmpdir), "2020-01-01"),
+        "donor1",
+        types=["cbg"]
+    )
+    assert list(cbg.id) == ["a1", "a2"]
+
+
+def test_concurrency_limit(mock_api, tmpdir):
+    mock_api.data_delay = 0.2
+    donors = [("donor%d" % i, "bigdata") for i in range(4)]
+
+    startTime = time.time()
+    async_fetcher.get_all_donor_data(
+        donors,
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=52*2,
+        max_concurrency=4,
+        requests_per_second=None
+    )
+    duration = time.time() - startTime
+
+    # 12 windows, 4 at a time
+    assert mock_api.max_in_flight == 4
+    assert duration < 12 * 0.2
+
+
+def test_windows_per_donor_limit(mock_api, tmpdir):
+    mock_api.data_delay = 0.1
+    mock_api.tag_windows = True
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=52*5,
+        max_windows_per_donor=2,
+        requests_per_second=None
+    )
+
+    # 6 windows, 2 at a time, still saved in order
+    assert results == {"donor1": len(RECORDS) * 6}
+    assert mock_api.max_in_flight == 2
+    saved = pd.read_json(
+        os.path.join(
+            str(tmpdir), "PHI-2020-01-01-donor-data",
+            "PHI-2020-01-01-ndjsonData", "PHI-donor1.ndjson"
+        ),
+        lines=True
+    )
+    assert saved["id"].str.split("-", n=1).str[1].is_monotonic_decreasing
+
+
+def test_each_donor_runs_its_own_stages(mock_api, tmpdir):
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata"), ("donor2", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=4,
+        donor_stages={"donor1": ["metadata"], "donor2": ["dataset"]}
+    )
+
+    assert results == {"donor1": 0, "donor2": len(RECORDS)}
+    paths = [path for method, path in mock_api.requests]
+    assert [p for p in paths if p.startswith("/metadata/")] == [
+        "/metadata/donor1/profile"
+    ]
+    data_paths = [p for p in paths if p.startswith("/data/")]
+    assert len(data_paths) == 1
+    assert data_paths[0].startswith("/data/donor2")
+
+
+def test_rate_limiter():
+    async def run():
+        limiter = async_fetcher.RateLimiter(20)
+        startTime = time.time()
+        await asyncio.gather(*[limiter.wait() for _ in range(5)])
+        return time.time() - startTime
+
+    assert run_async(run()) >= 4 / 20
+
+
+def test_retries_failed_requests(mock_api, tmpdir):
+    mock_api.fail_data_requests(2)
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=4,
+        backoff_seconds=0.01
+    )
+
+    assert results == {"donor1": len(RECORDS)}
+
+
+def test_gives_up_after_max_retries(mock_api, tmpdir):
+    mock_api.fail_data_requests(10)
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=4,
+        max_retries=2,
+        backoff_seconds=0.01
+    )
+
+    assert results == {"donor1": None}
+    assert len([r for r in mock_api.requests if "/data/" in r[1]]) == 3
+
+
+def test_login_again_when_token_expires(mock_api, tmpdir):
+    session_infos = get_session_infos(mock_api)
+    session_infos["bigdata"]["token"] = "expired"
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata"), ("donor2", "bigdata")],
+        session_infos,
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="csv",
+        weeks_of_data=4,
+        backoff_seconds=0.01
+    )
+
+    assert results == {"donor1": len(RECORDS), "donor2": len(RECORDS)}
+    assert mock_api.nLogins == 1
+
+
+def test_get_data_windows():
+    windows = get_data_windows(52*2, now=dt.datetime(2020, 3, 10, 12))
+
+    assert [w[0] for w in windows] == [
+        dt.datetime(2019, 3, 12),
+        dt.datetime(2018, 3, 12),
+        dt.datetime(2017, 3, 12),
+    ]
+
+
+def run_async(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_failed_write_only_fails_that_donor(mock_api, tmpdir, monkeypatch):
+    manifest = JobManifest(os.path.join(str(tmpdir), "manifest.sqlite"))
+    write_records = donor_data_store.DonorNdjsonWriter.write_records
+
+    def fail_donor1(self, records):
+        if "donor1" in self.file_path:
+            raise OSError("disk full")
+        write_records(self, records)
+
+    monkeypatch.setattr(
+        donor_data_store.DonorNdjsonWriter, "write_records", fail_donor1
+    )
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata"), ("donor2", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=4,
+        manifest=manifest
+    )
+
+    assert results == {"donor1": None, "donor2": len(RECORDS)}
+    ndjson_path = os.path.join(
+        str(tmpdir), "PHI-2020-01-01-donor-data", "PHI-2020-01-01-ndjsonData"
+    )
+    assert os.listdir(ndjson_path) == ["PHI-donor2.ndjson"]
+    jobs = manifest.get_jobs("dataset").set_index("userid")
+    assert jobs.loc["donor1", "status"] == "failed"
+    assert "OSError: disk full" in jobs.loc["donor1", "error"]
+    assert jobs.loc["donor2", "status"] == "done"
+
+
+def test_failed_parquet_write_keeps_saved_donor(mock_api, tmpdir, monkeypatch):
+    args = (
+        [("donor1", "bigdata")], get_session_infos(mock_api), "2020-01-01",
+        str(tmpdir)
+    )
+    async_fetcher.get_all_donor_data(
+        *args, storage_format="parquet", weeks_of_data=4
+    )
+
+    def bad_data(df):
+        raise ValueError("bad data")
+
+    monkeypatch.setattr(donor_data_store, "prepare_for_parquet", bad_data)
+    results = async_fetcher.get_all_donor_data(
+        *args, storage_format="parquet", weeks_of_data=4
+    )
+
+    assert results == {"donor1": None}
+    dataset_path = donor_data_store.get_parquet_dataset_path(
+        str(tmpdir), "2020-01-01"
+    )
+    assert os.listdir(dataset_path) == ["userid=donor1"]
+    assert len(
+        donor_data_store.load_donor_dataset(dataset_path, "donor1")
+    ) == len(RECORDS)
+
+
+def test_donor_limit(mock_api, tmpdir, monkeypatch):
+    mock_api.data_delay = 0.1
+    get_sink = async_fetcher.get_sink
+    open_sinks = []
+    max_open_sinks = []
+
+    def track_sink(*args):
+        # count the sinks that are open (created, but not closed or aborted)
+        sink = get_sink(*args)
+        close, abort = sink.close, sink.abort
+
+        def close_sink():
+            open_sinks.remove(sink)
+            return close()
+
+        def abort_sink():
+            open_sinks.remove(sink)
+            return abort()
+
+        sink.close, sink.abort = close_sink, abort_sink
+        open_sinks.append(sink)
+        max_open_sinks.append(len(open_sinks))
+        return sink
+
+    monkeypatch.setattr(async_fetcher, "get_sink", track_sink)
+    donors = [("donor%d" % i, "bigdata") for i in range(5)]
+
+    results = async_fetcher.get_all_donor_data(
+        donors,
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=52*2,
+        max_donors=2,
+        max_windows_per_donor=1,
+        requests_per_second=None
+    )
+
+    # 5 donors, 2 at a time, with one window each in flight
+    assert results == {u: len(RECORDS) * 3 for u, _ in donors}
+    assert mock_api.max_in_flight == 2
+    assert len(max_open_sinks) == 5
+    assert max(max_open_sinks) == 2
+    assert open_sinks == []
+
+
+def test_windows_are_written_in_batches(mock_api, tmpdir, monkeypatch):
+    mock_api.tag_windows = True
+    batch_sizes = []
+    write_records = donor_data_store.DonorNdjsonWriter.write_records
+
+    def record_batch(self, records):
+        batch_sizes.append(len(records))
+        write_records(self, records)
+
+    monkeypatch.setattr(
+        donor_data_store.DonorNdjsonWriter, "write_records", record_batch
+    )
+
+    results = async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        get_session_infos(mock_api),
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=52*2,
+        batch_size=2,
+        requests_per_second=None
+    )
+
+    assert results == {"donor1": len(RECORDS) * 3}
+    assert max(batch_sizes) == 2
+    assert sum(batch_sizes) == len(RECORDS) * 3
+    saved = pd.read_json(
+        os.path.join(
+            str(tmpdir), "PHI-2020-01-01-donor-data",
+            "PHI-2020-01-01-ndjsonData", "PHI-donor1.ndjson"
+        ),
+        lines=True
+    )
+    assert saved["id"].str.split("-", n=1).str[1].is_monotonic_decreasing
@@ -0,0 +1,162 @@
+import json
+import os
+
+import pandas as pd
+
+import donor_data_store
+
+
+records = [
+    {
+        "id": "c1", "type": "cbg", "time": "2019-01-01T00:00:00.000Z",
+        "value": 5.5, "units": "mmol/L",
+        "payload": {
+            "systemTime": "2019-01-01T00:00:00", "trend": {"rate": 1.5}
+        },
+        "annotations": [{"code": "bg/out-of-range"}],
+    },
+    {
+        "id": "c2", "type": "cbg", "time": "2019-01-01T00:05:00.000Z",
+        "value": 6.1, "units": "mmol/L",
+        "payload": {"systemTime": "2019-01-01T00:05:00"},
+    },
+    {
+        "id": "w1", "type": "wizard", "time": "2019-01-01T08:00:00.000Z",
+        "bolus": "b1", "carbInput": 30,
+        "recommended": {"carb": 2.5, "correction": 0.5, "net": 3.0},
+    },
+    {
+        "id": "b1", "type": "bolus", "subType": "normal",
+        "time": "2019-01-01T08:00:00.000Z", "normal": 3.0,
+    },
+    {
+        "id": "t1", "type": "basal", "deliveryType": "temp",
+        "time": "2019-01-01T01:00:00.000Z", "duration": 1800000, "rate": 0.5,
+        "suppressed": {
+            "type": "basal", "deliveryType": "scheduled", "rate": 0.8,
+            "annotations": [{"code": "basal/auto"}],
+        },
+    },
+    {
+        "id": "c3", "type": "cbg", "time": "2019-01-01T00:10:00.000Z",
+        "value": 7.2, "units": "mmol/L",
+    },
+    {
+        "id": "u1", "type": "upload", "time": "2019-01-02T00:00:00.000Z",
+        "uploadId": "up1", "deviceTags": ["cgm", "insulin-pump"],
+    },
+]
+
+
+def write_donor(tmpdir):
+    # write the same donor, in two batches, to the parquet dataset and to a
+    # csv file
+    dataset_path = str(tmpdir.join("parquetData"))
+    csv_path = str(tmpdir.join("PHI-donor.csv"))
+    for sink in [
+        donor_data_store.DonorParquetWriter(dataset_path, "donor"),
+        donor_data_store.DonorCsvWriter(csv_path),
+    ]:
+        sink.write_records(records[:3])
+        sink.write_records(records[3:])
+        sink.close()
+
+    return dataset_path, csv_path
+
+
+def read_csv_as_parquet(csv_path):
+    # the csv path, in the form the parquet dataset stores it
+    df = pd.read_csv(csv_path, low_memory=False)
+    df = df.drop(columns="Unnamed: 0")
+    df = donor_data_store.parse_embedded_json(df)
+
+    return donor_data_store.prepare_for_parquet(df)
+
+
+def assert_same_data(df, expected):
+    df = df.sort_values("id").reset_index(drop=True)
+    expected = expected.sort_values("id").reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        df.sort_index(axis=1), expected.sort_index(axis=1),
+        check_dtype=False
+    )
+
+
+def test_round_trip(tmpdir):
+    dataset_path, csv_path = write_donor(tmpdir)
+
+    df = donor_data_store.load_donor_dataset(dataset_path, "donor")
+
+    assert len(df) == len(records)
+    assert_same_data(df, read_csv_as_parquet(csv_path))
+
+    # the embedded json is flattened, and the lists are json strings
+    df = df.set_index("id")
+    assert "payload" not in list(df)
+    assert df.loc["c1", "payload.systemTime"] == "2019-01-01T00:00:00"
+    assert df.loc["c1", "payload.trend.rate"] == 1.5
+    assert df.loc["w1", "recommended.net"] == 3.0
+    assert df.loc["t1", "suppressed.rate"] == 0.8
+    assert json.loads(df.loc["t1", "suppressed.annotations"]) == \
+        [{"code": "basal/auto"}]
+    assert json.loads(df.loc["c1", "annotations"]) == \
+        [{"code": "bg/out-of-range"}]
+    assert json.loads(df.loc["u1", "deviceTags"]) == ["cgm", "insulin-pump"]
+    # the rows of each type are in the order they were saved
+    assert list(df[df["type"] == "cbg"].index) == ["c1", "c2", "c3"]
+
+
+def test_load_types_columns_and_filters(tmpdir):
+    dataset_path, csv_path = write_donor(tmpdir)
+    csv_data = read_csv_as_parquet(csv_path)
+
+    df = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", types=["cbg", "wizard"]
+    )
+    assert_same_data(
+        df,
+        csv_data[csv_data["type"].isin(["cbg", "wizard"])]
+        .dropna(axis=1, how="all")
+    )
+
+    columns = ["id", "type", "time", "value", "payload.systemTime"]
+    df = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", types=["cbg", "bolus"], columns=columns
+    )
+    assert list(df) == columns
+    assert_same_data(df, csv_data.loc[
+        csv_data["type"].isin(["cbg", "bolus"]), columns
+    ])
+
+    # the filtered column is only in the cbg partition
+    df = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", columns=["id", "value"],
+        filters=[("value", ">", 6)]
+    )
+    assert_same_data(
+        df, csv_data.loc[csv_data["value"] > 6, ["id", "value"]]
+    )
+
+    df = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", types=["food"], columns=["id", "value"]
+    )
+    assert len(df) == 0
+    assert list(df) == ["id", "value"]
+
+
+def test_convert_csv_folder(tmpdir):
+    _, csv_path = write_donor(tmpdir)
+
+    dataset_path = str(tmpdir.join("convertedData"))
+    donor_data_store.convert_csv_folder(str(tmpdir), dataset_path)
+
+    assert_same_data(
+        donor_data_store.load_donor_dataset(dataset_path, "donor"),
+        read_csv_as_parquet(csv_path)
+    )
+    assert donor_data_store.get_donor_size(dataset_path, "donor") == \
+        sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(dataset_path)
+            for f in files if f.endswith(".parquet")
+        )
@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import estimate_local_time as elt
+
+
+timezone_aliases_path = os.path.join(
+    os.path.dirname(elt.__file__), "wikipedia-timezone-aliases-2018-04-28.csv"
+)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def tz_calendar_path(tmpdir_factory):
+    # keep the timezone offset calendars out of the user's cache
+    calendar_path = elt.td.tz.CALENDAR_PATH
+    elt.td.tz.CALENDAR_PATH = str(tmpdir_factory.mktemp("tz-calendar"))
+    yield elt.td.tz.CALENDAR_PATH
+    elt.td.tz.CALENDAR_PATH = calendar_path
+
+
+@pytest.fixture(scope="module")
+def timezone_aliases():
+    return elt.load_timezone_aliases(timezone_aliases_path)
+
+
+def test_convert_deprecated_timezone_to_alias(timezone_aliases):
+    df = pd.DataFrame({"timezone": [
+        "US/Mountain", "America/Denver", "Calcutta", None, "Mountain", "Foo"
+    ]})
+
+    df = elt.convertDeprecatedTimezoneToAlias(df, timezone_aliases)
+
+    assert df.timezone.dtype == "category"
+    # "Mountain" is the end of both US/Mountain and Canada/Mountain
+    assert list(df.timezone.astype(object).fillna("")) == [
+        "America/Denver", "America/Denver", "Asia/Kolkata", "",
+        "Mountain", "Foo"
+    ]
+
+
+def test_load_timezone_aliases_cache(tmpdir, timezone_aliases):
+    cache_path = str(tmpdir.join("timezoneAliasMap.json"))
+
+    assert elt.load_timezone_aliases(
+        timezone_aliases_path, cache_path
+    ) == timezone_aliases
+    assert os.path.exists(cache_path)
+    # the second load comes from the cache
+    with open(cache_path, "w") as cache_file:
+        cache_file.write('{"Mountain": "America/Denver"}')
+    assert elt.load_timezone_aliases(timezone_aliases_path, cache_path) == {
+        "Mountain": "America/Denver"
+    }
+
+
+def make_data(days, timezone="US/Mountain"):
+    # a cgm (or smbg if there is no timezoneOffset) value every 2 hours of
+    # each (date, timezoneOffset, has_upload) day, and a healthkit upload
+    rows = []
+    for date, tzo, has_upload in days:
+        for hour in range(0, 24, 2):
+            rows.append({
+                "type": "smbg" if tzo is None else "cbg",
+                "time": "%sT%02d:30:00.000Z" % (date, hour),
+                "timezoneOffset": tzo,
+                "conversionOffset": 0,
+            })
+        if has_upload:
+            rows.append({
+                "type": "upload",
+                "time": date + "T18:00:00.000Z",
+                "timezone": timezone,
+                "timezoneOffset": tzo,
+                "conversionOffset": 0,
+                "deviceTags": "['cgm']",
+                "timeProcessing": "none",
+            })
+
+    return pd.DataFrame(rows)
+
+
+def test_estimate_local_time_example(timezone_aliases):
+    data, _ = elt.checkInputFile(
+        os.path.join(os.path.dirname(elt.__file__), "example-csv.csv")
+    )
+
+    data, day_series = elt.estimate_local_time(
+        data, timezone_aliases, "2010-01-01", "2020-01-01"
+    )
+
+    assert data["est.localTime"].notnull().all()
+    assert (
+        data["est.localTime"] ==
+        data["utcTime"] + pd.to_timedelta(data["est.timezoneOffset"], unit="m")
+    ).all()
+    assert set(data.date) <= set(day_series.date)
+    assert (day_series["est.version"] == elt.codeVersion).all()
+
+
+def test_estimate_local_time_around_dst(timezone_aliases):
+    days = [
+        (d.strftime("%Y-%m-%d"), -420 if d.day < 11 else -360, True)
+        for d in pd.date_range("2018-03-08", "2018-03-13")
+    ]
+
+    data, day_series = elt.estimate_local_time(
+        make_data(days), timezone_aliases, "2010-01-01", "2020-01-01"
+    )
+
+    assert (day_series["est.type"] == "UPLOAD").all()
+    assert (day_series["est.timezone"] == "America/Denver").all()
+    assert data["est.timezone"].dtype == "category"
+    # dst starts on 2018-03-11 at 2am local time, 9am utc
+    dst_day = data[data.time.str.startswith("2018-03-11")]
+    before = dst_day.time < "2018-03-11T09"
+    assert (dst_day.loc[before, "est.timezoneOffset"] == -420).all()
+    assert (dst_day.loc[~before, "est.timezoneOffset"] == -360).all()
+
+
+def test_estimate_local_time_imputes_gaps(timezone_aliases):
+    # uploads on the first and last 2 days, and no timezoneOffset on days 5-7
+    days = [
+        (d.strftime("%Y-%m-%d"), None if 4 <= i <= 6 else -420, i in [0, 1, 8, 9])
+        for i, d in enumerate(pd.date_range("2018-01-01", "2018-01-10"))
+    ]
+
+    _, day_series = elt.estimate_local_time(
+        make_data(days), timezone_aliases, "2010-01-01", "2020-01-01"
+    )
+
+    day_series = day_series.set_index("date")["est.type"]
+    assert list(day_series.sort_index()) == [
+        "UPLOAD", "UPLOAD", "DEVICE", "DEVICE",
+        "IMPUTE", "IMPUTE", "IMPUTE", "DEVICE", "UPLOAD", "UPLOAD"
+    ]
+
+
+def test_large_timezone_offset_correction():
+    df = pd.DataFrame({
+        "timezoneOffset": [840, 841, 2281, -720, -721, -3000, np.nan],
+        "conversionOffset": [0, 0, 0, 0, 0, 0, 0],
+    })
+
+    df, n_corrected = elt.largeTimezoneOffsetCorrection(df)
+
+    assert n_corrected == 4
+    day = 1440 * 60 * 1000
+    np.testing.assert_array_equal(
+        df.timezoneOffset, [840, -599, -599, -720, 719, -120, np.nan]
+    )
+    np.testing.assert_array_equal(
+        df.conversionOffset, [0, -day, -2 * day, 0, day, 2 * day, 0]
+    )
+
+
+def test_get_and_preprocess_upload_records():
+    df = pd.DataFrame({
+        "type": ["upload", "upload", "upload", "upload", "upload", "cbg"],
+        "deviceTags": [
+            ["insulin-pump", "bgm"], "['cgm']", "['cgm']",
+            ["cgm", "insulin-pump"], ["bgm"], np.nan
+        ],
+        "timeProcessing": [
+            "utc-bootstrapping", "none", np.nan,
+            "across-the-board-timezone", "none", np.nan
+        ],
+    })
+
+    ud = elt.getAndPreprocessUploadRecords(df)
+
+    assert list(ud.deviceType.fillna("")) == [
+        "pump", "healthkit", "cgm", "cgm", ""
+    ]
+
+
+@pytest.mark.parametrize("payloads", [
+    # json data
+    [{"systemTime": "2018-01-01T00:00:00"}, {"trend": "flat"}, np.nan],
+    # csv data
+    ["{'systemTime': '2018-01-01T00:00:00'}", "{'trend': 'flat'}", np.nan],
+])
+def test_get_and_preprocess_non_dexcom_api_cgm_records(payloads):
+    df = pd.DataFrame({
+        "type": ["cbg", "cbg", "cbg", "smbg"],
+        "timezoneOffset": [-420, -420, -420, -420],
+        "payload": payloads + [{"systemTime": "2018-01-01T00:00:00"}],
+    })
+
+    cd = elt.getAndPreprocessNonDexApiCgmRecords(df)
+
+    assert list(cd.index) == [1, 2]
+
+
+def test_get_and_preprocess_non_dexcom_api_cgm_records_flat_payload():
+    df = pd.DataFrame({
+        "type": ["cbg", "cbg"],
+        "timezoneOffset": [-420, -420],
+        "payload.systemTime": ["2018-01-01T00:00:00", np.nan],
+    })
+
+    cd = elt.getAndPreprocessNonDexApiCgmRecords(df)
+
+    assert list(cd.index) == [1]
+
+
+def test_make_synthetic_dataset():
+    import benchmark_estimate_local_time as belt
+
+    df = belt.make_synthetic_dataset(
+        years=0.25, dexcomApiFraction=1, corruptedFraction=0.2, seed=1
+    )
+
+    assert set(df.type) == {"cbg", "bolus", "upload"}
+    assert df.id.is_unique
+    assert df.payload.str.contains("systemTime").any()
+    assert (df.timezoneOffset.abs() > 1440).any()
+    assert "none" in set(df.timeProcessing)
+    assert df.equals(belt.make_synthetic_dataset(
+        years=0.25, dexcomApiFraction=1, corruptedFraction=0.2, seed=1
+    ))
+
+
+def test_run_benchmark(tmpdir):
+    import benchmark_estimate_local_time as belt
+
+    inputFile = str(tmpdir.join("synthetic.csv"))
+    belt.make_synthetic_dataset(years=0.1, cgmMinutes=60).to_csv(
+        inputFile, index=False
+    )
+
+    stats = belt.run_benchmark(inputFile, timezone_aliases_path, "2015-03-01")
+
+    for stage in belt.STAGES:
+        assert stats[stage + "Seconds"] >= 0
+    assert stats["nDays"] > 0
+    assert stats["nRows"] > 0
+    assert stats["peakMemoryMB"] >= stats["startMemoryMB"]
@@ -0,0 +1,223 @@
+import datetime as dt
+import json
+import os
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import get_single_tidepool_dataset as gstd
+import donor_data_store
+from mock_tidepool_api import RECORDS
+from tidepool_client import TidepoolClient
+
+
+def test_get_data_api_streams_in_batches(api_url):
+    batches = []
+
+    class ListSink:
+        def write_records(self, records):
+            batches.append(records)
+
+    nRecords, _ = gstd.get_data_api(
+        "donor",
+        pd.to_datetime("2019-01-01"),
+        pd.to_datetime("2019-12-31"),
+        TidepoolClient(("email", "password"), api_url=api_url),
+        sink=ListSink(),
+        batch_size=2
+    )
+
+    assert nRecords == len(RECORDS)
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert [r for b in batches for r in b] == RECORDS
+
+
+def test_get_data_api_without_sink(api_url):
+    df, endDate = gstd.get_data_api(
+        "donor",
+        pd.to_datetime("2019-01-01"),
+        pd.to_datetime("2019-12-31"),
+        TidepoolClient(("email", "password"), api_url=api_url)
+    )
+
+    assert list(df.id) == [r["id"] for r in RECORDS]
+    assert endDate == pd.to_datetime("2018-12-31T00:00:00.000Z")
+
+
+def test_get_data_streams_to_ndjson(api_url, tmpdir):
+    file_path = os.path.join(str(tmpdir), "PHI-donor.ndjson")
+    sink = donor_data_store.DonorNdjsonWriter(file_path)
+
+    nRecords, userid = gstd.get_data(
+        weeks_of_data=4,
+        userid_of_shared_user="donor",
+        auth=("email", "password"),
+        sink=sink,
+        api_url=api_url
+    )
+    sink.close()
+
+    with open(file_path) as f:
+        saved = [json.loads(line) for line in f]
+
+    assert userid == "donor"
+    assert nRecords == len(RECORDS)
+    assert saved == RECORDS
+
+
+def test_get_data_streams_to_parquet(api_url, tmpdir):
+    dataset_path = str(tmpdir)
+    sink = donor_data_store.DonorParquetWriter(dataset_path, "donor")
+
+    nRecords, _ = gstd.get_data(
+        weeks_of_data=4,
+        userid_of_shared_user="donor",
+        auth=("email", "password"),
+        sink=sink,
+        api_url=api_url
+    )
+    sink.close()
+
+    cbg = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", types=["cbg"], columns=["id", "value"]
+    )
+    basal = donor_data_store.load_donor_dataset(
+        dataset_path, "donor", types=["basal"]
+    )
+
+    assert nRecords == len(RECORDS)
+    assert list(cbg.id) == ["a1", "a2"]
+    assert list(cbg.value) == [5.5, 6.1]
+    assert basal["suppressed.rate"].tolist() == [1.0]
+
+
+def make_record(id, type, days_ago, uploadId, **fields):
+    time = dt.datetime.utcnow() - dt.timedelta(days=days_ago)
+    return dict(
+        id=id,
+        type=type,
+        uploadId=uploadId,
+        time=time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        **fields
+    )
+
+
+def test_incremental_download(mock_api, tmpdir):
+    mock_api.records = [
+        make_record("up1", "upload", 100, "u1"),
+        make_record("b1", "bolus", 100, "u1", normal=1.5),
+        make_record("c1", "cbg", 100, "u1", value=5.5),
+        make_record("c2", "cbg", 30, "u1", value=6.1),
+    ]
+    kwargs = dict(
+        date_stamp="2020-01-01",
+        data_path=str(tmpdir),
+        weeks_of_data=52,
+        userid_of_shared_user="donor",
+        auth=("email", "password"),
+        storage_format="parquet",
+        api_url=mock_api.url,
+        incremental=True
+    )
+    parquet_path = donor_data_store.get_parquet_dataset_path(
+        str(tmpdir), "2020-01-01"
+    )
+
+    # the first download is in full, and saves the watermark
+    gstd.get_and_save_dataset(**kwargs)
+    watermark = donor_data_store.get_watermark(parquet_path, "donor")
+    assert watermark["maxTime"] == mock_api.records[-1]["time"][:-1] + ".000000Z"
+    assert watermark["uploadIds"] == ["u1"]
+
+    # new data, an edited record, and a new upload of older data
+    mock_api.records = mock_api.records + [
+        make_record("c3", "cbg", 1, "u1", value=7.2),
+        make_record("up2", "upload", 1, "u2"),
+        make_record("c4", "cbg", 200, "u2", value=8.3),
+    ]
+    mock_api.records[3] = dict(
+        mock_api.records[3], value=6.2, modifiedTime=mock_api.records[4]["time"]
+    )
+    mock_api.requests = []
+    bolus_part = os.path.join(
+        donor_data_store.get_donor_path(parquet_path, "donor"),
+        "type=bolus", "part-0.parquet"
+    )
+    bolus_mtime = os.path.getmtime(bolus_part)
+
+    gstd.get_and_save_dataset(**kwargs)
+
+    # only the weeks since the watermark, and the older data of the new
+    # upload were requested
+    data_requests = [r[1] for r in mock_api.requests if "/data/" in r[1]]
+    assert len(data_requests) == 3
+    startDate = urlparse_query(data_requests[0])["startDate"][0]
+    assert pd.to_datetime(startDate) > pd.to_datetime(watermark["maxTime"]) \
+        - pd.Timedelta(gstd.INCREMENTAL_LOOKBACK_DAYS + 8, unit="d")
+    assert "uploadId=u2" in data_requests[2]
+
+    cbg = donor_data_store.load_donor_dataset(
+        parquet_path, "donor", types=["cbg"], columns=["id", "value"]
+    )
+    assert sorted(cbg.id) == ["c1", "c2", "c3", "c4"]
+    assert cbg.set_index("id").loc["c2", "value"] == 6.2
+    assert os.path.getmtime(bolus_part) == bolus_mtime
+
+    watermark = donor_data_store.get_watermark(parquet_path, "donor")
+    assert watermark["uploadIds"] == ["u1", "u2"]
+
+
+def test_merge_donor_dataset(tmpdir):
+    dataset_path = str(tmpdir)
+
+    # the first merge of a donor saves it, without the ids that the
+    # overlapping download windows repeat
+    nAdded, nReplaced = donor_data_store.merge_donor_dataset(
+        pd.DataFrame(RECORDS[:3] + RECORDS[1:3]), dataset_path, "donor"
+    )
+    cbg = donor_data_store.load_donor_dataset(dataset_path, "donor", ["cbg"])
+
+    assert (nAdded, nReplaced) == (3, 0)
+    assert len(donor_data_store.load_donor_dataset(dataset_path, "donor")) == 3
+    assert sorted(cbg.id) == ["a1", "a2"]
+
+    new = pd.DataFrame([
+        dict(RECORDS[1], value=7.0),
+        {"id": "a6", "type": "cbg", "value": 8.0},
+    ])
+    nAdded, nReplaced = donor_data_store.merge_donor_dataset(
+        new, dataset_path, "donor"
+    )
+    cbg = donor_data_store.load_donor_dataset(dataset_path, "donor", ["cbg"])
+
+    assert (nAdded, nReplaced) == (1, 1)
+    assert sorted(zip(cbg.id, cbg.value)) == [
+        ("a1", 5.5), ("a2", 7.0), ("a6", 8.0)
+    ]
+
+    # records that were not modified since the watermark are skipped
+    nAdded, nReplaced = donor_data_store.merge_donor_dataset(
+        pd.DataFrame([dict(RECORDS[0], value=1.0)]),
+        dataset_path,
+        "donor",
+        modified_since="2020-01-01T00:00:00.000000Z"
+    )
+    cbg = donor_data_store.load_donor_dataset(dataset_path, "donor", ["cbg"])
+
+    assert (nAdded, nReplaced) == (0, 0)
+    assert cbg.set_index("id").loc["a1", "value"] == 5.5
+
+
+def test_get_incremental_windows():
+    windows = gstd.get_incremental_windows(
+        {"maxTime": "2020-03-01T10:00:00.000000Z"},
+        lookback_days=7,
+        now=dt.datetime(2020, 3, 10, 12)
+    )
+
+    assert len(windows) == 1
+    assert windows[0][0] <= pd.to_datetime("2020-02-23")
+
+
+def urlparse_query(path):
+    return parse_qs(urlparse(path).query)
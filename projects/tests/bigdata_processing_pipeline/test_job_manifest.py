@@ -0,0 +1,105 @@
+import os
+from multiprocessing import Pool
+
+import pytest
+
+import async_fetcher
+import job_manifest
+from job_manifest import JobManifest
+
+
+def record_job(manifest, userid):
+    try:
+        with manifest.track("stage", userid, input_bytes=10):
+            if userid == "u2":
+                raise ValueError("bad data")
+    except ValueError:
+        pass
+
+    return userid
+
+
+def test_resume_unfinished_jobs(tmpdir):
+    manifest = JobManifest.for_date_stamp(str(tmpdir), "2020-01-01")
+    assert os.path.exists(
+        job_manifest.get_manifest_path(str(tmpdir), "2020-01-01")
+    )
+    manifest.add_jobs("stage", ["u1", "u2", "u3", "u4"])
+
+    record_job(manifest, "u1")
+    record_job(manifest, "u2")
+    # a job that was running when the batch stopped
+    manifest.start("stage", "u3")
+
+    # a new connection sees the state of the previous run
+    manifest = JobManifest.for_date_stamp(str(tmpdir), "2020-01-01")
+    assert manifest.get_unfinished("stage") == ["u3", "u4"]
+    assert manifest.get_unfinished("stage", retry_failed=True) == [
+        "u2", "u3", "u4"
+    ]
+    assert manifest.get_unfinished("stage", ["u5", "u4", "u1"]) == ["u5", "u4"]
+
+    jobs = manifest.get_jobs("stage").set_index("userid")
+    assert jobs.loc["u1", "status"] == "done"
+    assert jobs.loc["u1", "inputBytes"] == 10
+    assert jobs.loc["u2", "status"] == "failed"
+    assert "ValueError: bad data" in jobs.loc["u2", "error"]
+    assert jobs.loc["u3", "status"] == "running"
+
+    # adding the donors again does not reset their state
+    manifest.add_jobs("stage", ["u1", "u2"])
+    assert manifest.summary("stage").loc["stage"].to_dict() == {
+        "done": 1, "failed": 1, "pending": 1, "running": 1
+    }
+
+
+def test_interrupted_job_is_left_running(tmpdir):
+    manifest = JobManifest(os.path.join(str(tmpdir), "manifest.sqlite"))
+
+    with pytest.raises(KeyboardInterrupt):
+        with manifest.track("stage", "u1"):
+            raise KeyboardInterrupt
+
+    assert manifest.get_unfinished("stage") == ["u1"]
+
+
+def test_shared_with_worker_processes(tmpdir):
+    manifest = JobManifest(os.path.join(str(tmpdir), "manifest.sqlite"))
+    userids = ["u%d" % i for i in range(20)]
+    manifest.add_jobs("stage", userids)
+
+    with Pool(4) as pool:
+        pool.starmap(record_job, [(manifest, u) for u in userids])
+
+    jobs = manifest.get_jobs("stage")
+    assert (jobs["attempts"] == 1).all()
+    assert manifest.get_unfinished("stage", retry_failed=True) == ["u2"]
+
+
+def test_async_fetcher_records_stages(mock_api, tmpdir):
+    manifest = JobManifest(os.path.join(str(tmpdir), "manifest.sqlite"))
+    session_infos = {
+        "bigdata": {
+            "auth": ("email", "password"),
+            "api_url": mock_api.url,
+            "token": None,
+            "userid": None
+        }
+    }
+    mock_api.fail_data_requests(10)
+
+    async_fetcher.get_all_donor_data(
+        [("donor1", "bigdata")],
+        session_infos,
+        "2020-01-01",
+        str(tmpdir),
+        storage_format="ndjson",
+        weeks_of_data=4,
+        manifest=manifest,
+        max_retries=0
+    )
+
+    jobs = manifest.get_jobs().set_index("stage")
+    assert jobs.loc["metadata", "status"] == "done"
+    assert jobs.loc["dataset", "status"] == "failed"
+    assert "503" in jobs.loc["dataset", "error"]
@@ -0,0 +1,444 @@
+import datetime as dt
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import donor_data_store
+import qualify_single_dataset as qsd
+from job_manifest import JobManifest
+
+
+def make_day_stats(days, calculator_counts=None, missing_dates=()):
+    # one row per day, where "q" is a qualifying day and "-" is a day that
+    # does not qualify (i.e., a day of a gap)
+    begin_date = dt.date(2019, 1, 1)
+    df = pd.DataFrame({
+        "date": [begin_date + dt.timedelta(days=i) for i in range(len(days))],
+        "bolus.count": [3 if day == "q" else 0 for day in days],
+        "cgm.count": [288 if day == "q" else 0 for day in days],
+    })
+    if calculator_counts is None:
+        calculator_counts = [i % 4 for i in range(len(days))]
+    df["calculator.count"] = calculator_counts
+    df.loc[list(missing_dates), "date"] = None
+
+    return qsd.isQualifyingDay(df, 1, 0.5, 288)
+
+
+def get_window_stats_per_day(df, window_size):
+    # the stats of each window, one day at a time
+    rows = []
+    for i in range(len(df) - window_size + 1):
+        window = df.iloc[i:i + window_size]
+        longest_gap, gap = 0, 0
+        for is_qualifying in window["qualifyingDay"]:
+            gap = 0 if is_qualifying else gap + 1
+            longest_gap = max(longest_gap, gap)
+        rows.append({
+            "avgBolusCalculationsPerDay": window["calculator.count"].mean(),
+            "numberContiguousDays": window["date"].count(),
+            "percentQualifyingDays":
+                window["qualifyingDay"].sum() / window_size * 100,
+            "maxGapToContiguousRatio": longest_gap / window_size * 100,
+        })
+
+    return pd.DataFrame(rows, columns=[
+        "avgBolusCalculationsPerDay",
+        "numberContiguousDays",
+        "percentQualifyingDays",
+        "maxGapToContiguousRatio",
+    ])
+
+
+def assert_same_window_stats(df, window_size):
+    stats = qsd.getSlidingWindowStats(df, window_size)
+    expected = get_window_stats_per_day(df, window_size)
+
+    assert len(stats) == len(expected)
+    for column in list(expected):
+        np.testing.assert_allclose(
+            stats[column].astype(float).values,
+            expected[column].astype(float).values,
+            err_msg=column
+        )
+
+
+@pytest.mark.parametrize("days", [
+    "--qqqqq-qqq",
+    "qqq-qqqq---",
+    "---qq-q--qq-----",
+    "qqqqqqqqqq",
+    "----------",
+    "q",
+    "-",
+])
+@pytest.mark.parametrize("window_size", [1, 2, 3, 5, 10])
+def test_sliding_window_stats(days, window_size):
+    assert_same_window_stats(make_day_stats(days), window_size)
+
+
+def test_sliding_window_stats_missing_days():
+    days = "qq--qqq-qqqq-q"
+    calculator_counts = [
+        np.nan, 2, np.nan, np.nan, np.nan, 1, 5, np.nan, 0, 3, np.nan,
+        np.nan, np.nan, np.nan
+    ]
+    df = make_day_stats(days, calculator_counts, missing_dates=[0, 6, 7])
+
+    for window_size in [1, 2, 3, 4, 7, 14]:
+        assert_same_window_stats(df, window_size)
+
+    # a window of days without any calculator count has no average
+    stats = qsd.getSlidingWindowStats(df, 4)
+    assert np.isnan(float(stats.loc[10, "avgBolusCalculationsPerDay"]))
+
+
+def test_sliding_window_longer_than_series():
+    df = make_day_stats("q-qq")
+
+    stats = qsd.getSlidingWindowStats(df, 5)
+
+    assert len(stats) == 0
+    assert list(stats) == [
+        "avgBolusCalculationsPerDay",
+        "numberContiguousDays",
+        "percentQualifyingDays",
+        "maxGapToContiguousRatio",
+        "tier",
+    ]
+    df, qualifyingResults = qsd.getQualifyingTier(df, "tier1", 5, 1, 50, 50)
+    assert qualifyingResults == {"qualified": False}
+
+
+def test_window_sums_and_max_gap_run():
+    random_state = np.random.RandomState(20)
+    for _ in range(50):
+        n_days = random_state.randint(1, 40)
+        days = "".join(random_state.choice(["q", "-"], n_days))
+        df = make_day_stats(days)
+        values = random_state.randint(0, 10, n_days)
+        for window_size in range(1, n_days + 1):
+            n_windows = n_days - window_size + 1
+            np.testing.assert_array_equal(
+                qsd.windowSums(values, window_size),
+                [values[i:i + window_size].sum() for i in range(n_windows)]
+            )
+            expected = get_window_stats_per_day(df, window_size)
+            np.testing.assert_array_equal(
+                qsd.getMaxGapRunInWindow(
+                    df["gapGroup"].values.astype(int), window_size
+                ),
+                (expected["maxGapToContiguousRatio"] * window_size / 100)
+                .round().astype(int)
+            )
+
+
+def test_qualifying_tier():
+    df = make_day_stats("--qqqqq-qqqq-qq---", [2] * 18)
+
+    df, qualifyingResults = qsd.getQualifyingTier(df, "tier1", 7, 1, 80, 20)
+
+    expected = get_window_stats_per_day(df, 7)
+    expected_tier = (
+        (expected["numberContiguousDays"] == 7)
+        & (expected["avgBolusCalculationsPerDay"] >= 1)
+        & (expected["percentQualifyingDays"] >= 80)
+        & (expected["maxGapToContiguousRatio"] <= 20)
+    )
+    assert list(df["tier1.tier"].iloc[:len(expected)]) == list(expected_tier)
+    # the longest run of qualifying windows starts on days 2 to 5
+    assert list(np.flatnonzero(expected_tier)) == [2, 3, 4, 5, 8]
+    assert qualifyingResults == {
+        "qualified": True,
+        "qualified.beginDate": dt.date(2019, 1, 3),
+        "qualified.endDate": dt.date(2019, 1, 13),
+        "qualified.nDaysToDeliever": 10,
+    }
+
+
+qualification_criteria = {
+    "name": "test",
+    "nTempBasalsPerDayIsClosedLoop": 3,
+    "timeFreqMin": 60,
+    "bolusesPerDay": 1,
+    "cgmPercentPerDay": 0.5,
+    "tierAbbr": "T",
+    "tierNames": ["T1", "T2", "T3"],
+    "minContiguousDays": [3, 5, 10],
+    "avgBolusCalcsPerDay": [0, 0, 0],
+    "percentDaysQualifying": [80, 80, 80],
+    "maxGapToContigRatio": [40, 40, 40],
+}
+
+
+def make_donor_data(n_days=8, cgm_gap_days=(5,)):
+    # an hourly cgm value (with a gap), two boluses, a calculator bolus and
+    # a few temp basals per day, and the upload they came from
+    records = [{
+        "type": "upload",
+        "time": "2019-01-%02dT23:00:00.000Z" % n_days,
+        "uploadId": "upload1",
+        "deviceId": "DexG5MobRec_SM1",
+    }]
+    for day in range(n_days):
+        date = "2019-01-%02d" % (day + 1)
+        if day not in cgm_gap_days:
+            for hour in range(24):
+                records.append({
+                    "type": "cbg",
+                    "time": "%sT%02d:00:00.000Z" % (date, hour),
+                    "deviceTime": "%sT%02d:00:00" % (date, hour),
+                    "value": 5 + (day + hour) % 5,
+                    "uploadId": "upload1",
+                    "deviceId": "DexG5MobRec_SM1",
+                    "payload": {"trend": {"rate": hour % 3}},
+                })
+        for hour in [8, 18]:
+            records.append({
+                "type": "bolus",
+                "subType": "normal",
+                "time": "%sT%02d:00:00.000Z" % (date, hour),
+                "normal": 1 + day % 3,
+                "annotations": [{"code": "bolus/test"}],
+                "uploadId": "upload1",
+                "deviceId": "tandem_12345",
+            })
+        records.append({
+            "type": "wizard",
+            "time": "%sT08:00:00.000Z" % date,
+            "bolus": "bolus-%d" % day,
+            "uploadId": "upload1",
+            "deviceId": "tandem_12345",
+        })
+        for hour in range(0, 24, 6):
+            records.append({
+                "type": "basal",
+                "deliveryType": "temp" if day % 2 else "scheduled",
+                "time": "%sT%02d:00:00.000Z" % (date, hour),
+                "duration": 21600000,
+                "uploadId": "upload1",
+                "deviceId": "tandem_12345",
+            })
+
+    return pd.DataFrame(records)
+
+
+def write_donor_csv(data_path, date_stamp, userid, data):
+    paths = qsd.get_qualify_paths(
+        data_path, date_stamp, qualification_criteria
+    )
+    os.makedirs(paths["dataset"], exist_ok=True)
+    data.to_csv(
+        os.path.join(paths["dataset"], "PHI-" + userid + ".csv"), index=False
+    )
+
+    return paths
+
+
+def test_qualify_dataset(tmpdir):
+    paths = write_donor_csv(
+        str(tmpdir), "2019-02-01", "donor1", make_donor_data()
+    )
+
+    metadata = qsd.qualify_dataset(
+        "donor1", qualification_criteria, paths, save_dayStats=True
+    )
+
+    assert metadata.loc["donor1", "outputMessage"] == "qualifed as T2"
+    assert metadata.loc["donor1", "T.topTier"] == "T2"
+    assert metadata.loc["donor1", "contiguous.count"] == 8
+    assert metadata.loc["donor1", "qualifyingDays.count"] == 7
+    assert metadata.loc["donor1", "qualifyingDays.percent"] == 87.5
+    assert metadata.loc["donor1", "cgm.percentDexcomCGM"] == 100
+    # the 5 days before the gap qualify for T1 and T2, but not 10 days
+    assert metadata.loc["donor1", ["T1.qualified", "T2.qualified"]].all()
+    assert metadata.loc["donor1", "T1.qualified.beginDate"] == \
+        dt.date(2019, 1, 1)
+    assert metadata.loc["donor1", "T1.qualified.nDaysToDeliever"] == 5
+    assert metadata.loc["donor1", "T2.qualified.nDaysToDeliever"] == 8
+    assert not metadata.loc["donor1", "T3.qualified"]
+
+    saved_metadata = pd.read_csv(
+        os.path.join(paths["metadata"], "donor1.csv"), index_col=0
+    )
+    assert saved_metadata.loc["donor1", "outputMessage"] == "qualifed as T2"
+
+    day_stats = pd.read_csv(
+        os.path.join(paths["dayStats"], "donor1.csv"), index_col="dayIndex"
+    )
+    assert list(day_stats["date"]) == [
+        "2019-01-%02d" % day for day in range(1, 9)
+    ]
+    assert list(day_stats["cgm.count"]) == [24, 24, 24, 24, 24, 0, 24, 24]
+    assert list(day_stats["bolus.count"]) == [2] * 8
+    assert list(day_stats["qualifyingDay"]) == [
+        True, True, True, True, True, False, True, True
+    ]
+    assert list(day_stats["T1.tier"].iloc[:6]) == [
+        True, True, True, False, False, False
+    ]
+    assert list(day_stats["T2.tier"].iloc[:4]) == [True] * 4
+
+
+def test_qualify_dataset_without_data(tmpdir):
+    paths = write_donor_csv(
+        str(tmpdir), "2019-02-01", "donor1", make_donor_data(n_days=1)[:5]
+    )
+
+    metadata = qsd.qualify_dataset("donor1", qualification_criteria, paths)
+    assert metadata.loc["donor1", "outputMessage"] == \
+        "file does not contain enough data"
+
+    metadata = qsd.qualify_dataset("donor2", qualification_criteria, paths)
+    assert metadata.loc["donor2", "outputMessage"] == "file does not exist"
+    assert "fileSize" not in list(metadata)
+
+
+def run_batch_process(data_path, criteria_path, *args):
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(
+                os.path.dirname(qsd.__file__),
+                "qualify_all_donor_data_batch_process.py"
+            ),
+            "--date-stamp", "2019-02-01",
+            "--output-data-path", data_path,
+            "--qualification-criteria", criteria_path,
+            "--save-dayStats", "True",
+            "--workers", "2",
+        ] + list(args),
+        check=True
+    )
+
+
+def test_worker_pool_matches_direct_call(tmpdir):
+    # qualify the same donors with the batch process (a pool of workers) and
+    # with direct calls
+    userids = ["donor1", "donor2", "donor3", "donor4"]
+    donor_data = {
+        "donor1": make_donor_data(),
+        "donor2": make_donor_data(n_days=12, cgm_gap_days=(0, 6)),
+        "donor3": make_donor_data(n_days=4, cgm_gap_days=()),
+    }
+    batch_path = str(tmpdir.mkdir("batch"))
+    direct_path = str(tmpdir.mkdir("direct"))
+    for data_path in [batch_path, direct_path]:
+        for userid, data in donor_data.items():
+            write_donor_csv(data_path, "2019-02-01", userid, data)
+    pd.DataFrame({"userID": userids}).to_csv(
+        os.path.join(
+            batch_path,
+            "PHI-2019-02-01-donor-data",
+            "PHI-2019-02-01-uniqueDonorList.csv"
+        ),
+        index=False
+    )
+    criteria_path = str(tmpdir.join("criteria.json"))
+    with open(criteria_path, "w") as criteria_file:
+        json.dump(qualification_criteria, criteria_file)
+
+    run_batch_process(batch_path, criteria_path)
+
+    batch_paths = qsd.get_qualify_paths(
+        batch_path, "2019-02-01", qualification_criteria
+    )
+    direct_paths = qsd.get_qualify_paths(
+        direct_path, "2019-02-01", qualification_criteria
+    )
+    for userid in userids:
+        qsd.qualify_dataset(
+            userid, qualification_criteria, direct_paths, save_dayStats=True
+        )
+        for output in ["metadata", "dayStats"]:
+            direct_file = os.path.join(direct_paths[output], userid + ".csv")
+            batch_file = os.path.join(batch_paths[output], userid + ".csv")
+            assert os.path.exists(batch_file) == os.path.exists(direct_file)
+            if os.path.exists(direct_file):
+                pd.testing.assert_frame_equal(
+                    pd.read_csv(batch_file), pd.read_csv(direct_file)
+                )
+
+    all_metadata = pd.read_csv(os.path.join(
+        batch_path,
+        "PHI-2019-02-01-donor-data",
+        "PHI-2019-02-01-qualification-metadata.csv"
+    ))
+    assert sorted(all_metadata["userid"]) == userids
+    manifest = JobManifest.for_date_stamp(batch_path, "2019-02-01")
+    jobs = manifest.get_jobs("qualify-test").set_index("userid")
+    assert jobs["status"].to_dict() == {
+        "donor1": "done",
+        "donor2": "done",
+        "donor3": "done",
+        "donor4": "failed",
+    }
+    assert jobs.loc["donor4", "error"] == "no dataset: file does not exist"
+
+    # a donor without a dataset is qualified by --retry-failed, once its
+    # data has been downloaded
+    write_donor_csv(batch_path, "2019-02-01", "donor4", make_donor_data())
+    run_batch_process(batch_path, criteria_path, "--retry-failed")
+
+    jobs = manifest.get_jobs("qualify-test").set_index("userid")
+    assert (jobs["status"] == "done").all()
+    assert jobs["attempts"].to_dict() == {
+        "donor1": 1, "donor2": 1, "donor3": 1, "donor4": 2
+    }
+    metadata = pd.read_csv(
+        os.path.join(batch_paths["metadata"], "donor4.csv"), index_col=0
+    )
+    assert metadata.loc["donor4", "outputMessage"] == "qualifed as T2"
+
+
+def test_parquet_matches_csv(tmpdir):
+    # qualify the same donors from the csv files and from the parquet dataset
+    donor_data = {
+        "donor1": make_donor_data(),
+        "donor2": make_donor_data(n_days=12, cgm_gap_days=(0, 6)),
+    }
+    csv_paths = qsd.get_qualify_paths(
+        str(tmpdir.mkdir("csv")), "2019-02-01", qualification_criteria
+    )
+    os.makedirs(csv_paths["dataset"])
+    parquet_paths = qsd.get_qualify_paths(
+        str(tmpdir.mkdir("parquet")), "2019-02-01", qualification_criteria
+    )
+    for userid, data in donor_data.items():
+        for sink in [
+            donor_data_store.DonorCsvWriter(
+                os.path.join(csv_paths["dataset"], "PHI-" + userid + ".csv")
+            ),
+            donor_data_store.DonorParquetWriter(
+                parquet_paths["parquetDataset"], userid
+            ),
+        ]:
+            sink.write(data[:100])
+            sink.write(data[100:])
+            sink.close()
+
+    for userid in donor_data:
+        csv_metadata = qsd.qualify_dataset(
+            userid, qualification_criteria, csv_paths, save_dayStats=True
+        )
+        parquet_metadata = qsd.qualify_dataset(
+            userid, qualification_criteria, parquet_paths, save_dayStats=True
+        )
+        assert not os.path.exists(os.path.join(
+            parquet_paths["dataset"], "PHI-" + userid + ".csv"
+        ))
+        pd.testing.assert_frame_equal(
+            parquet_metadata.drop(columns="fileSize"),
+            csv_metadata.drop(columns="fileSize")
+        )
+        pd.testing.assert_frame_equal(
+            pd.read_csv(
+                os.path.join(parquet_paths["dayStats"], userid + ".csv")
+            ),
+            pd.read_csv(os.path.join(csv_paths["dayStats"], userid + ".csv"))
+        )
@@ -0,0 +1,68 @@
+import pandas as pd
+
+from accept_new_donors_and_get_donor_list import (
+    accept_new_donors_and_get_donor_list
+)
+from get_single_donor_metadata import get_shared_metadata
+from get_single_tidepool_dataset import get_data
+from mock_tidepool_api import RECORDS
+from tidepool_client import TidepoolClient
+
+
+def test_login_once_for_many_donors(mock_api):
+    with TidepoolClient(("email", "password"), api_url=mock_api.url) as client:
+        for userid in ["donor1", "donor2", "donor3"]:
+            metadata, _ = get_shared_metadata(
+                userid_of_shared_user=userid, client=client
+            )
+            data, _ = get_data(
+                weeks_of_data=4, userid_of_shared_user=userid, client=client
+            )
+            assert metadata.loc[userid, "diagnosisType"] == "type1"
+            assert len(data) == len(RECORDS)
+
+    assert mock_api.nLogins == 1
+    assert mock_api.nLogouts == 1
+    # the requests share one (keep-alive) connection
+    assert len(mock_api.connections) == 1
+
+
+def test_login_again_when_token_expires(mock_api):
+    client = TidepoolClient(("email", "password"), api_url=mock_api.url)
+    assert client.get_profile("donor").ok
+
+    mock_api.expire_token()
+    api_response = client.get_profile("donor")
+
+    assert api_response.ok
+    assert mock_api.nLogins == 2
+
+
+def test_session_info_reuses_login(mock_api):
+    client = TidepoolClient(("email", "password"), api_url=mock_api.url)
+    client.login()
+
+    worker_client = TidepoolClient(**client.session_info())
+    assert worker_client.get_profile("donor").ok
+    assert mock_api.nLogins == 1
+
+
+def test_without_client_logs_in_and_out(mock_api):
+    metadata, userid = get_shared_metadata(
+        auth=("email", "password"), api_url=mock_api.url
+    )
+
+    assert userid == "master"
+    assert mock_api.nLogins == 1
+    assert mock_api.nLogouts == 1
+
+
+def test_accept_new_donors_and_get_donor_list(mock_api):
+    with TidepoolClient(("email", "password"), api_url=mock_api.url) as client:
+        nAccepted, donors = accept_new_donors_and_get_donor_list(client)
+
+    assert nAccepted == 1
+    assert ("PUT", "/confirm/accept/invite/master/donor") in mock_api.requests
+    pd.testing.assert_frame_equal(
+        donors, pd.DataFrame({"userID": ["master", "donor"]})
+    )
@@ -1,5 +1,6 @@
 
-from tidals.clean.clean import remove_duplicates, round_time
+from tidals.clean.clean import remove_duplicates, round_time, round_time_from_first_record, flatten_json
+import numpy as np
 import pandas as pd
 from pandas.util import testing as tm
 import pytest
@@ -35,3 +36,63 @@ def test_round_time(valid_df):
     rounded_df = round_time(raw_df)
     tm.assert_frame_equal(valid_df, rounded_df)
 
+
+
+def test_round_time_multiple_chunks():
+    raw_df = pd.DataFrame({"time": ["2018-11-19 23:20:01", "2018-11-19 23:24:59",
+                                    "2018-11-19 23:43:10", "2018-11-19 23:48:20"]})
+    rounded_df = round_time(raw_df)
+
+    expected_times = pd.to_datetime(["2018-11-19 23:50:00", "2018-11-19 23:45:00",
+                                     "2018-11-19 23:25:00", "2018-11-19 23:20:00"])
+    assert list(rounded_df["roundedTime"]) == list(expected_times)
+    assert "TIB" not in rounded_df
+
+
+def test_round_time_from_first_record():
+    raw_df = pd.DataFrame({"time": ["2018-11-19 23:52:30", "2018-11-19 23:20:01",
+                                    "2018-11-19 23:22:31", "2018-11-19 23:25:01",
+                                    "2018-11-19 23:50:00"]})
+    rounded_df = round_time_from_first_record(raw_df, verbose=True)
+
+    # multiples of 2:30 round up, and the large gap starts a new chunk
+    expected_times = pd.to_datetime(["2018-11-19 23:20:00", "2018-11-19 23:25:00",
+                                     "2018-11-19 23:25:00", "2018-11-19 23:50:00",
+                                     "2018-11-19 23:55:00"])
+    tm.assert_series_equal(rounded_df["roundedTime"],
+                           pd.Series(expected_times, name="roundedTime"))
+    assert list(rounded_df["minutesFromFirstRecord"]) == [0, 2.5, 5, 0, 2.5]
+
+
+def test_round_time_from_first_record_descending():
+    raw_df = pd.DataFrame({"time": ["2018-11-19 23:20:01", "2018-11-19 23:24:59"]})
+    rounded_df = round_time_from_first_record(raw_df, startWithFirstRecord=False)
+
+    assert list(rounded_df["time"]) == ["2018-11-19 23:24:59", "2018-11-19 23:20:01"]
+    assert list(rounded_df["roundedTime"]) == \
+        list(pd.to_datetime(["2018-11-19 23:25:00", "2018-11-19 23:20:00"]))
+    assert list(rounded_df) == ["time", "roundedTime"]
+
+
+def test_flatten_json():
+    raw_df = pd.DataFrame({
+        "type": ["basal", "basal", "bolus"],
+        "suppressed": [{"rate": 1.0, "suppressed": {"rate": 0.5}}, np.nan, "none"],
+        "payload": [{"a": 1}, np.nan, np.nan],
+        "annotations": [[{"code": "x"}, {"code": "y"}], np.nan, np.nan],
+    })
+
+    flat_df = flatten_json(raw_df.copy(), do_not_flatten=["payload"])
+
+    assert list(flat_df) == ["type", "suppressed", "payload", "annotations",
+                             "suppressed.rate", "suppressed.suppressed",
+                             "annotations.code"]
+    assert flat_df["suppressed"].isnull().tolist() == [True, True, False]
+    assert flat_df["suppressed.suppressed"][0] == {"rate": 0.5}
+    assert flat_df["payload"][0] == {"a": 1}
+    assert flat_df["annotations.code"][0] == "x"
+
+    deep_df = flatten_json(raw_df.copy(), max_depth=None)
+    assert deep_df["suppressed.suppressed.rate"].tolist()[0] == 0.5
+    assert deep_df["payload.a"].tolist()[0] == 1
+
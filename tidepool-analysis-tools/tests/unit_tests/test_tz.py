@@ -0,0 +1,90 @@
+from tidals.tz.tz import get_timezone_offsets, get_timezone_offset, localize_offset
+from tidals.tz.tz import get_date_offsets, get_date_offset, is_dst_change_date
+from tidals.tz.tz import get_offset_calendar, get_calendar_file, build_offset_calendar
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("timezone_name", [
+    "America/New_York", "America/St_Johns", "Asia/Kolkata",
+    "Australia/Lord_Howe", "America/Sao_Paulo", "UTC"
+])
+def test_get_timezone_offsets_match_localize(timezone_name):
+    # every 15 minutes of the days around the 2018 and 2019 dst changes
+    localTimes = pd.date_range("2018-01-01", "2020-01-01", freq="15min")
+    tzos = get_timezone_offsets(localTimes, timezone_name)
+    changes = np.flatnonzero(np.diff(tzos) != 0)
+    sample = np.unique(np.concatenate(
+        [np.arange(0, len(localTimes), 97)] +
+        [np.arange(max(i - 200, 0), min(i + 200, len(localTimes)))
+         for i in changes]
+    ))
+
+    expected = [localize_offset(t, timezone_name) for t in localTimes[sample]]
+
+    np.testing.assert_array_equal(tzos[sample], expected)
+
+
+def test_get_timezone_offsets():
+    localTimes = pd.Series(pd.to_datetime([
+        "2019-03-10 01:59", "2019-03-10 02:30", "2019-03-10 03:00",
+        "2019-11-03 00:59", "2019-11-03 01:30", "2019-11-03 02:00"
+    ]))
+
+    tzos = get_timezone_offsets(localTimes, "America/Denver")
+
+    assert list(tzos) == [-420, -360, -360, -360, -360, -420]
+    assert tzos.dtype == np.int64
+    assert get_timezone_offset(localTimes[2], "America/Denver") == -360
+
+
+def test_get_timezone_offsets_keep_legacy_minutes():
+    # -0330 has always been converted to -310 minutes
+    assert get_timezone_offset(pd.Timestamp("2019-01-01"), "America/St_Johns") == -310
+    assert get_timezone_offset(pd.Timestamp("2019-01-01"), "Asia/Kolkata") == 330
+
+
+def test_get_timezone_offsets_missing():
+    tzos = get_timezone_offsets([pd.Timestamp("2019-01-01"), pd.NaT], "Europe/London")
+
+    assert tzos[0] == 0
+    assert np.isnan(tzos[1])
+
+
+def test_get_date_offsets_match_offsets_at_midnight(tmpdir):
+    dates = pd.date_range("2017-01-01", "2020-01-01")
+
+    tzos = get_date_offsets(dates, "America/Sao_Paulo", str(tmpdir))
+
+    np.testing.assert_array_equal(
+        tzos, get_timezone_offsets(dates, "America/Sao_Paulo")
+    )
+    assert get_date_offset(dates[100], "America/Sao_Paulo", str(tmpdir)) == \
+        tzos[100]
+
+
+def test_offset_calendar_is_saved(tmpdir):
+    calendar = get_offset_calendar("Europe/Paris", str(tmpdir))
+    calendarFile = get_calendar_file("Europe/Paris", str(tmpdir))
+
+    assert os.path.isfile(calendarFile)
+    assert isinstance(calendar, np.memmap)
+    np.testing.assert_array_equal(
+        np.load(calendarFile), build_offset_calendar("Europe/Paris")
+    )
+
+
+def test_is_dst_change_date(tmpdir):
+    assert is_dst_change_date("2019-03-31", "Europe/Paris", str(tmpdir))
+    assert is_dst_change_date("2019-10-27", "Europe/Paris", str(tmpdir))
+    assert not is_dst_change_date("2019-10-28", "Europe/Paris", str(tmpdir))
+
+
+def test_get_date_offsets_outside_of_calendar(tmpdir):
+    tzos = get_date_offsets(
+        ["1980-07-01", "2018-07-01", None], "America/Denver", str(tmpdir)
+    )
+
+    np.testing.assert_array_equal(tzos, [-360, -360, np.nan])
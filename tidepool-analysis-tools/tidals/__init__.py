@@ -10,3 +10,4 @@ license: BSD-2-Clause
 
 from .clean import clean
 from .load import load
+from .tz import tz
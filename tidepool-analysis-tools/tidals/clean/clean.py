@@ -16,9 +16,22 @@ def remove_duplicates(df, criteriaDF):
     return df, nDuplicatesRemoved
 
 
+def get_chunk_first_index(isChunkStart):
+    import numpy as np
+    # returns the position of the first record of the chunk that each record
+    # belongs to, where a new chunk starts wherever isChunkStart is True.
+    # NOTE: the chunk ids are the cumulative sum of the chunk start mask
+    isChunkStart = np.asarray(isChunkStart, dtype=bool)
+    chunkId = np.cumsum(isChunkStart) - 1
+    firstIndex = np.flatnonzero(isChunkStart)[chunkId]
+
+    return firstIndex, chunkId
+
+
 def round_time(df, timeIntervalMinutes=5, timeField="time",
                roundedTimeFieldName="roundedTime", verbose=False):
     import pandas as pd
+    import numpy as np
     # A general purpose round time function that rounds the
     # "time" field to nearest <timeIntervalMinutes> minutes
     # INPUTS:
@@ -38,21 +51,20 @@ def round_time(df, timeIntervalMinutes=5, timeField="time",
 
     # separate the data into chunks if TIB is greater than <timeIntervalMinutes> minutes
     # so that rounding process can start over
-    largeGaps = list(df.query("TIB > " + str(timeIntervalMinutes)).index)
-    largeGaps.insert(0, 0)
-    largeGaps.append(len(df))
-
-    # loop through each chunk to get the cumulative sum and the rounded time
-    for gIndex in range(0, len(largeGaps) - 1):
+    isChunkStart = (df["TIB"] > timeIntervalMinutes).values
+    if len(df) > 0:
+        isChunkStart[0] = True
+    _, chunkId = get_chunk_first_index(isChunkStart)
 
-        df.loc[largeGaps[gIndex], "TIB"] = 0
+    # get the cumulative sum and the rounded time of all chunks at once
+    df.loc[isChunkStart, "TIB"] = 0
+    df["TIB_cumsum"] = df["TIB"].groupby(chunkId).cumsum()
 
-        df.loc[largeGaps[gIndex]:(largeGaps[gIndex + 1] - 1), "TIB_cumsum"] = \
-            df.loc[largeGaps[gIndex]:(largeGaps[gIndex + 1] - 1), "TIB"].cumsum()
-
-        df.loc[largeGaps[gIndex]:(largeGaps[gIndex + 1] - 1), roundedTimeFieldName] = \
-            pd.to_datetime(df.loc[largeGaps[gIndex], timeField]).round(str(timeIntervalMinutes) + "min") + \
-            pd.to_timedelta(df.loc[largeGaps[gIndex]:(largeGaps[gIndex + 1] - 1), "TIB_cumsum"], unit="m")
+    roundedChunkStart = \
+        pd.to_datetime(df.loc[isChunkStart, timeField]).dt.round(str(timeIntervalMinutes) + "min")
+    df[roundedTimeFieldName] = \
+        roundedChunkStart.iloc[chunkId].reset_index(drop=True) + \
+        pd.to_timedelta(df["TIB_cumsum"], unit="m")
 
     # sort descendingly by time and drop fieldsfields
     df.sort_values(by=timeField, ascending=False, inplace=True)
@@ -63,6 +75,95 @@ def round_time(df, timeIntervalMinutes=5, timeField="time",
     return df
 
 
+def round_time_from_first_record(df, timeIntervalMinutes=5, timeField="time",
+                                 roundedTimeFieldName="roundedTime",
+                                 startWithFirstRecord=True, verbose=False):
+    '''
+    A general purpose round time function that rounds the "time"
+    field to nearest <timeIntervalMinutes> minutes
+    INPUTS:
+        * a dataframe (df) that contains a time field that you want to round
+        * timeIntervalMinutes (defaults to 5 minutes given that most cgms output every 5 minutes)
+        * timeField to round (defaults to the UTC time "time" field)
+        * roundedTimeFieldName is a user specified column name (defaults to roundedTime)
+        * startWithFirstRecord starts the rounding with the first record if True, and the last record if False (defaults to True)
+        * verbose specifies whether the extra columns used to make calculations are returned
+    NOTE: each chunk of data (i.e., records that are separated by less than
+    2 times the <timeIntervalMinutes>) is rounded relative to the first
+    record of the chunk. All chunks are rounded at once on the int64
+    nanosecond representation of the time field.
+    '''
+    import pandas as pd
+    import numpy as np
+
+    df.sort_values(by=timeField, ascending=startWithFirstRecord, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    # make sure the time field is in the right form
+    t = pd.to_datetime(df[timeField].astype('datetime64[ns]'))
+    isNaT = t.isnull().values
+    tNs = t.values.view("i8")
+
+    # calculate the time between consecutive records
+    # NOTE: whole seconds are used (i.e., the days and seconds components)
+    secondsBetweenRecords = np.full(len(df), np.nan)
+    secondsBetweenRecords[1:] = np.floor_divide(np.diff(tNs), 10**9)
+    secondsBetweenRecords[isNaT | np.roll(isNaT, 1)] = np.nan
+    daysBetweenRecords = np.floor_divide(secondsBetweenRecords, 86400)
+    timeBetweenRecords = \
+        np.round(daysBetweenRecords*(86400/(60 * timeIntervalMinutes)) +
+                 (secondsBetweenRecords - daysBetweenRecords * 86400) /
+                 (60 * timeIntervalMinutes)) * timeIntervalMinutes
+
+    # separate the data into chunks if timeBetweenRecords is greater than
+    # 2 times the <timeIntervalMinutes> minutes so the rounding process starts over
+    with np.errstate(invalid="ignore"):
+        isChunkStart = np.abs(timeBetweenRecords) > (timeIntervalMinutes * 2)
+    if len(df) > 0:
+        isChunkStart[0] = True
+    firstIndex, _ = get_chunk_first_index(isChunkStart)
+    firstRecordNs = tNs[firstIndex]
+
+    # calculate the time difference between each time record and the first record
+    secondsFromFirstRecord = np.floor_divide(tNs - firstRecordNs, 10**9)
+    daysFromFirstRecord = np.floor_divide(secondsFromFirstRecord, 86400)
+    minutesFromFirstRecord = \
+        daysFromFirstRecord*(86400/(60)) + \
+        (secondsFromFirstRecord - daysFromFirstRecord * 86400)/(60)
+    isMissing = isNaT | isNaT[firstIndex]
+    minutesFromFirstRecord[isMissing] = np.nan
+
+    # then round to the nearest X Minutes
+    # NOTE: the ".000001" ensures that mulitples of 2:30 always rounds up.
+    roundedMinutesFromFirstRecord = \
+        np.round((minutesFromFirstRecord / timeIntervalMinutes) + 0.000001) * (timeIntervalMinutes)
+
+    # round the first record of each chunk (plus 1 microsecond) to the
+    # nearest X minutes, with ties going to the even multiple (like pd.Timestamp.round)
+    intervalNs = timeIntervalMinutes * 60 * 10**9
+    quotient, remainder = np.divmod(firstRecordNs + 1000, intervalNs)
+    roundUp = ((remainder > (intervalNs // 2)) |
+               ((remainder == (intervalNs // 2)) & (quotient % 2 == 1)))
+    roundedFirstRecordNs = (quotient + roundUp) * intervalNs
+
+    roundedTimeNs = \
+        roundedFirstRecordNs + \
+        np.where(isMissing, 0, roundedMinutesFromFirstRecord).astype("i8") * 60 * 10**9
+    roundedTimeNs[isMissing] = np.iinfo("i8").min
+
+    if verbose:
+        df["timeBetweenRecords"] = timeBetweenRecords
+        df["minutesFromFirstRecord"] = minutesFromFirstRecord
+        df["roundedMinutesFromFirstRecord"] = roundedMinutesFromFirstRecord
+    df[roundedTimeFieldName] = roundedTimeNs.view("datetime64[ns]")
+
+    # sort by time and drop fieldsfields
+    df.sort_values(by=timeField, ascending=startWithFirstRecord, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
 def remove_brackets(df, fieldName):
     if fieldName in list(df):
         df.loc[df[fieldName].notnull(), fieldName] = \
@@ -71,28 +172,68 @@ def remove_brackets(df, fieldName):
     return df
 
 
-def flatten_json(df):
+def flatten_json(df, do_not_flatten=None, max_depth=1,
+                 first_of_lists=["annotations"], sep="."):
+    '''
+    flatten the columns that have embedded json (dictionaries) into
+    "<column>.<key>" columns
+    INPUTS:
+        * df is a dataframe, e.g. of tidepool data
+        * do_not_flatten (optional) is a list of columns that are left as they are
+        * max_depth is the number of levels of embedded json that are flattened
+          (None flattens all of them)
+        * first_of_lists is a list of columns whose lists are replaced with their
+          first item before flattening (defaults to the annotations), True for
+          all columns
+        * sep is the separator between the column and key names
+    NOTE: the embedded json cells of a column are replaced by nan, and the new
+    columns are added after the existing ones. The type of each cell is checked
+    once, and all new columns are added with a single concat.
+    '''
     import pandas as pd
     import numpy as np
-    # remove [] from annotations field
-    df = remove_brackets(df, "annotations")
-
-    # loop through each columnHeading
-    newDataFrame = pd.DataFrame()
 
-    for colHead in list(df):
-        # if the df field has embedded json
-        if any(isinstance(item, dict) for item in df[colHead]):
-            # grab the data that is in brackets
-            jsonBlob = df[colHead][df[colHead].astype(str).str[0] == "{"]
+    if do_not_flatten is None:
+        do_not_flatten = []
 
-            # replace those values with nan
-            df.loc[jsonBlob.index, colHead] = np.nan
+    if first_of_lists is True:
+        first_of_lists = list(df)
 
-            # turn jsonBlob to dataframe
-            newDataFrame = pd.concat([newDataFrame, pd.DataFrame(jsonBlob.tolist(),
-                                      index=jsonBlob.index).add_prefix(colHead + '.')], axis=1)
-
-    df = pd.concat([df, newDataFrame], axis=1)
+    newColumns = []
+    for colHead in list(df):
+        if (df[colHead].dtype != object) or (colHead in do_not_flatten):
+            continue
+
+        cellTypes = df[colHead].map(type)
+
+        if colHead in first_of_lists:
+            isList = (cellTypes == list).values
+            if isList.any():
+                df.loc[isList, colHead] = df.loc[isList, colHead].str[0]
+                cellTypes = df[colHead].map(type)
+
+        isDict = (cellTypes == dict).values
+        if not isDict.any():
+            continue
+
+        jsonBlob = df.loc[isDict, colHead]
+        nested = pd.DataFrame(
+            jsonBlob.tolist(), index=jsonBlob.index
+        ).add_prefix(colHead + sep)
+
+        if (max_depth is None) or (max_depth > 1):
+            nested = flatten_json(
+                nested,
+                max_depth=None if max_depth is None else max_depth - 1,
+                first_of_lists=[],
+                sep=sep
+            )
+
+        # replace those values with nan
+        df.loc[isDict, colHead] = np.nan
+        newColumns.append(nested)
+
+    if len(newColumns) > 0:
+        df = pd.concat([df] + newColumns, axis=1, sort=False)
 
     return df
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: initialize the timezone offset tools of tidals
+license: BSD-2-Clause
+"""
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+description: timezone offset tools for tidals (tidepool data analytics tools)
+license: BSD-2-Clause
+
+The timezone offset of a local time used to be computed one value at a time
+with pytz.timezone(tz).localize(localTime).strftime("%z"). These tools build
+an offset table per timezone from the pytz transitions instead, so that an
+entire series of local times gets its offsets with one np.searchsorted.
+The offsets are the same as the ones of the strftime("%z") round trip.
+
+The offsets of whole dates (at local midnight) are also kept in a calendar
+per timezone, with a flag for the dates that have a dst change. The
+calendars are saved as .npy files (CALENDAR_PATH, or the
+TIDALS_TZ_CALENDAR_PATH environment variable) the first time a timezone is
+used, and are memory-mapped read-only after that, so they are shared by all
+of the processes (e.g., the workers of a batch) that use them.
+"""
+
+import os
+import functools
+
+
+# the dates that are in the calendars, other dates are computed on the fly
+CALENDAR_START = "1990-01-01"
+CALENDAR_END = "2050-01-01"
+CALENDAR_PATH = os.environ.get(
+    "TIDALS_TZ_CALENDAR_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "tidals", "tz-calendar")
+)
+
+
+def utc_offset_to_minutes(tzoNum):
+    import numpy as np
+    # converts an offset in "%z" format (as an int, e.g. -330 for -0330) to
+    # minutes. NOTE: this is the conversion that has always been used, which
+    # is off for negative offsets that are not whole hours (e.g. -0330
+    # is -310 minutes), it is kept so offsets do not change
+    tzoHours = np.floor(tzoNum / 100)
+    tzoMinutes = round((tzoNum / 100 - tzoHours) * 100, 0)
+    tzoSign = np.sign(tzoHours)
+    tzo = int((tzoHours * 60) + (tzoMinutes * tzoSign))
+
+    return tzo
+
+
+def localize_offset(localTime, timezoneName):
+    import pandas as pd
+    from pytz import timezone
+    # the offset (in minutes) of a single local time, the slow way.
+    # NOTE: localize resolves the local times that are skipped or repeated
+    # at a dst change differently for timestamps than for datetimes, the
+    # offsets of the timestamps are used
+    tz = timezone(timezoneName)
+    tzoNum = int(tz.localize(pd.Timestamp(localTime)).strftime("%z"))
+
+    return utc_offset_to_minutes(tzoNum)
+
+
+@functools.lru_cache(maxsize=None)
+def get_offset_table(timezoneName):
+    import numpy as np
+    from pytz import timezone
+    # returns the start of each segment of local (wall clock) time with a
+    # constant offset, in ns, and the offset of each segment in minutes.
+    # A transition at utc time t, from offset o1 to o2, changes the offset
+    # of the local times t + o1 and t + o2 (the gap or overlap in between
+    # is resolved the way localize_offset does)
+    tz = timezone(timezoneName)
+    boundaries = []
+    if hasattr(tz, "_utc_transition_times"):
+        transitionTimes = tz._utc_transition_times
+        transitionOffsets = [info[0] for info in tz._transition_info]
+        for i in range(1, len(transitionTimes)):
+            boundaries.append(transitionTimes[i] + transitionOffsets[i - 1])
+            boundaries.append(transitionTimes[i] + transitionOffsets[i])
+
+    boundaries = np.unique(np.array(boundaries, dtype="datetime64[ns]"))
+    if len(boundaries) > 0:
+        firstSample = boundaries[0] - np.timedelta64(2, "D")
+    else:
+        firstSample = np.datetime64("2000-01-01", "ns")
+
+    starts = np.concatenate([
+        [np.iinfo(np.int64).min], boundaries.astype(np.int64)
+    ])
+    samples = [firstSample] + list(boundaries)
+    offsets = np.array([
+        localize_offset(sample, timezoneName) for sample in samples
+    ])
+
+    return starts, offsets
+
+
+def get_timezone_offsets(localTimes, timezoneName):
+    import numpy as np
+    import pandas as pd
+    # the timezone offsets (in minutes) of an array of local times (e.g., a
+    # date or datetime series). Offsets are ints, unless a local time is
+    # missing, in which case the offsets are floats with nan where missing
+    localTimes = pd.to_datetime(pd.Series(localTimes)).values
+    starts, offsets = get_offset_table(timezoneName)
+    segment = np.searchsorted(
+        starts, localTimes.astype(np.int64), side="right"
+    ) - 1
+    tzos = offsets[segment]
+
+    isMissing = pd.isnull(localTimes)
+    if isMissing.any():
+        tzos = tzos.astype(float)
+        tzos[isMissing] = np.nan
+
+    return tzos
+
+
+def get_timezone_offset(localTime, timezoneName):
+    import numpy as np
+    import pandas as pd
+    # the timezone offset (in minutes) of a single local time
+    starts, offsets = get_offset_table(timezoneName)
+    segment = np.searchsorted(
+        starts, pd.Timestamp(localTime).value, side="right"
+    ) - 1
+
+    return int(offsets[segment])
+
+
+def get_calendar_file(timezoneName, calendarPath=None):
+    import pytz
+    # the calendars are saved by tz database version, so they are rebuilt
+    # when the timezone rules change
+    if calendarPath is None:
+        calendarPath = CALENDAR_PATH
+
+    return os.path.join(
+        calendarPath, pytz.OLSON_VERSION, *timezoneName.split("/")
+    ) + ".npy"
+
+
+def build_offset_calendar(timezoneName):
+    import numpy as np
+    import pandas as pd
+    # the offset at local midnight of each calendar date, and whether the
+    # offset changes during the date (i.e., the offset of the next date is
+    # different)
+    dates = pd.date_range(CALENDAR_START, CALENDAR_END)
+    offsets = get_timezone_offsets(dates, timezoneName)
+
+    calendar = np.zeros(
+        len(dates) - 1, dtype=[("offset", "i2"), ("isDstChange", "?")]
+    )
+    calendar["offset"] = offsets[:-1]
+    calendar["isDstChange"] = offsets[:-1] != offsets[1:]
+
+    return calendar
+
+
+@functools.lru_cache(maxsize=None)
+def get_offset_calendar(timezoneName, calendarPath=None):
+    import numpy as np
+    # load (memory-mapped) the calendar of a timezone, the calendar is built
+    # and saved if it does not exist yet
+    calendarFile = get_calendar_file(timezoneName, calendarPath)
+    if os.path.isfile(calendarFile):
+        return np.load(calendarFile, mmap_mode="r")
+
+    calendar = build_offset_calendar(timezoneName)
+    try:
+        os.makedirs(os.path.dirname(calendarFile), exist_ok=True)
+        # write to a temporary file first, so other processes never load a
+        # calendar that is half written
+        tempFile = calendarFile[:-4] + ".tmp" + str(os.getpid()) + ".npy"
+        np.save(tempFile, calendar)
+        os.replace(tempFile, calendarFile)
+        calendar = np.load(calendarFile, mmap_mode="r")
+    except OSError:
+        # the calendar is kept in memory if it cannot be saved
+        pass
+
+    return calendar
+
+
+def get_date_offsets(dates, timezoneName, calendarPath=None):
+    import numpy as np
+    import pandas as pd
+    # the timezone offsets (in minutes) at local midnight of an array of
+    # dates (the time of day is ignored). Offsets are ints, unless a date is
+    # missing, in which case the offsets are floats with nan where missing
+    dates = pd.to_datetime(pd.Series(dates)).values.astype("datetime64[D]")
+    calendar = get_offset_calendar(timezoneName, calendarPath)
+    dayIndex = (dates - np.datetime64(CALENDAR_START, "D")).astype(np.int64)
+    inCalendar = (
+        (dayIndex >= 0) & (dayIndex < len(calendar)) & ~pd.isnull(dates)
+    )
+
+    tzos = np.zeros(len(dates), dtype=np.int64)
+    tzos[inCalendar] = calendar["offset"][dayIndex[inCalendar]]
+    if not inCalendar.all():
+        tzos[~inCalendar] = np.nan_to_num(
+            get_timezone_offsets(dates[~inCalendar], timezoneName)
+        )
+
+    isMissing = pd.isnull(dates)
+    if isMissing.any():
+        tzos = tzos.astype(float)
+        tzos[isMissing] = np.nan
+
+    return tzos
+
+
+def get_calendar_index(date):
+    import pandas as pd
+    # the index of a date in the calendars
+    return (pd.Timestamp(date).normalize() - pd.Timestamp(CALENDAR_START)).days
+
+
+def get_date_offset(date, timezoneName, calendarPath=None):
+    import pandas as pd
+    # the timezone offset (in minutes) at local midnight of a single date
+    calendar = get_offset_calendar(timezoneName, calendarPath)
+    dayIndex = get_calendar_index(date)
+    if (dayIndex >= 0) & (dayIndex < len(calendar)):
+        return int(calendar[dayIndex]["offset"])
+
+    return get_timezone_offset(pd.Timestamp(date).normalize(), timezoneName)
+
+
+def is_dst_change_date(date, timezoneName, calendarPath=None):
+    import pandas as pd
+    # whether the timezone offset changes during the date
+    calendar = get_offset_calendar(timezoneName, calendarPath)
+    dayIndex = get_calendar_index(date)
+    if (dayIndex >= 0) & (dayIndex < len(calendar)):
+        return bool(calendar[dayIndex]["isDstChange"])
+
+    return (
+        get_date_offset(date, timezoneName, calendarPath) !=
+        get_date_offset(pd.Timestamp(date) + pd.Timedelta(1, unit="D"),
+                        timezoneName, calendarPath)
+    )